@@ -0,0 +1,335 @@
+#!/usr/bin/env python
+# Copyright 2015 Cisco Systems, Inc.  All rights reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+
+#
+# Benchmark of the cdict conversion callbacks (mkcdict_perf_script.py)
+#
+# Replays an event stream through the perf callbacks the way perf script does (without perf)
+# and reports the number of events converted per second and the memory growth for:
+# - dispatch: the per event argument count check of the original callbacks
+# - bound: the callbacks bound once to the handler matching the perf callback layout
+# for both the old (no common_callchain) and new perf callback layouts,
+# followed by the average cost of every callback.
+#
+# The event stream is either synthetic sched and kvm events or a stream recorded from
+# a perf data file with the built-in perf data reader (--record), e.g.:
+#   python mkcdict_bench.py --record perf.data --stream host1.stream
+#   python mkcdict_bench.py --stream host1.stream --target 2000000
+#
+# Usage: python mkcdict_bench.py [-n <events>] [-r <repeat>] [--stream <file>] [--target <events/s>]
+#
+import multiprocessing
+from optparse import OptionParser
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import mkcdict_perf_script as script
+from perf_data_reader import PerfDataReader
+from perf_formatter import packb
+from perf_formatter import unpackb
+
+# tids that do not exist in /proc so that name decoding does not depend on the host
+BASE_TID = 4000000
+TASK_COUNT = 64
+CPU_COUNT = 16
+
+def get_events(count, new_layout):
+    '''Generate a list of synthetic perf events
+    :param count: number of events to generate
+    :param new_layout: True to generate the new perf callback layout (with common_callchain)
+    :return: a list of (callback name, args tuple)
+    '''
+    events = []
+    secs = 1000
+    nsecs = 0
+    for index in xrange(count):
+        nsecs += 1500
+        if nsecs >= 1000000000:
+            secs += 1
+            nsecs -= 1000000000
+        cpu = index % CPU_COUNT
+        tid = BASE_TID + index % TASK_COUNT
+        next_tid = BASE_TID + (index + 1) % TASK_COUNT
+        comm = 'task-%d' % (tid)
+        kind = index % 4
+        if kind == 0:
+            name = 'sched__sched_switch'
+            fields = (comm, tid, 120, 1, 'task-%d' % (next_tid), next_tid, 120)
+        elif kind == 1:
+            name = 'sched__sched_stat_runtime'
+            fields = (comm, tid, 1200, 123456)
+        elif kind == 2:
+            name = 'kvm__kvm_entry'
+            fields = (0,)
+        else:
+            name = 'kvm__kvm_exit'
+            fields = (index % 50, 0, 0, 0, 0)
+        common = (name.split('__')[1], None, cpu, secs, nsecs, tid, comm)
+        if new_layout:
+            common += (None,)
+        events.append((name, common + fields))
+    return events
+
+def record_events(perf_data_file, stream_file, count=0):
+    '''Record the events of a perf data file into an event stream file
+    The stream has the arguments of every callback call in the new perf callback layout
+    :param perf_data_file: perf data file name
+    :param stream_file: event stream file name
+    :param count: maximum number of events to record (0 = all)
+    :return: the number of events recorded
+    '''
+    reader = PerfDataReader(perf_data_file)
+    events = []
+    for fmt, cpu, secs, nsecs, tid, raw_offset in reader.read_events():
+        name = fmt.full_name
+        if not hasattr(script, name):
+            # perf calls trace_unhandled for these events
+            continue
+        fields = list(fmt.decode(reader.data, raw_offset))
+        handler = getattr(script, '_' + name, None)
+        if handler:
+            fields = fields[:handler.__code__.co_argcount - 8]
+        events.append([name, [name, None, cpu, secs, nsecs, tid, reader.get_comm(tid), None] + fields])
+        if count and len(events) >= count:
+            break
+    with open(stream_file, 'wb') as ff:
+        ff.write(packb(events))
+    return len(events)
+
+def load_events(stream_file, new_layout):
+    '''Load a recorded event stream
+    :param stream_file: event stream file name (see record_events)
+    :param new_layout: True to use the new perf callback layout (with common_callchain)
+    :return: a list of (callback name, args tuple)
+    '''
+    with open(stream_file, 'rb') as ff:
+        events = unpackb(ff.read())
+    if new_layout:
+        return [(name, tuple(args)) for name, args in events]
+    return [(name, tuple(args[:7] + args[8:])) for name, args in events]
+
+def dispatch_callbacks():
+    '''Callbacks that check the argument count on every event'''
+    def get_callback(target):
+        def callback(*args):
+            arg_count = target.__code__.co_argcount
+            if len(args) != arg_count:
+                largs = list(args)
+                largs.insert(7, None)
+                args = tuple(largs)
+            target(*args)
+        return callback
+    return dict((name, get_callback(getattr(script, '_' + name))) for name in script.HANDLED_CALLBACKS)
+
+# events replayed by the worker processes (inherited when the pool is forked)
+replay_events = None
+
+def get_rss():
+    '''Get the resident memory of this process in KB'''
+    with open('/proc/self/status') as ff:
+        for line in ff:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+    return 0
+
+def run(mode, chunk_rows):
+    '''Convert the replay events in a fresh converter state
+    :param mode: 'dispatch' or 'bound'
+    :param chunk_rows: number of rows per cdict chunk
+    :return: a tuple of the elapsed time in seconds and the memory growth in KB
+    '''
+    reload(script)
+    # avoid any stdout output from the converter in the timed loop
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        rss = get_rss()
+        script.trace_begin(['codec=raw', 'chunk_rows=%d' % (chunk_rows)])
+        if mode == 'dispatch':
+            callbacks = dispatch_callbacks()
+        else:
+            callbacks = None
+        start = time.time()
+        if callbacks:
+            for name, args in replay_events:
+                callbacks[name](*args)
+        else:
+            # perf looks up the callback by name in the script module for every event
+            module_dict = vars(script)
+            for name, args in replay_events:
+                module_dict[name](*args)
+        elapsed = time.time() - start
+        # the converter state before the last chunk and the task names are written
+        growth = get_rss() - rss
+        script.trace_end()
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+    return elapsed, growth
+
+def run_process(mode, chunk_rows):
+    '''Run a conversion in a new process (the memory growth of a run is not affected by the previous runs)'''
+    pool = multiprocessing.Pool(1, maxtasksperchild=1)
+    try:
+        return pool.apply(run, (mode, chunk_rows))
+    finally:
+        pool.close()
+        pool.join()
+
+def noop_callback(*args):
+    pass
+
+def profile_callbacks(chunk_rows):
+    '''Measure the average cost of every bound callback on the replay events
+    Every call is timed, the cost of timing an empty callback is subtracted
+    :param chunk_rows: number of rows per cdict chunk
+    :return: a dict of [call count, total secs] indexed by callback name,
+        the 'flush_chunk' entry has the cost of encoding and writing the chunks
+        (also included in the cost of the callbacks that fill the chunks)
+    '''
+    timer = time.time
+    # cost of the timing loop
+    overhead = 0
+    for name, args in replay_events:
+        start = timer()
+        noop_callback(*args)
+        overhead += timer() - start
+    overhead /= max(len(replay_events), 1)
+
+    reload(script)
+    costs = {}
+    flush_chunk = script.flush_chunk
+
+    def timed_flush_chunk():
+        start = timer()
+        flush_chunk()
+        cost = costs.setdefault('flush_chunk', [0, 0])
+        cost[0] += 1
+        cost[1] += timer() - start
+    # add_event looks up flush_chunk in the module for every call
+    script.flush_chunk = timed_flush_chunk
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        script.trace_begin(['codec=raw', 'chunk_rows=%d' % (chunk_rows)])
+        module_dict = vars(script)
+        for name, args in replay_events:
+            callback = module_dict[name]
+            start = timer()
+            callback(*args)
+            elapsed = timer() - start
+            try:
+                cost = costs[name]
+                cost[0] += 1
+                cost[1] += elapsed - overhead
+            except KeyError:
+                costs[name] = [1, elapsed - overhead]
+        script.trace_end()
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+    return costs
+
+def print_callback_costs(costs):
+    print '  %-36s %10s %12s %8s' % ('callback', 'calls', 'usec/call', 'share')
+    total = sum(secs for name, (calls, secs) in costs.items() if name != 'flush_chunk') or 1
+    for name in sorted(costs, key=lambda name: costs[name][1], reverse=True):
+        calls, secs = costs[name]
+        print '  %-36s %10d %12.3f %7.1f%%' % (name, calls, secs * 1000000 / calls, secs * 100 / total)
+
+def main():
+    parser = OptionParser(usage="usage: %prog [options]")
+    parser.add_option("-n", "--events", dest="events",
+                      type="int",
+                      metavar="<count>",
+                      help="number of synthetic events to convert (default=500000) "
+                           "or maximum number of events to record")
+    parser.add_option("-r", "--repeat", dest="repeat",
+                      type="int",
+                      default=3,
+                      metavar="<count>",
+                      help="number of runs per case, the best run is reported (default=3)")
+    parser.add_option("--chunk-rows", dest="chunk_rows",
+                      type="int",
+                      default=script.CDICT_CHUNK_ROWS,
+                      metavar="<rows>",
+                      help="number of rows per cdict chunk (default=%d)" % (script.CDICT_CHUNK_ROWS))
+    parser.add_option("--stream", dest="stream",
+                      metavar="<file>",
+                      help="replay the events of a recorded event stream file instead of synthetic events "
+                           "(or the file to record to with --record)")
+    parser.add_option("--record", dest="record",
+                      metavar="<perf data file>",
+                      help="record the events of a perf data file into the --stream file "
+                           "(at most --events events if --events is given) and exit")
+    parser.add_option("--target", dest="target",
+                      type="int",
+                      default=0,
+                      metavar="<events/s>",
+                      help="report if the conversion rate of the bound callbacks is below this rate")
+    (opts, args) = parser.parse_args()
+    global replay_events
+
+    if opts.record:
+        if not opts.stream:
+            parser.error('--record requires --stream')
+        count = record_events(opts.record, opts.stream, opts.events or 0)
+        print 'Recorded %d events to %s' % (count, opts.stream)
+        return
+
+    work_dir = tempfile.mkdtemp(prefix='mkcdict-bench-')
+    cwd = os.getcwd()
+    os.chdir(os.path.abspath(work_dir))
+    if opts.stream:
+        opts.stream = os.path.join(cwd, opts.stream)
+
+    def get_replay_events(new_layout):
+        if opts.stream:
+            return load_events(opts.stream, new_layout)
+        return get_events(opts.events or 500000, new_layout)
+    try:
+        print '%-8s %-10s %12s %10s %12s' % ('layout', 'callbacks', 'events/s', 'speedup', 'memory MB')
+        rates = {}
+        for new_layout in [True, False]:
+            layout = 'new' if new_layout else 'old'
+            replay_events = get_replay_events(new_layout)
+            for mode in ['dispatch', 'bound']:
+                elapsed, growth = min(run_process(mode, opts.chunk_rows) for _ in xrange(opts.repeat))
+                rates[layout, mode] = len(replay_events) / elapsed
+                print '%-8s %-10s %12d %9.2fx %12.1f' % (layout, mode, rates[layout, mode],
+                                                         rates[layout, mode] / rates[layout, 'dispatch'],
+                                                         growth / 1000.0)
+        for new_layout in [True, False]:
+            layout = 'new' if new_layout else 'old'
+            replay_events = get_replay_events(new_layout)
+            print
+            print 'Cost per callback (%s layout, bound callbacks):' % (layout)
+            print_callback_costs(profile_callbacks(opts.chunk_rows))
+        if opts.target:
+            print
+            for layout in ['new', 'old']:
+                rate = rates[layout, 'bound']
+                print '%s layout: %d events/s %s target of %d events/s' % \
+                      (layout, rate, 'meets' if rate >= opts.target else 'is BELOW', opts.target)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(work_dir)
+
+if __name__ == '__main__':
+    main()
@@ -5,16 +5,15 @@
 #
 # This script reads a perf binary file (through perf script -s) and generates a cdict file
 # named perf.cdict.
-# The cdict file is a compressed json dump of a python dictionary that contains
-# a subset of the perf traces in a form that is ready to be loaded into a pandas dataframe.
+# The cdict file contains a subset of the perf traces stored as typed columns
+# (see perf_formatter.py) in a form that is ready to be loaded into a pandas dataframe.
 #
 # Functions in this script are also called from mkcdict.py when the python scripting of perf is not compiled in.
 #
 import os
 import sys
+import threading
 from os.path import expanduser
-import re
-import zlib
 
 # Location of the perf python helper files
 try:
@@ -23,6 +22,8 @@ try:
 except KeyError:
     pass
 sys.path.append(expanduser('~/perf-trace-lib'))
+# perf does not add the location of this script to the python path
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
 try:
     from perf_trace_context import *
@@ -30,14 +31,17 @@ try:
 except ImportError:
     pass
 
-try:
-    # try to use the faster version if available
-    from msgpack import packb
-except ImportError:
-    # else fall back to the pure python version (slower)
-    from umsgpack import packb
+# perf_formatter can only be imported once this folder is in the python path above
+from perf_formatter import CdictWriter  # noqa: E402
+from perf_formatter import CDICT_CHUNK_ROWS  # noqa: E402
+from perf_formatter import CDICT_SUMMARY_USECS  # noqa: E402
+from perf_formatter import decode_task  # noqa: E402
+from perf_formatter import load_task_snapshot  # noqa: E402
+from perf_formatter import read_task_snapshot  # noqa: E402
+from perf_formatter import save_task_cache  # noqa: E402
 
 # pandas dataframe friendly data structures
+# (only hold the rows of the current chunk)
 event_name_list = []
 cpu_list = []
 usecs_list = []
@@ -50,6 +54,34 @@ next_comm_list = []
 # a dict of task names indexed by tid
 name_by_tid = {}
 
+# the events only store the raw tid and comm, the final task names are resolved once
+# per tid at the end of the trace and stored in the cdict footer
+# a dict of raw comm indexed by tid
+comm_by_tid = {}
+
+# the plugin is initialized while the events are processed
+plugin_convert_name = None
+plugin_thread = None
+
+# the cdict file is written one chunk at a time while events are processed
+cdict_writer = None
+chunk_rows = CDICT_CHUNK_ROWS
+
+# Conversion options passed as name=value arguments after the perf script options
+# e.g. perf script -s mkcdict_perf_script.py -i perf.data codec=raw chunk_rows=100000 output=run1.cdict
+# tasks: file containing the task snapshot taken at the start of the capture (see perfcap.py)
+# summary_usecs: time granularity of the summary stored in the cdict file (0 = no summary)
+script_options = {'codec': 'zlib', 'chunk_rows': str(CDICT_CHUNK_ROWS), 'output': 'perf.cdict', 'tasks': '',
+                  'summary_usecs': str(CDICT_SUMMARY_USECS)}
+
+def parse_script_options(args):
+    for arg in args:
+        name, sep, value = arg.partition('=')
+        if sep and name in script_options:
+            script_options[name] = value
+        else:
+            print 'Ignoring invalid script argument: ' + arg
+
 # A dict of counts indexed by event name
 # counts how many are being ignored (not counted) in the cdict
 event_drops = {}
@@ -71,9 +103,43 @@ def count_event(event_name):
     except KeyError:
         event_counts[event_name] = 1
 
-def trace_begin():
+def flush_chunk():
+    comm_by_tid.update(zip(pid_list, comm_list))
+    comm_by_tid.update(zip(next_pid_list, next_comm_list))
+    cdict_writer.add_chunk({'event': event_name_list,
+                            'cpu': cpu_list,
+                            'usecs': usecs_list,
+                            'pid': pid_list,
+                            'task_name': comm_list,
+                            'duration': duration_list,
+                            'next_pid': next_pid_list,
+                            'next_comm': next_comm_list})
+    for col_list in [event_name_list, cpu_list, usecs_list, pid_list, comm_list,
+                     duration_list, next_pid_list, next_comm_list]:
+        del col_list[:]
+
+def trace_begin(args=None):
+    '''Called by perf before the first event
+    :param args: list of conversion options (defaults to the perf script arguments)
+    '''
+    global cdict_writer
+    global chunk_rows
+    global plugin_thread
+
+    parse_script_options(sys.argv[1:] if args is None else args)
+    chunk_rows = int(script_options['chunk_rows'])
+    cdict_writer = CdictWriter(script_options['output'], script_options['codec'],
+                               int(script_options['summary_usecs']))
+    if script_options['tasks']:
+        # resolve the task names from the snapshot instead of /proc
+        snapshot = read_task_snapshot(script_options['tasks'])
+        load_task_snapshot(snapshot)
+        cdict_writer.metadata['tasks'] = snapshot['tasks']
+    plugin_thread = threading.Thread(target=init_plugin)
+    plugin_thread.start()
+
+def init_plugin():
     global plugin_convert_name
-
     # try to import
     try:
         from mkcdict_plugin import plugin_init
@@ -83,6 +149,16 @@ def trace_begin():
     except (ImportError, ValueError, Exception):
         plugin_convert_name = None
 
+def resolve_task_names():
+    '''Resolve the final name of every tid seen in the trace
+    Only the names that differ from the raw comm are stored in the cdict
+    '''
+    for tid, comm in comm_by_tid.items():
+        if tid:
+            name = get_final_name(tid, comm)
+            if name != comm:
+                cdict_writer.task_names[tid] = name
+
 def trace_end():
     # report dropped kvm events
     print 'Dropped events (not stored in cdict file):'
@@ -93,59 +169,21 @@ def trace_end():
     for name in sorted(event_counts, key=event_counts.get, reverse=True):
         print '   %6d %s' % (event_counts[name], name)
     print
-    # build cdict
-    res = {'event': event_name_list,
-           'cpu': cpu_list,
-           'usecs': usecs_list,
-           'pid': pid_list,
-           'task_name': comm_list,
-           'duration': duration_list,
-           'next_pid': next_pid_list,
-           'next_comm': next_comm_list}
-    print 'End of trace, marshaling and compressing...'
-    compressed = zlib.compress(packb(res))
-    with open('perf.cdict', 'w') as ff:
-        ff.write(compressed)
-    print 'Compressed dictionary written to perf.cdict %d entries size=%d bytes' % \
-          (len(cpu_list), len(compressed))
-
-uuid_re = re.compile('-uuid ([a-fA-F0-9\-]*)')
-# /proc/pid/cpuset output
-# /machine/instance-000065d7.libvirt-qemu/emulator
-# /machine/instance-000065d3.libvirt-qemu/vcpu0
-cpuset_re = re.compile('/machine/(instance-[a-fA-F0-9]*).libvirt-qemu/(\w*)')
-
-def decode_cpuset(pid):
-    name = None
-    thread_type = None
+    print 'End of trace, writing last chunk...'
+    flush_chunk()
+    # the plugin is needed to resolve the task names
+    plugin_thread.join()
+    resolve_task_names()
     try:
-        with open('/proc/%d/cpuset' % (pid)) as f:
-            cpuset = f.read()
-            res = cpuset_re.match(cpuset)
-            if res:
-                name = res.group(1)
-                thread_type = res.group(2)
-    except IOError:
-        pass
-    return name, thread_type
-
-def decode_pid(pid):
-    name = None
-    uuid = None
-    thread_type = None
-    try:
-        with open('/proc/%d/cmdline' % (pid)) as f:
-            cmdline = f.read()
-            # this is a nul separated tokens
-            cmdline = cmdline.replace('\x00', ' ')
-            if cmdline.startswith('/usr/bin/qemu-system'):
-                res = uuid_re.search(cmdline)
-                if res:
-                    uuid = res.group(1)
-                    name, thread_type = decode_cpuset(pid)
-    except IOError:
+        # absolute time of the first event, allows to align the usecs of several captures
+        cdict_writer.metadata['epoch'] = epoch
+    except NameError:
+        # no event
         pass
-    return name, uuid, thread_type
+    size = cdict_writer.close()
+    save_task_cache()
+    print 'Dictionary written to %s %d entries %d chunks size=%d bytes (%s)' % \
+          (cdict_writer.cdict_file, cdict_writer.rows, len(cdict_writer.chunks), size, cdict_writer.codec)
 
 def get_final_name(tid, name):
     if not tid:
@@ -155,7 +193,7 @@ def get_final_name(tid, name):
     except KeyError:
         pass
     # check if it is a kvm thread from the look of the name
-    libvirt_name, uuid, thread_type = decode_pid(tid)
+    libvirt_name, uuid, thread_type = decode_task(tid)
     if libvirt_name:
         if plugin_convert_name:
             name = plugin_convert_name(name, tid, libvirt_name, uuid, thread_type)
@@ -179,12 +217,14 @@ def add_event(name, cpu, secs, nsecs, pid, comm, duration=0, next_pid=0, next_co
     cpu_list.append(cpu)
     usecs_list.append(get_usecs(secs, nsecs))
     pid_list.append(pid)
-    comm_list.append(get_final_name(pid, comm))
+    comm_list.append(comm)
     # duration in usec
     duration_list.append(duration / 1000)
     next_pid_list.append(next_pid)
-    next_comm_list.append(get_final_name(next_pid, next_comm))
+    next_comm_list.append(next_comm)
     count_event(name)
+    if len(cpu_list) >= chunk_rows:
+        flush_chunk()
 
 def add_kvm_event(name, cpu, secs, nsecs, pid, comm, prev_usecs, reason=None):
     usecs = get_usecs(secs, nsecs)
@@ -192,11 +232,13 @@ def add_kvm_event(name, cpu, secs, nsecs, pid, comm, prev_usecs, reason=None):
     cpu_list.append(cpu)
     usecs_list.append(usecs)
     pid_list.append(pid)
-    comm_list.append(get_final_name(pid, comm))
+    comm_list.append(comm)
     duration_list.append(usecs - prev_usecs)
     next_pid_list.append(None)
     next_comm_list.append(reason)
     count_event(name)
+    if len(cpu_list) >= chunk_rows:
+        flush_chunk()
     return usecs
 
 #
@@ -223,16 +265,39 @@ def add_kvm_event(name, cpu, secs, nsecs, pid, comm, prev_usecs, reason=None):
 # a None argument at position 8 (which is index 7 in the list) before calling the
 # target function
 #
+# The layout is the same for all the events of a trace, so it is only checked on
+# the first event: the public callbacks below are then rebound to their handler
+# (new layout) or to a thin adapter (old layout), perf looks up the callback by
+# name for every event and will call the rebound function from then on.
+#
+HANDLED_CALLBACKS = ['sched__sched_stat_sleep', 'sched__sched_stat_runtime', 'sched__sched_switch',
+                     'sched__sched_stat_iowait', 'kvm__kvm_entry', 'kvm__kvm_exit']
+
+def _old_layout_handler(target):
+    def handler(event_name, context, common_cpu, common_secs, common_nsecs, common_pid, common_comm, *fields):
+        target(event_name, context, common_cpu, common_secs, common_nsecs, common_pid, common_comm,
+               None, *fields)
+    return handler
+
+def install_callbacks(new_layout):
+    '''Bind the callbacks of all handled events for the given perf callback layout
+    :param new_layout: True if perf passes the common_callchain argument
+    '''
+    module_dict = globals()
+    for name in HANDLED_CALLBACKS:
+        target = module_dict['_' + name]
+        if new_layout:
+            module_dict[name] = target
+        else:
+            module_dict[name] = _old_layout_handler(target)
+
 def _dispatch(target, *args):
-    arg_count = target.__code__.co_argcount
-    if len(args) != arg_count:
-        largs = list(args)
-        largs.insert(7, None)
-        args = tuple(largs)
-        # note that any error case like arg list shorter than 7 or
-        # signature mismatch after insertion will result in a runtime error
-        # which is ok
-    target(*args)
+    # only called for the first handled event, detect the layout and install the callbacks
+    install_callbacks(len(args) == target.__code__.co_argcount)
+    # note that any error case like arg list shorter than 7 or
+    # signature mismatch after insertion will result in a runtime error
+    # which is ok
+    globals()[target.__name__[1:]](*args)
 
 def _sched__sched_stat_sleep(event_name, context, common_cpu,
                              common_secs, common_nsecs, common_pid, common_comm,
@@ -22,10 +22,13 @@
 # and store the resulting descriptive string in a dictionary indexed by the uuid
 #
 
+import atexit
 import credentials
+import json
 import os
 import re
-from novaclient.client import Client
+import threading
+import time
 
 # Config file to specify the OpenStack crendentials needed to connect to the controller
 # The file must contain the rc variable to point to the OpenStack credentials file
@@ -44,6 +47,18 @@ instance_re = re.compile('ESC_Day0-3__\d*__MT__MTPerftest.FULL.(\d*)ESC_Day0-31.
 # becomes 'CSR.01'
 by_uuid = {}
 
+# The names loaded from Nova are cached in a local file so that the conversion can start
+# without waiting for Nova (and work when the controller is not reachable):
+# {'time': time of the last refresh from Nova, 'by_uuid': dict of full names indexed by the uuid}
+# A cache older than NOVA_CACHE_TTL seconds is refreshed in the background with the
+# servers that changed since the last refresh
+NOVA_CACHE_FILE = os.path.expanduser('~/.cache/perfwhiz/nova.json')
+NOVA_CACHE_TTL = 3600
+# The background refresh is waited for at exit (at most NOVA_REFRESH_EXIT_TIMEOUT seconds)
+# so that it is not killed while saving the cache
+NOVA_REFRESH_EXIT_TIMEOUT = 10
+refresh_thread = None
+
 def decode_instance_name(name):
     m = instance_re.match(name)
     if m:
@@ -66,25 +81,124 @@ class OptionsHolder(object):
                         setattr(self, m.group(1), m.group(2))
 
 
-def plugin_init(opts=None):
+def get_nova_client(opts):
+    from novaclient.client import Client
     # Parse the credentials of the OpenStack cloud
     if not opts:
         opts = OptionsHolder()
     cred = credentials.Credentials(opts)
     creds_nova = cred.get_nova_credentials_v2()
-    # Create the nova and neutron instances
-    nova_client = Client(**creds_nova)
+    return Client(**creds_nova)
+
+def load_nova_cache():
+    '''Load the cached names
+    :return: the cache dict or None if there is no valid cache
+    '''
+    try:
+        with open(NOVA_CACHE_FILE, 'r') as ff:
+            cache = json.load(ff)
+        if isinstance(cache['by_uuid'], dict):
+            return cache
+    except (IOError, ValueError, KeyError, TypeError):
+        pass
+    return None
+
+def save_nova_cache(cache):
+    try:
+        folder = os.path.dirname(NOVA_CACHE_FILE)
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        tmp_file = '%s.%d' % (NOVA_CACHE_FILE, os.getpid())
+        try:
+            with open(tmp_file, 'w') as ff:
+                json.dump(cache, ff)
+            os.rename(tmp_file, NOVA_CACHE_FILE)
+        except (IOError, OSError):
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+            raise
+    except (IOError, OSError) as exc:
+        print 'Warning: cannot save the Nova name cache: ' + str(exc)
 
+def load_nova_names(nova_client, changes_since=None):
+    '''Load the service chain names from Nova
+    :param nova_client: a novaclient client (or any object with the same servers.list method)
+    :param changes_since: only load the servers that changed since that time (seconds since epoch)
+    :return: a dict of full names indexed by the uuid and the list of uuids that have no name
+             (deleted servers, which Nova only returns with changes_since, and renamed servers)
+    '''
     opts = {'all_tenants': 1}
+    if changes_since:
+        opts['changes-since'] = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(changes_since))
     servers = nova_client.servers.list(detailed=True, search_opts=opts)
-    count = 0
+    names = {}
+    removed = []
     for server in servers:
         chain_id, nvf = decode_instance_name(server.name)
-        if chain_id:
-            full_name = '%s.%02d' % (nvf, chain_id)
-            by_uuid[server.id] = full_name
-            count += 1
-    print 'Plugin loaded with %d service chain names from Nova' % (count)
+        if chain_id and getattr(server, 'status', None) != 'DELETED':
+            names[server.id] = '%s.%02d' % (nvf, chain_id)
+        else:
+            removed.append(server.id)
+    return names, removed
+
+def refresh_nova_cache(cache, opts, nova_client):
+    '''Update the cache with the servers that changed since the last refresh
+    Can run in a background thread, the names in the cache are kept if Nova cannot be reached
+    '''
+    try:
+        if nova_client is None:
+            nova_client = get_nova_client(opts)
+        refresh_time = time.time()
+        names, removed = load_nova_names(nova_client, cache['time'])
+    except Exception as exc:
+        print 'Warning: cannot refresh the Nova names, using cached names: ' + str(exc)
+        return
+    for uuid in removed:
+        if uuid in cache['by_uuid']:
+            del cache['by_uuid'][uuid]
+            by_uuid.pop(uuid, None)
+    cache['by_uuid'].update(names)
+    cache['time'] = refresh_time
+    by_uuid.update(names)
+    save_nova_cache(cache)
+
+def wait_nova_refresh(timeout=NOVA_REFRESH_EXIT_TIMEOUT):
+    '''Wait for the background refresh of the cache if it is still running
+    :param timeout: maximum time to wait in seconds
+    '''
+    if refresh_thread and refresh_thread.is_alive():
+        refresh_thread.join(timeout)
+        if refresh_thread.is_alive():
+            print 'Warning: Nova names refresh still running, cache not updated'
+
+def plugin_init(opts=None, nova_client=None):
+    '''Load the service chain names
+    Names are loaded from the cache file if there is one (and refreshed in the background if it has
+    expired), else from Nova
+    :param opts: options with the OpenStack credentials (defaults to the options in CFG_FILE)
+    :param nova_client: client to use instead of a novaclient client built from the credentials
+    '''
+    global refresh_thread
+    cache = load_nova_cache()
+    if cache:
+        by_uuid.update(cache['by_uuid'])
+        age = time.time() - cache['time']
+        print 'Plugin loaded with %d service chain names from cache (%d seconds old)' % (len(cache['by_uuid']), age)
+        if age > NOVA_CACHE_TTL:
+            # daemon thread: a conversion never waits for Nova, except at exit for a little while
+            refresh_thread = threading.Thread(target=refresh_nova_cache, args=(cache, opts, nova_client))
+            refresh_thread.daemon = True
+            refresh_thread.start()
+            atexit.register(wait_nova_refresh)
+        return True
+
+    if nova_client is None:
+        nova_client = get_nova_client(opts)
+    cache = {'time': time.time()}
+    cache['by_uuid'] = load_nova_names(nova_client)[0]
+    by_uuid.update(cache['by_uuid'])
+    save_nova_cache(cache)
+    print 'Plugin loaded with %d service chain names from Nova' % (len(cache['by_uuid']))
     return True
 
 def plugin_convert_name(name, tid, libvirt_name, uuid, thread_type):
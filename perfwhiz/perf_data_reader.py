@@ -0,0 +1,712 @@
+# Copyright 2015 Cisco Systems, Inc.  All rights reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+#
+# ---------------------------------------------------------
+#
+# A reader for perf.data files that decodes the sched and kvm tracepoint samples
+# without going through perf script and its python scripting extension.
+#
+# Only the parts of the perf.data file needed by the cdict conversion are decoded:
+# - the file header and the event attributes (sample layout)
+# - the tracing data feature section (format of each tracepoint)
+# - the sample records (one struct unpack per record for all the tracepoint fields)
+# - the comm records (task names)
+#
+# The samples are time ordered the same way perf does it (using the finished round records).
+# If numpy is available, the samples of every round are decoded in bulk into typed columns and
+# converted with vectorized equivalents of the mkcdict_perf_script callbacks (see BulkConverter),
+# else every sample is passed to the mkcdict_perf_script callbacks.
+#
+import heapq
+import mmap
+import re
+import struct
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+PERF_MAGIC = 'PERFILE2'
+# u64 magic, u64 size, u64 attr_size, 3 sections (u64 offset, u64 size), 256 bits of features
+FILE_HEADER = struct.Struct('<8sQQQQQQQQ4Q')
+SECTION = struct.Struct('<QQ')
+# perf_event_attr: u32 type, u32 size, u64 config, u64 sample_period, u64 sample_type
+EVENT_ATTR = struct.Struct('<IIQQQ')
+# perf_event_header: u32 type, u16 misc, u16 size
+EVENT_HEADER = struct.Struct('<IHH')
+U16 = struct.Struct('<H')
+U32 = struct.Struct('<I')
+I32 = struct.Struct('<i')
+U64 = struct.Struct('<Q')
+
+PERF_TYPE_TRACEPOINT = 2
+
+PERF_RECORD_COMM = 3
+PERF_RECORD_SAMPLE = 9
+PERF_RECORD_FINISHED_ROUND = 68
+
+HEADER_TRACING_DATA = 1
+
+PERF_SAMPLE_IP = 1 << 0
+PERF_SAMPLE_TID = 1 << 1
+PERF_SAMPLE_TIME = 1 << 2
+PERF_SAMPLE_ADDR = 1 << 3
+PERF_SAMPLE_READ = 1 << 4
+PERF_SAMPLE_CALLCHAIN = 1 << 5
+PERF_SAMPLE_ID = 1 << 6
+PERF_SAMPLE_CPU = 1 << 7
+PERF_SAMPLE_PERIOD = 1 << 8
+PERF_SAMPLE_STREAM_ID = 1 << 9
+PERF_SAMPLE_RAW = 1 << 10
+PERF_SAMPLE_IDENTIFIER = 1 << 16
+
+TRACING_MAGIC = '\027\010\104tracing'
+
+field_re = re.compile(r'field:(.*?);\s*offset:(\d+);\s*size:(\d+);\s*signed:(\d+);')
+# struct format characters indexed by size, for unsigned fields (signed fields use the lower case)
+INT_FORMATS = {1: 'B', 2: 'H', 4: 'I', 8: 'Q'}
+
+class TraceEventFormat(object):
+    '''The format of a tracepoint as described by its format file
+    Decodes all the non common fields of a raw tracepoint sample with 1 struct unpack
+    '''
+    def __init__(self, system, text):
+        self.system = system
+        self.name = None
+        self.id = None
+        # list of field names (not including the common fields) in format order
+        self.field_names = []
+        # indices of the fields that are strings
+        self.string_fields = []
+        # indices of the fields that are __data_loc strings
+        self.data_loc_fields = []
+        # (offset, size, signed, is string) indexed by field name (see get_column)
+        self.fields = {}
+        fields = []
+        for line in text.splitlines():
+            if line.startswith('name:'):
+                self.name = line[5:].strip()
+            elif line.startswith('ID:'):
+                self.id = int(line[3:])
+            else:
+                m = field_re.search(line)
+                if m:
+                    fields.append((m.group(1).strip(), int(m.group(2)), int(m.group(3)), m.group(4) == '1'))
+        self.full_name = '%s__%s' % (system, self.name)
+        fmt = '<'
+        pos = 0
+        for decl, offset, size, signed in fields:
+            name = decl.split()[-1]
+            if '[' in name:
+                name = name[:name.index('[')]
+            if name.startswith('common_'):
+                continue
+            index = len(self.field_names)
+            self.fields[name] = (offset, size, signed, decl.startswith('char') and '[' in decl)
+            if decl.startswith('__data_loc'):
+                code = 'I'
+                self.data_loc_fields.append(index)
+            elif '[' in decl or size not in INT_FORMATS:
+                code = '%ds' % (size)
+                if decl.startswith('char'):
+                    self.string_fields.append(index)
+            else:
+                code = INT_FORMATS[size]
+                if signed:
+                    code = code.lower()
+            if offset > pos:
+                fmt += '%dx' % (offset - pos)
+            fmt += code
+            pos = offset + size
+            self.field_names.append(name)
+        self.struct = struct.Struct(fmt)
+
+    def decode(self, data, offset):
+        '''Decode the fields of a raw sample
+        :param data: the buffer that contains the raw sample
+        :param offset: offset of the raw sample in data
+        :return: a list of field values in format order
+        '''
+        values = list(self.struct.unpack_from(data, offset))
+        for index in self.string_fields:
+            value = values[index]
+            end = value.find('\0')
+            if end >= 0:
+                values[index] = value[:end]
+        for index in self.data_loc_fields:
+            loc = values[index]
+            start = offset + (loc & 0xffff)
+            value = data[start:start + (loc >> 16)]
+            end = value.find('\0')
+            values[index] = value[:end] if end >= 0 else value
+        return values
+
+    def get_column(self, buf, raw_offsets, name):
+        '''Decode a field of a list of raw samples (requires numpy)
+        :param buf: the buffer that contains the raw samples as a numpy uint8 array
+        :param raw_offsets: numpy array of the offsets of the raw samples in buf
+        :param name: name of the field (integer or char array)
+        :return: a numpy array of the field values (an object array of strings for char arrays)
+        '''
+        offset, size, signed, is_string = self.fields[name]
+        if is_string:
+            values = gather(buf, raw_offsets + offset, 'S%d' % (size))
+            # the strings end at the first nul (the rest of the array is not always cleared)
+            uniques, inverse = np.unique(values, return_inverse=True)
+            strings = np.empty(len(uniques), dtype=object)
+            strings[:] = [value.split('\0', 1)[0] for value in uniques.tolist()]
+            return strings[inverse]
+        return gather(buf, raw_offsets + offset, '<%s%d' % ('i' if signed else 'u', size))
+
+def gather(buf, offsets, dtype):
+    '''Read a value at every offset of a buffer (requires numpy)
+    :param buf: numpy uint8 array
+    :param offsets: numpy array of offsets in buf
+    :param dtype: numpy dtype of the values
+    :return: a numpy array of the values
+    '''
+    dtype = np.dtype(dtype)
+    indices = offsets[:, None] + np.arange(dtype.itemsize)
+    return buf[indices].view(dtype).reshape(len(offsets))
+
+def parse_tracing_data(data, offset):
+    '''Parse the tracing data feature section
+    :param data: content of the perf.data file
+    :param offset: offset of the tracing data section
+    :return: a dict of TraceEventFormat indexed by tracepoint id
+    '''
+    if data[offset:offset + len(TRACING_MAGIC)] != TRACING_MAGIC:
+        raise ValueError('Invalid tracing data in perf data file')
+    offset += len(TRACING_MAGIC)
+    end = data.find('\0', offset)
+    offset = end + 1
+    big_endian = ord(data[offset])
+    if big_endian:
+        raise ValueError('Big endian perf data files are not supported')
+    # skip big endian flag, long size and page size
+    offset += 2 + 4
+    # header_page and header_event
+    for _ in range(2):
+        offset = data.find('\0', offset) + 1
+        size, = U64.unpack_from(data, offset)
+        offset += 8 + size
+    # ftrace formats
+    count, = U32.unpack_from(data, offset)
+    offset += 4
+    for _ in range(count):
+        size, = U64.unpack_from(data, offset)
+        offset += 8 + size
+    # event formats
+    formats = {}
+    systems, = U32.unpack_from(data, offset)
+    offset += 4
+    for _ in range(systems):
+        end = data.find('\0', offset)
+        system = data[offset:end]
+        offset = end + 1
+        count, = U32.unpack_from(data, offset)
+        offset += 4
+        for _ in range(count):
+            size, = U64.unpack_from(data, offset)
+            offset += 8
+            fmt = TraceEventFormat(system, data[offset:offset + size])
+            formats[fmt.id] = fmt
+            offset += size
+    return formats
+
+class PerfDataReader(object):
+    '''Read the tracepoint samples of a perf.data file'''
+    def __init__(self, perf_data_file):
+        with open(perf_data_file, 'rb') as ff:
+            self.data = mmap.mmap(ff.fileno(), 0, access=mmap.ACCESS_READ)
+        header = FILE_HEADER.unpack_from(self.data, 0)
+        if header[0] != PERF_MAGIC:
+            raise ValueError('Not a perf data file (or unsupported format): ' + perf_data_file)
+        attr_size = header[2]
+        attrs_offset, attrs_size = header[3], header[4]
+        self.data_offset, self.data_size = header[5], header[6]
+        features = header[9:]
+
+        sample_types = set()
+        for offset in range(attrs_offset, attrs_offset + attrs_size, attr_size):
+            attr_type, _, _, _, sample_type = EVENT_ATTR.unpack_from(self.data, offset)
+            if attr_type == PERF_TYPE_TRACEPOINT:
+                sample_types.add(sample_type)
+        if len(sample_types) != 1:
+            raise ValueError('perf data file must have tracepoint events with the same sample type')
+        self.sample_type = sample_types.pop()
+        self.set_sample_layout()
+
+        if not features[0] & (1 << HEADER_TRACING_DATA):
+            raise ValueError('perf data file has no tracing data')
+        # the feature sections are stored right after the data section, in feature bit order
+        # the tracing data section is preceded by the nop feature section (bit 0) if set
+        index = features[0] & 1
+        section_offset, _ = SECTION.unpack_from(self.data, self.data_offset + self.data_size + index * SECTION.size)
+        self.formats = parse_tracing_data(self.data, section_offset)
+        # task names indexed by tid
+        self.comm_by_tid = {0: 'swapper'}
+
+    def set_sample_layout(self):
+        '''Compute where the tid, time, cpu and raw data are in a sample record'''
+        sample_type = self.sample_type
+        if not sample_type & PERF_SAMPLE_RAW or not sample_type & PERF_SAMPLE_TIME:
+            raise ValueError('perf data file samples have no raw data or time')
+        if sample_type & PERF_SAMPLE_READ:
+            raise ValueError('perf data file samples with read values are not supported')
+        offset = EVENT_HEADER.size
+        self.cpu_offset = None
+        for flag in [PERF_SAMPLE_IDENTIFIER, PERF_SAMPLE_IP, PERF_SAMPLE_TID, PERF_SAMPLE_TIME,
+                     PERF_SAMPLE_ADDR, PERF_SAMPLE_ID, PERF_SAMPLE_STREAM_ID, PERF_SAMPLE_CPU,
+                     PERF_SAMPLE_PERIOD]:
+            if sample_type & flag:
+                if flag == PERF_SAMPLE_TIME:
+                    self.time_offset = offset
+                elif flag == PERF_SAMPLE_CPU:
+                    self.cpu_offset = offset
+                offset += 8
+        # offset of the callchain (if any) or raw data
+        self.var_offset = offset
+        self.has_callchain = sample_type & PERF_SAMPLE_CALLCHAIN
+
+    def get_comm(self, tid):
+        try:
+            return self.comm_by_tid[tid]
+        except KeyError:
+            # same default as perf
+            return ':%d' % (tid)
+
+    def read_samples(self):
+        '''Read all the tracepoint samples in time order
+        :return: a generator of (time, cpu, offset of raw data) tuples
+        '''
+        data = self.data
+        offset = self.data_offset
+        end = self.data_offset + self.data_size
+        # perf writes the per cpu buffers in rounds: all the samples that are older than
+        # the most recent sample of the previous round can be safely sorted and returned
+        queue = []
+        round_max_time = 0
+        flush_time = 0
+        seq = 0
+        while offset < end:
+            rec_type, _, size = EVENT_HEADER.unpack_from(data, offset)
+            if not size:
+                break
+            if rec_type == PERF_RECORD_SAMPLE:
+                time, = U64.unpack_from(data, offset + self.time_offset)
+                cpu = U32.unpack_from(data, offset + self.cpu_offset)[0] if self.cpu_offset else 0
+                raw_offset = offset + self.var_offset
+                if self.has_callchain:
+                    nr, = U64.unpack_from(data, raw_offset)
+                    raw_offset += 8 + nr * 8
+                # skip the raw data size
+                heapq.heappush(queue, (time, seq, cpu, raw_offset + 4))
+                seq += 1
+                if time > round_max_time:
+                    round_max_time = time
+            elif rec_type == PERF_RECORD_COMM:
+                _, tid = struct.unpack_from('<II', data, offset + EVENT_HEADER.size)
+                start = offset + EVENT_HEADER.size + 8
+                self.comm_by_tid[tid] = data[start:data.find('\0', start, offset + size)]
+            elif rec_type == PERF_RECORD_FINISHED_ROUND:
+                while queue and queue[0][0] <= flush_time:
+                    time, _, cpu, raw_offset = heapq.heappop(queue)
+                    yield time, cpu, raw_offset
+                flush_time = round_max_time
+            offset += size
+        while queue:
+            time, _, cpu, raw_offset = heapq.heappop(queue)
+            yield time, cpu, raw_offset
+
+    def read_sample_rounds(self):
+        '''Read all the tracepoint samples in time order, one round at a time (requires numpy)
+        Same order as read_samples, the comm records are processed up to the end of each round
+        :return: a generator of numpy arrays of the offsets of the sample records
+        '''
+        data = self.data
+        buf = np.frombuffer(data, dtype=np.uint8)
+        offset = self.data_offset
+        end = self.data_offset + self.data_size
+        unpack_header = EVENT_HEADER.unpack_from
+        # samples read since the last round (not yet sorted)
+        new_offsets = []
+        # samples read but not yet returned and their time
+        pending = np.empty(0, dtype=np.int64)
+        pending_times = np.empty(0, dtype=np.int64)
+        round_max_time = 0
+        flush_time = 0
+        while True:
+            rec_type = None
+            if offset < end:
+                rec_type, _, size = unpack_header(data, offset)
+                if not size:
+                    offset = end
+                    rec_type = None
+            if rec_type == PERF_RECORD_SAMPLE:
+                new_offsets.append(offset)
+            elif rec_type == PERF_RECORD_COMM:
+                _, tid = struct.unpack_from('<II', data, offset + EVENT_HEADER.size)
+                start = offset + EVENT_HEADER.size + 8
+                self.comm_by_tid[tid] = data[start:data.find('\0', start, offset + size)]
+            elif rec_type == PERF_RECORD_FINISHED_ROUND or rec_type is None:
+                if new_offsets:
+                    offsets = np.array(new_offsets, dtype=np.int64)
+                    del new_offsets[:]
+                    times = gather(buf, offsets + self.time_offset, '<u8').astype(np.int64)
+                    round_max_time = max(round_max_time, int(times.max()))
+                    pending = np.concatenate([pending, offsets])
+                    pending_times = np.concatenate([pending_times, times])
+                if rec_type is None:
+                    # end of data: all the remaining samples
+                    flush_time = round_max_time
+                ready = pending_times <= flush_time
+                if ready.any():
+                    # stable sort: same order as the (time, sequence) heap of read_samples
+                    order = np.argsort(pending_times[ready], kind='mergesort')
+                    yield pending[ready][order]
+                    pending = pending[~ready]
+                    pending_times = pending_times[~ready]
+                if rec_type is None:
+                    break
+                flush_time = round_max_time
+            offset += size
+
+    def get_raw_offsets(self, buf, offsets):
+        '''Get the offsets of the raw data of a list of sample records (requires numpy)
+        :param buf: the perf data as a numpy uint8 array
+        :param offsets: numpy array of sample record offsets
+        :return: a numpy array of raw data offsets
+        '''
+        raw_offsets = offsets + self.var_offset
+        if self.has_callchain:
+            raw_offsets += 8 + gather(buf, raw_offsets, '<u8').astype(np.int64) * 8
+        # skip the raw data size
+        return raw_offsets + 4
+
+    def read_events(self):
+        '''Read and decode all the tracepoint samples in time order
+        :return: a generator of (TraceEventFormat, cpu, secs, nsecs, tid, raw offset) tuples
+            use the format decode method to decode the fields
+        '''
+        formats = self.formats
+        data = self.data
+        for time, cpu, raw_offset in self.read_samples():
+            # all raw tracepoint samples start with the common fields:
+            # u16 common_type (tracepoint id), u8 common_flags, u8 common_preempt_count, s32 common_pid
+            event_id, = U16.unpack_from(data, raw_offset)
+            tid, = I32.unpack_from(data, raw_offset + 4)
+            yield formats[event_id], cpu, time // 1000000000, time % 1000000000, tid, raw_offset
+
+class BulkConverter(object):
+    '''Convert the samples of a perf data file with numpy, one round of samples at a time
+    The sample fields are decoded in bulk into typed columns and the events are generated with
+    vectorized equivalents of the mkcdict_perf_script callbacks, the converter state (epoch,
+    runtime per cpu, kvm times, event counts, comm per tid) is shared with mkcdict_perf_script
+    so that the cdict file is the same as the one generated by the callbacks.
+    '''
+    # columns of the generated events
+    COLUMNS = ['event', 'cpu', 'usecs', 'pid', 'task_name', 'duration', 'next_pid', 'next_comm']
+
+    def __init__(self, reader, script):
+        self.reader = reader
+        self.script = script
+        self.buf = np.frombuffer(reader.data, dtype=np.uint8)
+        # pieces of the generated columns not yet written indexed by column name
+        self.pieces = dict((name, []) for name in self.COLUMNS)
+        self.rows = 0
+
+    def convert(self):
+        for offsets in self.reader.read_sample_rounds():
+            self.convert_samples(offsets)
+        self.write_chunks(True)
+
+    def convert_samples(self, offsets):
+        '''Convert a list of samples in time order
+        :param offsets: numpy array of the offsets of the sample records
+        '''
+        reader = self.reader
+        buf = self.buf
+        raw_offsets = reader.get_raw_offsets(buf, offsets)
+        times = gather(buf, offsets + reader.time_offset, '<u8').astype(np.int64)
+        if reader.cpu_offset:
+            cpus = gather(buf, offsets + reader.cpu_offset, '<u4').astype(np.int64)
+        else:
+            cpus = np.zeros(len(offsets), dtype=np.int64)
+        event_ids = gather(buf, raw_offsets, '<u2')
+        # samples (indices in time order) of every tracepoint name
+        samples = {}
+        for event_id in np.unique(event_ids).tolist():
+            fmt = reader.formats[event_id]
+            indices = np.flatnonzero(event_ids == event_id)
+            if fmt.full_name in self.script.HANDLED_CALLBACKS:
+                samples[fmt.full_name] = (fmt, indices)
+            else:
+                self.script.event_drops[fmt.full_name] = \
+                    self.script.event_drops.get(fmt.full_name, 0) + len(indices)
+        # list of (sample indices, columns dict) of the generated events
+        events = []
+        switches = self.get_switch_events(samples, cpus, raw_offsets)
+        for name in ['sched__sched_stat_sleep', 'sched__sched_stat_iowait']:
+            if name in samples:
+                fmt, indices = samples[name]
+                fields = raw_offsets[indices]
+                events.append((indices, {'event': name,
+                                         'pid': fmt.get_column(buf, fields, 'pid'),
+                                         'task_name': fmt.get_column(buf, fields, 'comm'),
+                                         'duration': fmt.get_column(buf, fields, 'delay').astype(np.int64) // 1000,
+                                         'next_pid': 0,
+                                         'next_comm': None}))
+        if switches:
+            events.append(switches)
+        kvm_indices = [samples[name][1] for name in ['kvm__kvm_entry', 'kvm__kvm_exit'] if name in samples]
+        self.set_epoch(times, [event_indices for event_indices, _ in events] + kvm_indices)
+        usecs = times // 1000 - self.script.epoch if kvm_indices or events else None
+        events.extend(self.get_kvm_events(samples, usecs, raw_offsets))
+        if not events:
+            return
+        # all the events in time order
+        indices = np.concatenate([event_indices for event_indices, _ in events])
+        order = np.argsort(indices, kind='mergesort')
+        indices = indices[order]
+        self.add_column('cpu', cpus[indices])
+        self.add_column('usecs', usecs[indices])
+        for name in ['event', 'pid', 'task_name', 'duration', 'next_pid', 'next_comm']:
+            pieces = []
+            for event_indices, columns in events:
+                values = columns[name]
+                if not isinstance(values, np.ndarray):
+                    # same value for all the events
+                    values = np.array([values] * len(event_indices), dtype=object)
+                pieces.append(values.astype(object) if name in ['event', 'task_name', 'next_comm'] else
+                              values.astype(np.int64))
+            self.add_column(name, np.concatenate(pieces)[order])
+        for event_indices, columns in events:
+            event = columns['event']
+            if isinstance(event, np.ndarray):
+                for name, count in zip(*np.unique(event, return_counts=True)):
+                    self.count_event(name, count)
+            else:
+                self.count_event(event, len(event_indices))
+        self.rows += len(indices)
+        self.write_chunks()
+
+    def count_event(self, name, count):
+        event_counts = self.script.event_counts
+        event_counts[name] = event_counts.get(name, 0) + int(count)
+
+    def set_epoch(self, times, event_indices):
+        '''Set the epoch of the converter (time of the first event that has a usecs value)'''
+        try:
+            self.script.epoch
+        except AttributeError:
+            firsts = [indices[0] for indices in event_indices if len(indices)]
+            if firsts:
+                self.script.epoch = int(times[min(firsts)]) // 1000
+
+    def get_switch_events(self, samples, cpus, raw_offsets):
+        '''Generate the sched switch events
+        The duration of a switch is the runtime accumulated on its cpu since the previous switch
+        (switches are only generated after the first switch of every cpu)
+        :return: a tuple of the sample indices and the columns of the events or None
+        '''
+        if 'sched__sched_switch' not in samples:
+            # only accumulate the runtime of the cpus that had a switch
+            if 'sched__sched_stat_runtime' in samples:
+                fmt, indices = samples['sched__sched_stat_runtime']
+                runtimes = fmt.get_column(self.buf, raw_offsets[indices], 'runtime').astype(np.int64)
+                runtime_by_cpu = self.script.runtime_by_cpu
+                for cpu, runtime in zip(cpus[indices].tolist(), runtimes.tolist()):
+                    if cpu in runtime_by_cpu:
+                        runtime_by_cpu[cpu] += runtime
+            return None
+        sw_fmt, sw_indices = samples['sched__sched_switch']
+        if 'sched__sched_stat_runtime' in samples:
+            rt_fmt, rt_indices = samples['sched__sched_stat_runtime']
+            runtimes = rt_fmt.get_column(self.buf, raw_offsets[rt_indices], 'runtime').astype(np.int64)
+        else:
+            rt_indices = np.empty(0, dtype=np.int64)
+            runtimes = np.empty(0, dtype=np.int64)
+        # switches (runtime 0) and runtimes of every cpu in time order
+        indices = np.concatenate([sw_indices, rt_indices])
+        values = np.concatenate([np.zeros(len(sw_indices), dtype=np.int64), runtimes])
+        is_switch = np.concatenate([np.ones(len(sw_indices), dtype=bool), np.zeros(len(rt_indices), dtype=bool)])
+        order = np.lexsort((indices, cpus[indices]))
+        indices = indices[order]
+        values = values[order]
+        is_switch = is_switch[order]
+        group_cpus, starts = np.unique(cpus[indices], return_index=True)
+        runtime_by_cpu = self.script.runtime_by_cpu
+        emitted = []
+        durations = []
+        for cpu, start, stop in zip(group_cpus.tolist(), starts.tolist(), starts[1:].tolist() + [len(indices)]):
+            # runtime accumulated on this cpu before each event (including the runtime of that event)
+            cumsum = np.cumsum(values[start:stop])
+            switch_pos = np.flatnonzero(is_switch[start:stop])
+            if not len(switch_pos):
+                if cpu in runtime_by_cpu:
+                    runtime_by_cpu[cpu] += int(cumsum[-1])
+                continue
+            switch_runtimes = np.diff(cumsum[switch_pos])
+            switch_indices = indices[start + switch_pos[1:]]
+            if cpu in runtime_by_cpu:
+                switch_runtimes = np.concatenate([[runtime_by_cpu[cpu] + cumsum[switch_pos[0]]], switch_runtimes])
+                switch_indices = indices[start + switch_pos]
+            emitted.append(switch_indices)
+            durations.append(switch_runtimes)
+            runtime_by_cpu[cpu] = int(cumsum[-1] - cumsum[switch_pos[-1]])
+        if not emitted:
+            return None
+        indices = np.concatenate(emitted)
+        order = np.argsort(indices)
+        indices = indices[order]
+        raw = raw_offsets[indices]
+        return (indices, {'event': 'sched__sched_switch',
+                          'pid': sw_fmt.get_column(self.buf, raw, 'prev_pid'),
+                          'task_name': sw_fmt.get_column(self.buf, raw, 'prev_comm'),
+                          'duration': np.concatenate(durations)[order] // 1000,
+                          'next_pid': sw_fmt.get_column(self.buf, raw, 'next_pid'),
+                          'next_comm': sw_fmt.get_column(self.buf, raw, 'next_comm')})
+
+    def get_kvm_events(self, samples, usecs, raw_offsets):
+        '''Generate the kvm entry and exit events
+        The duration of an entry is the time since the previous exit of the same task (and vice versa),
+        the events of a task are only generated after its first exit (or entry)
+        :return: a list of tuples of the sample indices and the columns of the events
+        '''
+        pieces = []
+        for name in ['kvm__kvm_entry', 'kvm__kvm_exit']:
+            if name in samples:
+                fmt, indices = samples[name]
+                pieces.append((name == 'kvm__kvm_exit', fmt, indices))
+        if not pieces:
+            return []
+        indices = np.concatenate([event_indices for _, _, event_indices in pieces])
+        is_exit = np.concatenate([np.full(len(event_indices), is_exit_event, dtype=bool)
+                                  for is_exit_event, _, event_indices in pieces])
+        reasons = np.concatenate([piece_fmt.get_column(self.buf, raw_offsets[event_indices], 'exit_reason')
+                                  if is_exit_event else np.zeros(len(event_indices), dtype=np.uint32)
+                                  for is_exit_event, piece_fmt, event_indices in pieces])
+        tids = gather(self.buf, raw_offsets[indices] + 4, '<i4').astype(np.int64)
+        order = np.lexsort((indices, tids))
+        indices = indices[order]
+        is_exit = is_exit[order]
+        reasons = reasons[order]
+        tids = tids[order]
+        group_tids, starts = np.unique(tids, return_index=True)
+        kvm_time_dict = self.script.kvm_time_dict
+        emitted = []
+        durations = []
+        comms = []
+        for tid, start, stop in zip(group_tids.tolist(), starts.tolist(), starts[1:].tolist() + [len(indices)]):
+            try:
+                kt = kvm_time_dict[tid]
+            except KeyError:
+                kt = self.script.KvmTime(tid)
+                kvm_time_dict[tid] = kt
+            task_usecs = usecs[indices[start:stop]]
+            task_exits = is_exit[start:stop]
+            positions = np.arange(stop - start)
+            # usecs of the last entry and of the last exit before every event of the task
+            last_usecs = []
+            for is_exit_event, last_usec in [(False, kt.entry_time), (True, kt.exit_time)]:
+                last_pos = np.maximum.accumulate(np.where(task_exits == is_exit_event, positions, -1))
+                last_pos = np.concatenate([[-1], last_pos[:-1]])
+                last_usecs.append(np.where(last_pos >= 0, task_usecs[np.maximum(last_pos, 0)], last_usec))
+            # an entry follows the last exit, an exit follows the last entry (0 = none)
+            prev_usecs = np.where(task_exits, last_usecs[0], last_usecs[1])
+            selected = np.flatnonzero(prev_usecs != 0)
+            emitted.append(start + selected)
+            durations.append(task_usecs[selected] - prev_usecs[selected])
+            comms.append(np.array([self.reader.get_comm(tid)] * len(selected), dtype=object))
+            for is_exit_event in [False, True]:
+                task_pos = np.flatnonzero(task_exits == is_exit_event)
+                if len(task_pos):
+                    if is_exit_event:
+                        kt.exit_time = int(task_usecs[task_pos[-1]])
+                    else:
+                        kt.entry_time = int(task_usecs[task_pos[-1]])
+        selected = np.concatenate(emitted)
+        exits = is_exit[selected]
+        next_comms = np.empty(len(selected), dtype=object)
+        next_comms[exits] = reasons[selected][exits].tolist()
+        events = np.where(exits, 'kvm_exit', 'kvm_entry').astype(object)
+        return [(indices[selected], {'event': events,
+                                     'pid': tids[selected],
+                                     'task_name': np.concatenate(comms),
+                                     'duration': np.concatenate(durations),
+                                     'next_pid': 0,
+                                     'next_comm': next_comms})]
+
+    def add_column(self, name, values):
+        self.pieces[name].append(values)
+
+    def write_chunks(self, last=False):
+        '''Write the generated events by chunks of chunk_rows rows
+        :param last: True to also write the last partial chunk
+        '''
+        script = self.script
+        if self.rows < script.chunk_rows and not (last and self.rows):
+            return
+        columns = dict((name, np.concatenate(pieces)) for name, pieces in self.pieces.items())
+        start = 0
+        while self.rows - start >= script.chunk_rows or (last and start < self.rows):
+            stop = min(start + script.chunk_rows, self.rows)
+            chunk = dict((name, values[start:stop]) for name, values in columns.items())
+            script.comm_by_tid.update(zip(chunk['pid'].tolist(), chunk['task_name'].tolist()))
+            script.comm_by_tid.update(zip(chunk['next_pid'].tolist(), chunk['next_comm'].tolist()))
+            script.cdict_writer.add_chunk(chunk)
+            start = stop
+        self.pieces = dict((name, [values[start:]]) for name, values in columns.items())
+        self.rows -= start
+
+def convert(perf_data_file, args=None, bulk=True):
+    '''Convert a perf.data file into a perf.cdict file without perf script
+    The samples are converted in bulk if numpy is available, else the mkcdict_perf_script
+    callbacks are called directly with the decoded fields of every sample
+    :param perf_data_file: perf.data file name
+    :param args: list of conversion options (name=value) for mkcdict_perf_script
+    :param bulk: False to always call the callbacks
+    '''
+    import mkcdict_perf_script as script
+
+    reader = PerfDataReader(perf_data_file)
+    script.trace_begin(args or [])
+    if bulk and np is not None:
+        BulkConverter(reader, script).convert()
+        script.trace_end()
+        return
+    # the callback of each tracepoint and the number of fields it takes
+    # (the new perf callback layout is used)
+    handlers = {}
+    for event_id, fmt in reader.formats.items():
+        handler = getattr(script, '_' + fmt.full_name, None)
+        if handler:
+            nb_fields = handler.__code__.co_argcount - 8
+        else:
+            handler = getattr(script, fmt.full_name, None)
+            nb_fields = len(fmt.field_names)
+        handlers[event_id] = (handler, nb_fields)
+    data = reader.data
+    get_comm = reader.get_comm
+    drop_event = script.drop_event
+    for fmt, cpu, secs, nsecs, tid, raw_offset in reader.read_events():
+        handler, nb_fields = handlers[fmt.id]
+        if handler:
+            fields = fmt.decode(data, raw_offset)
+            handler(fmt.full_name, None, cpu, secs, nsecs, tid, get_comm(tid), None, *fields[:nb_fields])
+        else:
+            drop_event(fmt.full_name)
+    script.trace_end()
@@ -15,10 +15,15 @@
 
 # Common functions across capture and map functions
 
+import array
 import csv
+import hashlib
 import marshal
+import mmap
 import os
 import re
+import struct
+import sys
 import zlib
 try:
     # try to use the faster version if available
@@ -28,6 +33,13 @@ except ImportError:
     # else fall back to the pure python version (slower)
     from umsgpack import packb
     from umsgpack import unpackb
+try:
+    # numpy and pandas are only available on the analysis side (perfmap)
+    import numpy as np
+    import pandas
+except ImportError:
+    np = None
+    pandas = None
 
 # a dict of task names indexed by tid
 name_by_tid = {}
@@ -83,6 +95,180 @@ def decode_pid(pid):
         pass
     return name, uuid, thread_type
 
+# Persistent cache of the /proc information of the qemu threads (see decode_pid) shared by all captures,
+# allows to resolve qemu threads that have exited since the capture and to skip reading /proc for known tasks
+# The cache is only valid for the current boot, a tid can be reused so every entry also stores the
+# start time of the task (in clock ticks since boot):
+#   'boot_id': boot id of the kernel
+#   'tasks': dict of [start time, libvirt name, uuid, thread type] indexed by tid
+TASK_CACHE_FILE = os.path.expanduser('~/.cache/perfwhiz/tasks')
+# maximum number of tasks kept in the cache file (the most recently started are kept)
+TASK_CACHE_MAX_TASKS = 4096
+task_cache = None
+task_cache_updated = False
+
+# Snapshot of the tasks taken at the start of the capture (see snapshot_tasks)
+# qemu threads information indexed by tid (same entries as the task cache)
+snapshot_qemu_tasks = {}
+# tids of all the other tasks
+snapshot_other_tids = set()
+# time of the snapshot in clock ticks since boot (None = no snapshot)
+snapshot_time = None
+
+def get_boot_id():
+    try:
+        with open('/proc/sys/kernel/random/boot_id') as f:
+            return f.read().strip()
+    except IOError:
+        return None
+
+def get_start_time(tid):
+    '''Get the start time of a task
+    :param tid: task id
+    :return: the start time in clock ticks since boot or None if the task does not exist
+    '''
+    try:
+        with open('/proc/%d/stat' % (tid)) as f:
+            stat = f.read()
+    except IOError:
+        return None
+    # the task name can contain spaces and parentheses, the start time is the 22nd field
+    return int(stat[stat.rfind(')') + 2:].split()[19])
+
+def get_uptime():
+    '''Get the time since boot in clock ticks (same unit as the task start times)'''
+    with open('/proc/uptime') as f:
+        return int(float(f.read().split()[0]) * os.sysconf('SC_CLK_TCK'))
+
+def load_task_cache():
+    global task_cache
+    boot_id = get_boot_id()
+    try:
+        with open(TASK_CACHE_FILE, 'rb') as ff:
+            cache = unpackb(ff.read())
+        if cache['boot_id'] == boot_id:
+            task_cache = cache['tasks']
+            return
+    except Exception:
+        # missing or invalid cache file
+        pass
+    task_cache = {}
+
+def save_task_cache():
+    '''Save the task cache if it has new entries'''
+    global task_cache_updated
+    if not task_cache_updated:
+        return
+    try:
+        folder = os.path.dirname(TASK_CACHE_FILE)
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        tasks = task_cache
+        if len(tasks) > TASK_CACHE_MAX_TASKS:
+            tids = sorted(tasks, key=lambda tid: tasks[tid][0])[-TASK_CACHE_MAX_TASKS:]
+            tasks = dict((tid, tasks[tid]) for tid in tids)
+        # concurrent captures can update the cache, the last one wins
+        tmp_file = '%s.%d' % (TASK_CACHE_FILE, os.getpid())
+        with open(tmp_file, 'wb') as ff:
+            ff.write(packb({'boot_id': get_boot_id(), 'tasks': tasks}))
+        os.rename(tmp_file, TASK_CACHE_FILE)
+        task_cache_updated = False
+    except (IOError, OSError) as exc:
+        print 'Warning: cannot save the task cache: ' + str(exc)
+
+def snapshot_tasks():
+    '''Take a snapshot of the /proc information of all the running tasks
+    Only the threads of the qemu processes are decoded
+    :return: a snapshot dict:
+        'tasks': dict of [start time, libvirt name, uuid, thread type] indexed by tid for the qemu threads
+        'others': list of the tids of all the other tasks
+        'time': time of the snapshot in clock ticks since boot
+    '''
+    tasks = {}
+    others = []
+    snapshot_time = get_uptime()
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit():
+            continue
+        pid = int(pid)
+        _, uuid, _ = decode_pid(pid)
+        try:
+            tids = [int(tid) for tid in os.listdir('/proc/%d/task' % (pid))]
+        except OSError:
+            # process has exited
+            continue
+        if not uuid:
+            others.extend(tids)
+            continue
+        for tid in tids:
+            start_time = get_start_time(tid)
+            if start_time is not None:
+                libvirt_name, thread_type = decode_cpuset(tid)
+                tasks[tid] = [start_time, libvirt_name, uuid, thread_type]
+    return {'tasks': tasks, 'others': others, 'time': snapshot_time}
+
+def write_task_snapshot(snapshot_file, snapshot):
+    with open(snapshot_file, 'wb') as ff:
+        ff.write(packb(snapshot))
+
+def read_task_snapshot(snapshot_file):
+    with open(snapshot_file, 'rb') as ff:
+        return unpackb(ff.read())
+
+def load_task_snapshot(snapshot):
+    '''Resolve the tasks from a snapshot before looking at the task cache or /proc
+    :param snapshot: a snapshot dict (see snapshot_tasks)
+    '''
+    global task_cache_updated
+    global snapshot_time
+    if task_cache is None:
+        load_task_cache()
+    snapshot_qemu_tasks.update(snapshot['tasks'])
+    snapshot_other_tids.update(snapshot['others'])
+    # snapshots taken by older versions have no time
+    snapshot_time = snapshot.get('time')
+    # keep the qemu threads in the task cache for future captures
+    task_cache.update(snapshot['tasks'])
+    task_cache_updated = True
+
+def decode_task(tid):
+    '''Get the /proc information of a task using the task snapshot and the persistent task cache
+    :param tid: task id
+    :return: libvirt name, uuid, thread type (all None if not a qemu thread or unknown)
+    '''
+    global task_cache_updated
+    try:
+        return tuple(snapshot_qemu_tasks[tid][1:])
+    except KeyError:
+        pass
+    if tid in snapshot_other_tids:
+        return None, None, None
+    if task_cache is None:
+        load_task_cache()
+    start_time = get_start_time(tid)
+    entry = task_cache.get(tid)
+    if entry:
+        if start_time is not None:
+            if entry[0] == start_time:
+                return tuple(entry[1:])
+        elif snapshot_time is not None and entry[0] >= snapshot_time:
+            # a task that has exited can only be resolved from the cache, the entry can
+            # only be trusted if the task started during the capture: a task started before
+            # would be in the snapshot, so the entry belongs to a previous task with the same tid
+            return tuple(entry[1:])
+    if start_time is None:
+        return None, None, None
+    if entry:
+        # the tid has been reused
+        del task_cache[tid]
+        task_cache_updated = True
+    info = decode_pid(tid)
+    if info[1]:
+        # only the qemu threads are cached
+        task_cache[tid] = [start_time] + list(info)
+        task_cache_updated = True
+    return info
+
 def get_task_name(tid, name):
     if not tid:
         return name
@@ -91,7 +277,7 @@ def get_task_name(tid, name):
     except KeyError:
         pass
     # check if it is a kvm thread from the look of the name
-    libvirt_name, uuid, thread_type = decode_pid(tid)
+    libvirt_name, uuid, thread_type = decode_task(tid)
     if libvirt_name:
         if plugin_convert_name:
             name = plugin_convert_name(name, tid, libvirt_name, uuid, thread_type)
@@ -102,78 +288,1081 @@ def get_task_name(tid, name):
 
 # cdict management functions
 
-def remap(perf_dict, csv_map):
-    '''Remap all the task names in the cdict file with those specified in the mapping file
-    :param perf_dict: an uncompressed dictionary
+def read_task_map(csv_map):
+    '''Read a task name mapping file
     :param csv_map: csv mapping file name
+    :return: a mapping dict of task names indexed by the tid
     '''
-    # a mapping dict of task names indexed by the tid
-    map_dict = {}
-    print 'Remapping task names...'
+    task_map = {}
     with open(csv_map, 'r') as ff:
         # 19236,instance-000019f4,emulator,8f81e3a1-3ebd-4015-bbee-e291f0672d02,FULL,5,CSR
         reader = csv.DictReader(ff, fieldnames=['tid', 'libvirt_id', 'thread_type', 'uuid', 'chain_type',
                                                 'chain_id', 'nvf_name'])
         for row in reader:
             task_name = '%s.%02d.%s' % (row['nvf_name'], int(row['chain_id']), row['thread_type'])
-            map_dict[int(row['tid'])] = task_name
-    pids = perf_dict['pid']
-    names = perf_dict['task_name']
-    next_pids = perf_dict['next_pid']
-    next_comms = perf_dict['next_comm']
+            task_map[int(row['tid'])] = task_name
+    return task_map
+
+def map_task_names(pids, names, task_map):
+    '''Replace the task names of all the rows that have a pid in a mapping dict
+    Each distinct pid is only looked up once and the new names are then assigned to
+    all the matching rows in bulk
+    :param pids: column of pids
+    :param names: column of task names (list, numpy array or pandas categorical)
+    :param task_map: a mapping dict of task names indexed by the tid
+    :return: the new column of task names (same type as names), number of names replaced
+    '''
+    if np is None:
+        names = list(names)
+        count = 0
+        for index, pid in enumerate(pids):
+            try:
+                names[index] = task_map[pid]
+                count += 1
+            except KeyError:
+                pass
+        return names, count
+    unique_pids, inverse = np.unique(np.asarray(pids), return_inverse=True)
+    unique_names = [task_map.get(pid) for pid in unique_pids.tolist()]
+    mapped = np.array([name is not None for name in unique_names], dtype=bool)
+    rows = mapped[inverse]
+    count = int(np.count_nonzero(rows))
+    if not count:
+        return names, 0
+    inverse = inverse[rows]
+    if pandas is not None and isinstance(names, pandas.Categorical):
+        # only the codes of the mapped rows change, new names are added as categories
+        categories = names.categories.tolist()
+        code_by_name = dict((name, code) for code, name in enumerate(categories))
+        unique_codes = np.full(len(unique_names), -1, dtype=np.int32)
+        for index, name in enumerate(unique_names):
+            if name is not None:
+                if name not in code_by_name:
+                    code_by_name[name] = len(categories)
+                    categories.append(name)
+                unique_codes[index] = code_by_name[name]
+        codes = names.codes.astype(np.int32)
+        codes[rows] = unique_codes[inverse]
+        return pandas.Categorical.from_codes(codes, categories), count
+    values = np.empty(len(unique_names), dtype=object)
+    values[:] = unique_names
+    # always copy as the column can be backed by a read only buffer
+    names = np.array(names, dtype=object)
+    names[rows] = values[inverse]
+    return names, count
+
+def apply_task_map(perf_dict, task_map):
+    '''Rename the tasks of a decoded cdict using a mapping dict
+    :param perf_dict: an uncompressed dictionary (updated)
+    :param task_map: a mapping dict of task names indexed by the tid
+    :return: the number of names replaced
+    '''
     count = 0
-    for index in xrange(len(pids)):
+    for pid_name, name_name in [('pid', 'task_name'), ('next_pid', 'next_comm')]:
+        if pid_name in perf_dict:
+            perf_dict[name_name], mapped = map_task_names(perf_dict[pid_name], perf_dict[name_name], task_map)
+            count += mapped
+    return count
+
+def remap(perf_dict, csv_map):
+    '''Remap all the task names in the cdict file with those specified in the mapping file
+    :param perf_dict: an uncompressed dictionary (updated)
+    :param csv_map: csv mapping file name
+    '''
+    print 'Remapping task names...'
+    print 'Remapped %d task names' % (apply_task_map(perf_dict, read_task_map(csv_map)))
+
+# cdict v2 format
+#
+# A v1 cdict file is the zlib compressed msgpack (or marshal) dump of a dict of lists.
+# A v2 cdict file stores the rows in chunks where every column is a typed little endian
+# buffer, with string columns dictionary encoded (uint32 codes into a table of unique values):
+#
+#   magic (8 bytes)
+#   chunk 0..N-1, each starting on an 8 byte boundary:
+#       chunk magic (4 bytes)
+#       chunk header length (uint32)
+#       chunk header (msgpack dict):
+#           'rows': number of rows in the chunk
+#           'codec': 'zlib' (compressed buffers) or 'raw' (uncompressed buffers)
+#           'size': size of the chunk data
+#           'usecs': [min, max] usecs of the chunk rows
+#           'columns': list of [name, dtype, offset, size] (offset relative to the chunk data start)
+#           'tables': values added to the value tables by this chunk indexed by column name
+#       padding to the next 8 byte boundary (chunk data start)
+#       column buffers, each starting on an 8 byte boundary
+#   footer (msgpack dict):
+#       'version': 2
+#       'rows': total number of rows
+#       'codec': codec of the chunks
+#       'columns': list of [name, dtype]
+#       'tables': full value tables indexed by the name of the dictionary encoded columns
+#       'chunks': list of [offset, rows, min usecs, max usecs] for every chunk (time index)
+#       'metadata': capture information (e.g. 'epoch': absolute time in usecs of usecs 0)
+#       'task_names': final task names indexed by tid resolved by the converter (only the tasks that are
+#                     renamed), applied to the raw task names of the chunks when the file is decoded
+#       'task_map': task names indexed by tid, applied to the task names when the file is decoded
+#                   (optional, can be replaced without rewriting the chunks)
+#       'summary': zlib compressed msgpack dict of the event aggregates computed while the file
+#                  is written (optional, see CdictSummary)
+#   footer length (uint32)
+#   end magic (8 bytes)
+#
+# Every chunk is self contained (except for the value tables that are built incrementally)
+# so that a file with a missing footer (e.g. conversion interrupted) can be recovered by
+# walking the chunks.
+# The time index allows to only decode the chunks that overlap a given time window.
+# Raw column buffers can be mapped directly into numpy arrays from a memory mapped file.
+#
+# A long capture can be stored as several segment cdict files grouped by a manifest file:
+#
+#   manifest magic (8 bytes)
+#   manifest (msgpack dict):
+#       'version': 2
+#       'segments': list of segment cdict file names in time order (relative to the manifest folder)
+#
+# The usecs of each segment are relative to the epoch of that segment and are shifted
+# to the epoch of the first segment when the manifest is opened.
+#
+CDICT_MAGIC = 'PWCDICT\x02'
+CDICT_END_MAGIC = 'PWCDEND\x02'
+CDICT_CHUNK_MAGIC = 'PWCK'
+CDICT_MANIFEST_MAGIC = 'PWCDSEG\x02'
+CDICT_VERSION = 2
+CDICT_ALIGN = 8
+CDICT_CODECS = ['zlib', 'raw']
+# default number of rows per chunk
+CDICT_CHUNK_ROWS = 256 * 1024
+# default time granularity of the summary in usecs
+CDICT_SUMMARY_USECS = 100000
+# size of the blocks hashed by get_cdict_digest
+CDICT_DIGEST_BLOCK_SIZE = 1024 * 1024
+
+# storage type of the known cdict columns, any other column is dictionary encoded
+# 'str' columns can also contain non string values (next_comm has the kvm exit reason)
+CDICT_COLUMNS = [('event', 'str'),
+                 ('cpu', '<i4'),
+                 ('usecs', '<i8'),
+                 ('pid', '<i4'),
+                 ('task_name', 'str'),
+                 ('duration', '<i8'),
+                 ('next_pid', '<i4'),
+                 ('next_comm', 'str')]
+CDICT_CODE_DTYPE = '<u4'
+# None values are not stored in the value tables but encoded with a code that
+# reads as -1 when the codes are viewed as signed integers
+CDICT_NONE_CODE = 0xFFFFFFFF
+
+# array module typecodes indexed by dtype
+typecode_by_dtype = {}
+
+def get_typecode(dtype):
+    '''Get the array module typecode that matches a numpy style dtype string
+    :param dtype: little endian dtype string (e.g. '<i4' or '<u4')
+    :return: the corresponding array typecode
+    '''
+    try:
+        return typecode_by_dtype[dtype]
+    except KeyError:
+        pass
+    size = int(dtype[2:])
+    typecodes = 'BHILQ' if dtype[1] == 'u' else 'bhilq'
+    for typecode in typecodes:
         try:
-            new_task_name = map_dict[pids[index]]
-            names[index] = new_task_name
-            count += 1
-        except KeyError:
+            if array.array(typecode).itemsize == size:
+                typecode_by_dtype[dtype] = typecode
+                return typecode
+        except ValueError:
+            # 'q' and 'Q' are not supported by all python versions
             pass
+    raise ValueError('Unsupported cdict column type: ' + dtype)
+
+def align(offset):
+    return (offset + CDICT_ALIGN - 1) & ~(CDICT_ALIGN - 1)
+
+def get_column_dtype(name):
+    for col_name, dtype in CDICT_COLUMNS:
+        if col_name == name:
+            return dtype
+    return 'str'
+
+def encode_column(values, dtype, table=None, code_by_value=None):
+    '''Encode a column into a little endian buffer
+    :param values: list or numpy array of values
+    :param dtype: storage type of the column ('str' for dictionary encoding)
+    :param table: value table of a dictionary encoded column (new values are appended to it)
+    :param code_by_value: dict of codes indexed by value for the table (updated)
+    :return: the column buffer
+    '''
+    if dtype == 'str' and np is not None and isinstance(values, np.ndarray):
+        # look up the code of every distinct value only (None values are factorized as -1)
+        indices, uniques = pandas.factorize(values)
+        codes = np.empty(len(uniques) + 1, dtype=CDICT_CODE_DTYPE)
+        codes[-1] = CDICT_NONE_CODE
+        for index, value in enumerate(uniques):
+            try:
+                codes[index] = code_by_value[value]
+            except KeyError:
+                code = len(table)
+                code_by_value[value] = code
+                table.append(value)
+                codes[index] = code
+        return codes[indices].tostring()
+    if dtype == 'str':
+        codes = array.array(get_typecode(CDICT_CODE_DTYPE))
+        for value in values:
+            try:
+                codes.append(code_by_value[value])
+            except KeyError:
+                code = len(table)
+                code_by_value[value] = code
+                table.append(value)
+                codes.append(code)
+        arr = codes
+    elif np is not None and isinstance(values, np.ndarray):
+        return values.astype(dtype).tostring()
+    else:
         try:
-            new_task_name = map_dict[next_pids[index]]
-            next_comms[index] = new_task_name
-            count += 1
+            arr = array.array(get_typecode(dtype), values)
+        except TypeError:
+            # missing values (e.g. next_pid of kvm events) are stored as 0
+            arr = array.array(get_typecode(dtype), [value or 0 for value in values])
+    if sys.byteorder == 'big':
+        arr.byteswap()
+    return arr.tostring()
+
+def decode_column(buf, dtype, table=None, offset=0, size=None, categorical=False):
+    '''Decode a column buffer
+    :param buf: a buffer containing the column (bytes or mmap)
+    :param dtype: storage type of the column
+    :param table: value table for dictionary encoded columns
+    :param offset: offset of the column in buf
+    :param size: size of the column in bytes (defaults to the rest of buf)
+    :param categorical: return dictionary encoded columns as pandas categoricals
+        built from the codes (requires pandas)
+    :return: a numpy array if numpy is available else a list
+        numeric numpy arrays share the memory of buf
+    '''
+    if size is None:
+        size = len(buf) - offset
+    if table is not None:
+        # view the codes as signed so that the None code becomes -1
+        dtype = '<i4'
+        if categorical:
+            arr = np.frombuffer(buf, dtype=dtype, count=size // 4, offset=offset)
+            return pandas.Categorical.from_codes(arr, table)
+        # index -1 of the value table is None
+        table = table + [None]
+    if np is not None:
+        dtype = np.dtype(dtype)
+        arr = np.frombuffer(buf, dtype=dtype, count=size // dtype.itemsize, offset=offset)
+        if table is None:
+            return arr
+        values = np.empty(len(table), dtype=object)
+        values[:] = table
+        return values[arr]
+    arr = array.array(get_typecode(dtype))
+    arr.fromstring(buf[offset:offset + size])
+    if sys.byteorder == 'big':
+        arr.byteswap()
+    if table is None:
+        return arr.tolist()
+    return [table[code] for code in arr]
+
+def get_cells(key_columns, usecs, durations, counts=None):
+    '''Aggregate rows into cells of same key (requires numpy)
+    :param key_columns: list of numpy arrays of the key columns (object columns can contain None)
+    :param usecs: numpy array of the usecs of the rows (a cell has the usecs of its first row)
+    :param durations: numpy array of the durations to sum per cell
+    :param counts: numpy array of the counts to sum per cell (defaults to 1 per row)
+    :return: a tuple of the key columns, usecs, durations and counts of the cells in order of first row
+    '''
+    # combine the codes of the key columns one column at a time (the combined codes stay dense
+    # so they cannot overflow), the cells are numbered in order of first row
+    cell_codes = np.zeros(len(usecs), dtype=np.int64)
+    for values in key_columns:
+        # None is coded -1
+        codes, uniques = pandas.factorize(values)
+        cell_codes = pandas.factorize(cell_codes * (len(uniques) + 1) + codes + 1)[0]
+    first_rows = np.unique(cell_codes, return_index=True)[1]
+    durations = np.bincount(cell_codes, weights=durations).astype(np.int64)
+    if counts is None:
+        counts = np.bincount(cell_codes)
+    else:
+        counts = np.bincount(cell_codes, weights=counts).astype(np.int64)
+    return [values[first_rows] for values in key_columns], usecs[first_rows], durations, counts
+
+class CdictSummary(object):
+    '''Aggregates of the events of a capture, computed one chunk at a time
+    The events are aggregated in cells per time interval, event, task (pid and raw task name),
+    cpu and kvm exit reason. Each cell has the usecs of its first event, the sum of the durations
+    and the number of events of the cell.
+    This is all the basic charts and the task list need, so these can be generated without
+    decoding the events (at the granularity of the interval for the time window).
+    '''
+    # columns of the cells
+    COLUMNS = ['event', 'cpu', 'usecs', 'pid', 'task_name', 'duration', 'next_comm', 'count']
+    # key columns of the cells (the interval index is computed from the usecs)
+    KEY_COLUMNS = ['event', 'pid', 'task_name', 'cpu', 'next_comm']
+    # the cells of the chunks are merged when there are more chunks than this
+    MAX_CELL_CHUNKS = 16
+
+    def __init__(self, interval):
+        self.interval = interval
+        # without numpy: [usecs, duration, count] indexed by
+        # (interval index, event, pid, task name, cpu, exit reason)
+        self.cells = {}
+        # with numpy: list of the cells of every chunk (see get_cells)
+        self.cell_chunks = []
+        self.usecs_range = None
+
+    def add_chunk(self, chunk_dict):
+        '''Aggregate a chunk of rows
+        :param chunk_dict: a dict of columns (lists or numpy arrays of same length)
+        '''
+        usecs = chunk_dict['usecs']
+        if not len(usecs):
+            return
+        if np is not None:
+            self.add_chunk_cells(chunk_dict)
+            return
+        cells = self.cells
+        interval = self.interval
+        for event, cpu, usec, pid, comm, duration, next_comm in zip(
+                chunk_dict['event'], chunk_dict['cpu'], usecs, chunk_dict['pid'],
+                chunk_dict['task_name'], chunk_dict['duration'], chunk_dict['next_comm']):
+            # the exit reason is only relevant for kvm exits
+            key = (usec // interval, event, pid, comm, cpu, next_comm if event == 'kvm_exit' else None)
+            try:
+                cell = cells[key]
+                cell[1] += duration
+                cell[2] += 1
+            except KeyError:
+                cells[key] = [usec, duration, 1]
+        self.set_usecs_range(int(min(usecs)), int(max(usecs)))
+
+    def set_usecs_range(self, first, last):
+        if self.usecs_range:
+            first = min(first, self.usecs_range[0])
+            last = max(last, self.usecs_range[1])
+        self.usecs_range = [first, last]
+
+    def add_chunk_cells(self, chunk_dict):
+        '''Aggregate a chunk of rows with numpy (same cells as the row by row aggregation)'''
+        usecs = np.asarray(chunk_dict['usecs'], dtype=np.int64)
+        columns = dict((name, np.asarray(chunk_dict[name], dtype=object if get_column_dtype(name) == 'str'
+                                         else np.int64))
+                       for name in self.KEY_COLUMNS)
+        # the exit reason is only relevant for kvm exits
+        columns['next_comm'] = np.where(columns['event'] == 'kvm_exit', columns['next_comm'], None)
+        key_columns = [usecs // self.interval] + [columns[name] for name in self.KEY_COLUMNS]
+        self.cell_chunks.append(get_cells(key_columns, usecs, np.asarray(chunk_dict['duration'], dtype=np.float64)))
+        if len(self.cell_chunks) > self.MAX_CELL_CHUNKS:
+            self.cell_chunks = [self.merge_cell_chunks()]
+        self.set_usecs_range(int(usecs.min()), int(usecs.max()))
+
+    def merge_cell_chunks(self):
+        '''Merge the cells of all the chunks (the chunks are in time order)'''
+        if len(self.cell_chunks) == 1:
+            return self.cell_chunks[0]
+        key_columns = [np.concatenate([chunk[0][index] for chunk in self.cell_chunks])
+                       for index in range(len(self.KEY_COLUMNS) + 1)]
+        return get_cells(key_columns,
+                         np.concatenate([chunk[1] for chunk in self.cell_chunks]),
+                         np.concatenate([chunk[2] for chunk in self.cell_chunks]).astype(np.float64),
+                         np.concatenate([chunk[3] for chunk in self.cell_chunks]).astype(np.float64))
+
+    def get_cell_columns(self):
+        '''Get the columns of the cells in time order
+        :return: a dict of lists indexed by column name (see COLUMNS)
+        '''
+        columns = dict((name, []) for name in self.COLUMNS)
+        if self.cell_chunks:
+            key_columns, usecs, durations, counts = self.merge_cell_chunks()
+            order = np.argsort(usecs, kind='mergesort')
+            values = dict(zip(['index'] + self.KEY_COLUMNS, key_columns))
+            values.update({'usecs': usecs, 'duration': durations, 'count': counts})
+            for name in self.COLUMNS:
+                columns[name] = values[name][order].tolist()
+            return columns
+        # cells with the same first usecs are sorted by key so that the order does not depend on the dict
+        for key, cell in sorted(self.cells.items(), key=lambda item: (item[1][0], item[0])):
+            _, event, pid, comm, cpu, reason = key
+            for name, value in zip(self.COLUMNS, [event, cpu, cell[0], pid, comm, cell[1], reason, cell[2]]):
+                columns[name].append(value)
+        return columns
+
+    def encode(self):
+        '''Encode the summary for the cdict footer
+        :return: the zlib compressed msgpack dict with the interval, the usecs range of
+            the events and the columns of the cells in time order
+        '''
+        return zlib.compress(packb({'interval': self.interval,
+                                    'usecs': self.usecs_range,
+                                    'columns': self.get_cell_columns()}))
+
+class CdictWriter(object):
+    '''Write a v2 cdict file one chunk at a time
+    Each chunk is written to disk as soon as it is added
+    '''
+    def __init__(self, cdict_file, codec='zlib', summary_usecs=0):
+        if codec not in CDICT_CODECS:
+            raise ValueError('Invalid cdict codec: ' + codec)
+        if not cdict_file.endswith('.cdict'):
+            # automatically add the cdict extension if there is one
+            cdict_file += '.cdict'
+        self.cdict_file = cdict_file
+        self.codec = codec
+        self.rows = 0
+        # list of [name, dtype]
+        self.columns = None
+        # value tables and code dicts indexed by column name
+        self.tables = {}
+        self.code_by_values = {}
+        # list of [offset, rows, min usecs, max usecs]
+        self.chunks = []
+        self.metadata = {}
+        self.task_names = {}
+        self.task_map = {}
+        # summary of the events (encoded) or accumulator (0 = no summary)
+        self.summary = CdictSummary(summary_usecs) if summary_usecs else None
+        self.ff = open(cdict_file, 'wb')
+        self.ff.write(CDICT_MAGIC)
+
+    def pad(self):
+        self.ff.write('\0' * (align(self.ff.tell()) - self.ff.tell()))
+
+    def add_chunk(self, chunk_dict):
+        '''Encode and write a chunk of rows
+        :param chunk_dict: a dict of columns (lists or numpy arrays of same length)
+        '''
+        if self.columns is None:
+            self.columns = [[name, get_column_dtype(name)] for name in sorted(chunk_dict)]
+            for name, dtype in self.columns:
+                if dtype == 'str':
+                    self.tables[name] = []
+                    self.code_by_values[name] = {None: CDICT_NONE_CODE}
+        rows = len(chunk_dict[self.columns[0][0]])
+        if not rows:
+            return
+        if self.summary:
+            self.summary.add_chunk(chunk_dict)
+        columns = []
+        new_values = {}
+        buffers = []
+        offset = 0
+        for name, dtype in self.columns:
+            table = self.tables.get(name)
+            if table is not None:
+                table_len = len(table)
+            buf = encode_column(chunk_dict[name], dtype, table, self.code_by_values.get(name))
+            if table is not None:
+                new_values[name] = table[table_len:]
+            if self.codec == 'zlib':
+                buf = zlib.compress(buf)
+            columns.append([name, dtype, offset, len(buf)])
+            buffers.append([buf])
+            offset = align(offset + len(buf))
+        try:
+            usecs = chunk_dict['usecs']
+            if np is not None and isinstance(usecs, np.ndarray):
+                usecs_range = [int(usecs.min()), int(usecs.max())]
+            else:
+                usecs_range = [int(min(usecs)), int(max(usecs))]
         except KeyError:
-            pass
-    print 'Remapped %d task names' % (count)
+            usecs_range = None
+        self.write_chunk(rows, usecs_range, columns, new_values, buffers)
 
-def open_cdict(cdict_file, map_file=None):
-    '''Open and decode a cdict file
+    def write_chunk(self, rows, usecs_range, columns, new_values, buffers):
+        '''Write an encoded chunk
+        :param rows: number of rows in the chunk
+        :param usecs_range: [min usecs, max usecs] of the chunk (None if unknown)
+        :param columns: list of [name, dtype, offset, size] of the encoded columns
+        :param new_values: values added to the value tables by this chunk indexed by column name
+        :param buffers: list of iterables that produce the pieces of each encoded column
+        '''
+        header = packb({'rows': rows,
+                        'codec': self.codec,
+                        'size': align(columns[-1][2] + columns[-1][3]) if columns else 0,
+                        'usecs': usecs_range,
+                        'columns': columns,
+                        'tables': new_values})
+        self.pad()
+        self.chunks.append([self.ff.tell(), rows] + (usecs_range or []))
+        self.ff.write(CDICT_CHUNK_MAGIC)
+        self.ff.write(struct.pack('<I', len(header)))
+        self.ff.write(header)
+        for pieces in buffers:
+            self.pad()
+            for piece in pieces:
+                self.ff.write(piece)
+        self.pad()
+        # make the chunk readable even if the conversion does not complete
+        self.ff.flush()
+        self.rows += rows
+
+    def close(self):
+        '''Write the footer and close the file
+        :return: the size of the file in bytes
+        '''
+        footer = {'version': CDICT_VERSION,
+                  'rows': self.rows,
+                  'codec': self.codec,
+                  'columns': self.columns or [],
+                  'tables': self.tables,
+                  'chunks': self.chunks,
+                  'metadata': self.metadata,
+                  'task_names': self.task_names,
+                  'task_map': self.task_map}
+        if isinstance(self.summary, CdictSummary):
+            if self.summary.usecs_range:
+                footer['summary'] = self.summary.encode()
+        elif self.summary:
+            footer['summary'] = self.summary
+        write_cdict_footer(self.ff, footer)
+        size = self.ff.tell()
+        self.ff.close()
+        return size
+
+def write_cdict_footer(ff, footer):
+    footer = packb(footer)
+    ff.write(footer)
+    ff.write(struct.pack('<I', len(footer)))
+    ff.write(CDICT_END_MAGIC)
+
+def read_chunk_header(cdict, offset):
+    '''Read the header of a chunk
+    :param cdict: the content of the file (bytes or mmap)
+    :param offset: offset of the chunk in the file
+    :return: the chunk header dict with 'start' set to the offset of the chunk data
+        or None if there is no valid chunk at that offset
+    '''
+    start = offset + len(CDICT_CHUNK_MAGIC) + 4
+    if start > len(cdict) or cdict[offset:offset + len(CDICT_CHUNK_MAGIC)] != CDICT_CHUNK_MAGIC:
+        return None
+    header_len, = struct.unpack_from('<I', cdict, offset + len(CDICT_CHUNK_MAGIC))
+    try:
+        header = unpackb(cdict[start:start + header_len])
+        header['start'] = align(start + header_len)
+    except Exception:
+        return None
+    if header['start'] + header['size'] > len(cdict):
+        # truncated chunk
+        return None
+    return header
+
+def read_cdict_footer(cdict):
+    '''Read the footer of a v2 cdict file
+    If the footer is missing, it is rebuilt from the chunks that are complete
+    :param cdict: the content of the file (bytes or mmap)
+    :return: the footer dict
+    '''
+    end = len(cdict) - len(CDICT_END_MAGIC)
+    if cdict[end:] == CDICT_END_MAGIC:
+        footer_len, = struct.unpack_from('<I', cdict, end - 4)
+        footer = unpackb(cdict[end - 4 - footer_len:end - 4])
+        if footer['version'] > CDICT_VERSION:
+            raise ValueError('Unsupported cdict version: %d' % (footer['version']))
+        return footer
+    # the conversion did not complete, recover all complete chunks
+    footer = {'version': CDICT_VERSION, 'rows': 0, 'codec': 'zlib', 'columns': [], 'tables': {}, 'chunks': []}
+    offset = align(len(CDICT_MAGIC))
+    while True:
+        header = read_chunk_header(cdict, offset)
+        if not header:
+            break
+        footer['codec'] = header['codec']
+        footer['columns'] = [[name, dtype] for name, dtype, _, _ in header['columns']]
+        for name, values in header['tables'].items():
+            footer['tables'].setdefault(name, []).extend(values)
+        footer['chunks'].append([offset, header['rows']] + (header.get('usecs') or []))
+        footer['rows'] += header['rows']
+        offset = header['start'] + header['size']
+    print 'Warning: incomplete cdict file, recovered %d rows from %d chunks' % \
+          (footer['rows'], len(footer['chunks']))
+    return footer
+
+def get_cdict_footer_offset(cdict, footer):
+    '''Get the offset of the footer of a v2 cdict file
+    :param cdict: the content of the file (bytes or mmap)
+    :param footer: the footer of the file (see read_cdict_footer)
+    :return: the offset of the footer or of the end of the last complete chunk if there is no footer
+    '''
+    end = len(cdict) - len(CDICT_END_MAGIC)
+    if cdict[end:] == CDICT_END_MAGIC:
+        footer_len, = struct.unpack_from('<I', cdict, end - 4)
+        return end - 4 - footer_len
+    if not footer['chunks']:
+        return align(len(CDICT_MAGIC))
+    header = read_chunk_header(cdict, footer['chunks'][-1][0])
+    return header['start'] + header['size']
+
+def in_time_window(chunk, from_usec, to_usec):
+    '''Check if a chunk may contain rows in a time window
+    :param chunk: footer chunk entry [offset, rows, min usecs, max usecs]
+    :param from_usec: start of the window
+    :param to_usec: end of the window (0 = unlimited)
+    '''
+    if len(chunk) < 4:
+        # no time index for this chunk
+        return True
+    if to_usec and chunk[2] > to_usec:
+        return False
+    return chunk[3] >= from_usec
+
+def get_chunk_headers(cdict, footer, from_usec=0, to_usec=0):
+    return [read_chunk_header(cdict, chunk[0]) for chunk in footer['chunks']
+            if in_time_window(chunk, from_usec, to_usec)]
+
+def get_column_pieces(cdict, headers, index):
+    '''Get the uncompressed buffers of a column in a list of chunks
+    :param cdict: the content of the file (bytes or mmap)
+    :param headers: list of chunk headers
+    :param index: index of the column
+    :return: a generator of the column buffers of each chunk
+    '''
+    for header in headers:
+        _, _, offset, size = header['columns'][index]
+        offset += header['start']
+        if header['codec'] == 'raw':
+            yield cdict[offset:offset + size]
+        else:
+            yield zlib.decompress(cdict[offset:offset + size])
+
+def decode_raw_column(cdict, headers, index, dtype, table=None, categorical=False):
+    '''Decode a column of a list of raw chunks (requires numpy)
+    The column of every chunk is mapped in place, the columns of several chunks are
+    concatenated with a single copy (no intermediate buffer)
+    :param cdict: the content of the file (bytes or mmap)
+    :param headers: list of chunk headers (all chunks must be raw)
+    :param index: index of the column
+    :param dtype: storage type of the column
+    :param table: value table for dictionary encoded columns
+    :param categorical: return dictionary encoded columns as pandas categoricals
+    :return: a numpy array (or a pandas categorical)
+    '''
+    views = []
+    for header in headers:
+        _, _, offset, size = header['columns'][index]
+        # view the codes as signed so that the None code becomes -1
+        views.append(decode_column(cdict, '<i4' if table is not None else dtype, None,
+                                   header['start'] + offset, size))
+    arr = views[0] if len(views) == 1 else np.concatenate(views)
+    if table is None:
+        return arr
+    if categorical:
+        return pandas.Categorical.from_codes(arr, table)
+    # index -1 of the value table is None
+    values = np.empty(len(table) + 1, dtype=object)
+    values[:-1] = table
+    return values[arr]
+
+def decode_cdict_v2(cdict, from_usec=0, to_usec=0, categorical=False):
+    '''Decode the content of a v2 cdict file
+    :param cdict: the content of the file (bytes or mmap)
+    :param from_usec: only decode the chunks that have rows at or after that time
+    :param to_usec: only decode the chunks that have rows at or before that time (0 = unlimited)
+    :param categorical: return the dictionary encoded columns as pandas categoricals
+    :return: the uncompressed dictionary of columns
+        raw columns are decoded in place if cdict is a mmap and the window covers a single chunk
+        (the raw columns of several chunks are copied once, without decompression)
+        the time window is applied at chunk granularity (rows outside of the window
+        can be returned)
+    '''
+    footer = read_cdict_footer(cdict)
+    tables = footer['tables']
+    headers = get_chunk_headers(cdict, footer, from_usec, to_usec)
+    perf_dict = {}
+    for index, (name, dtype) in enumerate(footer['columns']):
+        table = tables.get(name)
+        if headers and np is not None and all(header['codec'] == 'raw' for header in headers):
+            perf_dict[name] = decode_raw_column(cdict, headers, index, dtype, table, categorical)
+        else:
+            buf = ''.join(get_column_pieces(cdict, headers, index))
+            perf_dict[name] = decode_column(buf, dtype, table, categorical=categorical)
+    if footer.get('task_names'):
+        apply_task_map(perf_dict, footer['task_names'])
+    if footer.get('task_map'):
+        print 'Remapped %d task names' % (apply_task_map(perf_dict, footer['task_map']))
+    return perf_dict
+
+def get_cdict_epoch(cdict):
+    '''Get the absolute time in usecs of the start of a v2 cdict file
+    :param cdict: the content of the file (bytes or mmap)
+    :return: the epoch in usecs or None if unknown
+    '''
+    return read_cdict_footer(cdict).get('metadata', {}).get('epoch')
+
+def decode_cdict_summary(cdict):
+    '''Decode the summary of a v2 cdict file
+    :param cdict: the content of the file (bytes or mmap)
+    :return: a tuple of the summary dictionary of columns (with the final task names),
+        the [first, last] usecs of the events and the interval of the cells in usecs
+        or (None, None, None) if the file has no summary
+    '''
+    footer = read_cdict_footer(cdict)
+    if not footer.get('summary'):
+        return None, None, None
+    summary = unpackb(zlib.decompress(footer['summary']))
+    perf_dict = summary['columns']
+    # same columns as the events (the cells have no next task)
+    perf_dict['next_pid'] = [0] * len(perf_dict['count'])
+    if footer.get('task_names'):
+        apply_task_map(perf_dict, footer['task_names'])
+    if footer.get('task_map'):
+        apply_task_map(perf_dict, footer['task_map'])
+    return perf_dict, summary['usecs'], summary['interval']
+
+def open_cdict_summary(cdict_file, map_file=None):
+    '''Open the summary of a cdict file (or of all the segments of a manifest)
     :param cdict_file: name of the cdict file
     :param map_file: name of a mapping file (optional)
-    :return: the uncompressed dictionary representing the cdict file
+    :return: a tuple of the summary dictionary of columns (see CdictSummary),
+        the [first, last] usecs of the events and the interval of the cells in usecs
+        (None if the cells of the segments of a manifest do not start on the same time grid)
+        or (None, None, None) if the file (or any segment) has no summary
     '''
-    if not cdict_file.endswith('.cdict'):
+    cdict = read_cdict_file(cdict_file)
+    if cdict[:len(CDICT_MAGIC)] == CDICT_MAGIC:
+        perf_dict, usecs_range, interval = decode_cdict_summary(cdict)
+    elif cdict[:len(CDICT_MANIFEST_MAGIC)] == CDICT_MANIFEST_MAGIC:
+        folder = os.path.dirname(os.path.abspath(get_cdict_path(cdict_file)))
+        segments = unpackb(cdict[len(CDICT_MANIFEST_MAGIC):])['segments']
+        perf_dict = {}
+        usecs_range = None
+        interval = None
+        base_epoch = None
+        for index, segment in enumerate(segments):
+            seg_cdict = read_cdict_file(os.path.join(folder, segment))
+            seg_dict, seg_range, seg_interval = decode_cdict_summary(seg_cdict)
+            if seg_dict is None:
+                return None, None, None
+            epoch = get_cdict_epoch(seg_cdict)
+            if base_epoch is None:
+                base_epoch = epoch
+            shift = epoch - base_epoch if epoch is not None else 0
+            # the cells of a segment start at multiples of its interval from its own epoch
+            if not index:
+                interval = seg_interval
+            elif seg_interval != interval or shift % seg_interval:
+                interval = None
+            seg_dict['usecs'] = [value + shift for value in seg_dict['usecs']]
+            for name, values in seg_dict.items():
+                perf_dict.setdefault(name, []).extend(values)
+            if usecs_range is None:
+                usecs_range = [seg_range[0] + shift, seg_range[1] + shift]
+            else:
+                usecs_range[1] = seg_range[1] + shift
+    else:
+        # v1 format
+        return None, None, None
+    if perf_dict is not None and map_file:
+        remap(perf_dict, map_file)
+    return perf_dict, usecs_range, interval
+
+def concat_columns(pieces):
+    '''Concatenate the pieces of a decoded column
+    :param pieces: list of lists, numpy arrays or pandas categoricals
+    :return: the concatenated column
+    '''
+    if len(pieces) == 1:
+        return pieces[0]
+    if np is None:
+        return [value for piece in pieces for value in piece]
+    if isinstance(pieces[0], pandas.Categorical):
+        from pandas.api.types import union_categoricals
+        return union_categoricals(pieces)
+    return np.concatenate(pieces)
+
+def decode_cdict_segments(manifest, folder, from_usec=0, to_usec=0, categorical=False):
+    '''Decode all the segments of a segmented capture as a single cdict
+    :param manifest: the content of the manifest file
+    :param folder: folder of the manifest file
+    :param from_usec: start of the time window to decode (relative to the first segment)
+    :param to_usec: end of the time window to decode (0 = unlimited)
+    :param categorical: return the dictionary encoded columns as pandas categoricals
+    :return: the uncompressed dictionary of columns of all segments
+    '''
+    segments = unpackb(manifest[len(CDICT_MANIFEST_MAGIC):])['segments']
+    pieces_by_name = {}
+    base_epoch = None
+    for segment in segments:
+        cdict = read_cdict_file(os.path.join(folder, segment))
+        if cdict[:len(CDICT_MAGIC)] != CDICT_MAGIC:
+            raise ValueError('Invalid cdict segment: ' + segment)
+        epoch = get_cdict_epoch(cdict)
+        if base_epoch is None:
+            base_epoch = epoch
+        shift = epoch - base_epoch if epoch is not None else 0
+        if to_usec and to_usec < shift:
+            # this segment and all the next ones are after the time window
+            break
+        seg_dict = decode_cdict_v2(cdict, max(from_usec - shift, 0), to_usec - shift if to_usec else 0,
+                                   categorical)
+        if shift and 'usecs' in seg_dict:
+            usecs = seg_dict['usecs']
+            if np is None:
+                seg_dict['usecs'] = [value + shift for value in usecs]
+            else:
+                seg_dict['usecs'] = usecs + shift
+        for name, values in seg_dict.items():
+            pieces_by_name.setdefault(name, []).append(values)
+    return dict((name, concat_columns(pieces)) for name, pieces in pieces_by_name.items())
+
+def write_cdict_manifest(manifest_file, segment_files):
+    '''Write a manifest that groups segment cdict files into one logical capture
+    :param manifest_file: manifest file name (will auto add a .cdict extension if missing)
+    :param segment_files: list of segment cdict file names in time order
+    '''
+    if not manifest_file.endswith('.cdict'):
+        manifest_file += '.cdict'
+    folder = os.path.dirname(os.path.abspath(manifest_file))
+    segments = [os.path.relpath(os.path.abspath(name), folder) for name in segment_files]
+    with open(manifest_file, 'wb') as ff:
+        ff.write(CDICT_MANIFEST_MAGIC)
+        ff.write(packb({'version': CDICT_VERSION, 'segments': segments}))
+    print 'Manifest written to %s %d segments' % (manifest_file, len(segments))
+
+def get_cdict_path(cdict_file):
+    if not cdict_file.endswith('.cdict') and os.path.isfile(cdict_file + '.cdict'):
         # automatically add the cdict extension if there is one
-        if os.path.isfile(cdict_file + '.cdict'):
-            cdict_file += '.cdict'
-        else:
-            raise ValueError('cdict file name must have the .cdict extension: ' + cdict_file)
+        cdict_file += '.cdict'
+    return cdict_file
 
-    with open(cdict_file, 'r') as ff:
-        cdict = ff.read()
+def set_cdict_task_map(cdict_file, task_map):
+    '''Store a task name mapping table in a v2 cdict file (or in all the segments of a manifest)
+    Only the footer is rewritten, the task names are remapped when the file is decoded
+    :param cdict_file: name of the cdict file
+    :param task_map: a mapping dict of task names indexed by the tid (replaces any previous one)
+    :return: True if the mapping table was stored, False if the file is not a v2 cdict file
+    '''
+    cdict_file = get_cdict_path(cdict_file)
+    cdict = read_cdict_file(cdict_file)
+    if cdict[:len(CDICT_MANIFEST_MAGIC)] == CDICT_MANIFEST_MAGIC:
+        folder = os.path.dirname(os.path.abspath(cdict_file))
+        segments = unpackb(cdict[len(CDICT_MANIFEST_MAGIC):])['segments']
+        return all([set_cdict_task_map(os.path.join(folder, segment), task_map) for segment in segments])
+    if cdict[:len(CDICT_MAGIC)] != CDICT_MAGIC:
+        return False
+    footer = read_cdict_footer(cdict)
+    offset = get_cdict_footer_offset(cdict, footer)
+    # the memory map must not be accessed once the file is truncated
+    cdict.close()
+    footer['task_map'] = task_map
+    with open(cdict_file, 'r+b') as ff:
+        ff.seek(offset)
+        ff.truncate()
+        write_cdict_footer(ff, footer)
+    print 'Mapping table of %d tasks stored in %s' % (len(task_map), cdict_file)
+    return True
 
-    decomp = zlib.decompress(cdict)
-    try:
-        perf_dict = unpackb(decomp)
-    except Exception:
-        # old serialization format
-        perf_dict = marshal.loads(decomp)
+def read_cdict_file(cdict_file):
+    '''Read a cdict file
+    :param cdict_file: name of the cdict file (the .cdict extension is optional)
+    :return: the content of the file, a copy on write memory map for v2 files
+        (the mapping remains valid after the file is closed) else a bytes
+    '''
+    cdict_file = get_cdict_path(cdict_file)
+    if not cdict_file.endswith('.cdict'):
+        raise ValueError('cdict file name must have the .cdict extension: ' + cdict_file)
+
+    with open(cdict_file, 'rb') as ff:
+        magic = ff.read(len(CDICT_MAGIC))
+        ff.seek(0)
+        if magic == CDICT_MAGIC:
+            return mmap.mmap(ff.fileno(), 0, access=mmap.ACCESS_COPY)
+        return ff.read()
+
+def get_cdict_digest(cdict_file):
+    '''Get a digest of the content of a cdict file
+    All the bytes of the file are hashed (hashing is much faster than decoding the chunks),
+    the digest of a manifest covers all its segments
+    :param cdict_file: name of the cdict file (or of a segmented capture manifest)
+    :return: the digest as an hex string
+    '''
+    cdict = read_cdict_file(cdict_file)
+    digest = hashlib.sha1()
+    digest.update(str(len(cdict)))
+    for offset in xrange(0, len(cdict), CDICT_DIGEST_BLOCK_SIZE):
+        digest.update(cdict[offset:offset + CDICT_DIGEST_BLOCK_SIZE])
+    if cdict[:len(CDICT_MAGIC)] == CDICT_MAGIC:
+        cdict.close()
+    elif cdict[:len(CDICT_MANIFEST_MAGIC)] == CDICT_MANIFEST_MAGIC:
+        folder = os.path.dirname(os.path.abspath(get_cdict_path(cdict_file)))
+        for segment in unpackb(cdict[len(CDICT_MANIFEST_MAGIC):])['segments']:
+            digest.update(get_cdict_digest(os.path.join(folder, segment)))
+    return digest.hexdigest()
+
+def get_cdict_identity(cdict_file):
+    '''Get a cheap identity of a cdict file that changes whenever the file changes
+    Only the file attributes and the footer of a v2 file are read (see get_cdict_digest
+    for a digest of the content)
+    :param cdict_file: name of the cdict file (or of a segmented capture manifest)
+    :return: a list of [path, size, modification time, inode, device, footer digest]
+        for the file and for every segment of a manifest
+    '''
+    cdict_file = os.path.abspath(get_cdict_path(cdict_file))
+    stat = os.stat(cdict_file)
+    cdict = read_cdict_file(cdict_file)
+    footer_digest = None
+    segments = []
+    if cdict[:len(CDICT_MAGIC)] == CDICT_MAGIC:
+        end = len(cdict) - len(CDICT_END_MAGIC)
+        if cdict[end:] == CDICT_END_MAGIC:
+            footer_len, = struct.unpack_from('<I', cdict, end - 4)
+            footer_digest = hashlib.sha1(cdict[end - 4 - footer_len:]).hexdigest()
+        cdict.close()
+    elif cdict[:len(CDICT_MANIFEST_MAGIC)] == CDICT_MANIFEST_MAGIC:
+        folder = os.path.dirname(cdict_file)
+        for segment in unpackb(cdict[len(CDICT_MANIFEST_MAGIC):])['segments']:
+            segments.extend(get_cdict_identity(os.path.join(folder, segment)))
+    return [[cdict_file, stat.st_size, stat.st_mtime, stat.st_ino, stat.st_dev, footer_digest]] + segments
+
+def get_cdict_rows(cdict_file):
+    '''Get the number of events in a cdict file without decoding the chunks
+    :param cdict_file: name of the cdict file (or of a segmented capture manifest)
+    :return: the number of events, 0 if unknown (older cdict file)
+    '''
+    cdict = read_cdict_file(cdict_file)
+    if cdict[:len(CDICT_MAGIC)] == CDICT_MAGIC:
+        rows = read_cdict_footer(cdict)['rows']
+        cdict.close()
+        return rows
+    if cdict[:len(CDICT_MANIFEST_MAGIC)] == CDICT_MANIFEST_MAGIC:
+        folder = os.path.dirname(os.path.abspath(get_cdict_path(cdict_file)))
+        return sum(get_cdict_rows(os.path.join(folder, segment))
+                   for segment in unpackb(cdict[len(CDICT_MANIFEST_MAGIC):])['segments'])
+    return 0
+
+def get_cdict_last_usec(cdict_file):
+    '''Get the usecs of the last event of a cdict file from the time index of the chunks
+    :param cdict_file: name of the cdict file (or of a segmented capture manifest)
+    :return: the usecs of the last event (relative to the first segment of a manifest)
+        or None if unknown (older cdict file or chunks without time index)
+    '''
+    cdict = read_cdict_file(cdict_file)
+    if cdict[:len(CDICT_MAGIC)] == CDICT_MAGIC:
+        chunks = read_cdict_footer(cdict)['chunks']
+        cdict.close()
+        if not chunks or any(len(chunk) < 4 for chunk in chunks):
+            return None
+        return max(chunk[3] for chunk in chunks)
+    if cdict[:len(CDICT_MANIFEST_MAGIC)] == CDICT_MANIFEST_MAGIC:
+        folder = os.path.dirname(os.path.abspath(get_cdict_path(cdict_file)))
+        segments = unpackb(cdict[len(CDICT_MANIFEST_MAGIC):])['segments']
+        last_usec = get_cdict_last_usec(os.path.join(folder, segments[-1]))
+        if last_usec is None or len(segments) == 1:
+            return last_usec
+        base_epoch = get_cdict_epoch(read_cdict_file(os.path.join(folder, segments[0])))
+        epoch = get_cdict_epoch(read_cdict_file(os.path.join(folder, segments[-1])))
+        return last_usec + (epoch - base_epoch if epoch is not None and base_epoch is not None else 0)
+    return None
+
+def open_cdict(cdict_file, map_file=None, from_usec=0, to_usec=0, categorical=False):
+    '''Open and decode a cdict file
+    :param cdict_file: name of the cdict file (or of a segmented capture manifest)
+    :param map_file: name of a mapping file (optional)
+    :param from_usec: start of the time window to decode (v2 only)
+    :param to_usec: end of the time window to decode (v2 only, 0 = unlimited)
+    :param categorical: return the dictionary encoded columns as pandas categoricals
+        (v2 only, requires pandas)
+    :return: the uncompressed dictionary representing the cdict file
+        only the chunks that overlap the time window are decoded, the rows outside of
+        the time window must still be filtered out by the caller
+        the numeric columns of a single chunk raw v2 cdict file are backed by a copy on
+        write memory map of the file (not loaded in memory until accessed)
+    '''
+    cdict = read_cdict_file(cdict_file)
+    if cdict[:len(CDICT_MAGIC)] == CDICT_MAGIC:
+        perf_dict = decode_cdict_v2(cdict, from_usec, to_usec, categorical)
+    elif cdict[:len(CDICT_MANIFEST_MAGIC)] == CDICT_MANIFEST_MAGIC:
+        folder = os.path.dirname(os.path.abspath(get_cdict_path(cdict_file)))
+        perf_dict = decode_cdict_segments(cdict, folder, from_usec, to_usec, categorical)
+    else:
+        # v1 format
+        decomp = zlib.decompress(cdict)
+        try:
+            perf_dict = unpackb(decomp)
+        except Exception:
+            # old serialization format
+            perf_dict = marshal.loads(decomp)
     if map_file:
         remap(perf_dict, map_file)
     return perf_dict
 
-def write_cdict(cdict_file, perf_dict):
-    '''Write a dictionary to a cdict file
+def write_cdict(cdict_file, perf_dict, codec='zlib', chunk_rows=CDICT_CHUNK_ROWS, metadata=None):
+    '''Write a dictionary to a cdict file (v2 format)
     :param cdict_file: cdict file name (will auto add a .cdict extension if missing)
     :param perf_dict:  perf dict to compress and write
+    :param codec: 'zlib' to compress the columns, 'raw' to store them uncompressed
+        (larger file that can be memory mapped when loaded)
+    :param chunk_rows: maximum number of rows per chunk (0 for a single chunk)
+    :param metadata: capture information to store in the footer (optional)
     :return:
     '''
-    if not cdict_file.endswith('.cdict'):
-        # automatically add the cdict extension if there is one
-        cdict_file += '.cdict'
-    with open(cdict_file, 'w') as ff:
-        compressed = zlib.compress(packb(perf_dict))
-        ff.write(compressed)
-        print 'Compressed dictionary written to %s %d entries size=%d bytes' % \
-              (cdict_file, len(perf_dict), len(compressed))
+    writer = CdictWriter(cdict_file, codec)
+    if metadata:
+        writer.metadata = metadata
+    rows = len(perf_dict[next(iter(perf_dict))]) if perf_dict else 0
+    if not chunk_rows:
+        chunk_rows = max(rows, 1)
+    for start in range(0, rows, chunk_rows):
+        writer.add_chunk(dict((name, values[start:start + chunk_rows])
+                              for name, values in perf_dict.items()))
+    size = writer.close()
+    print 'Dictionary written to %s %d entries size=%d bytes (%s)' % \
+          (writer.cdict_file, rows, size, codec)
+
+def transcode_cdict(cdict_file, dest_file, codec='raw', map_file=None, from_usec=0, to_usec=0):
+    '''Rewrite a cdict file as a single chunk v2 cdict file
+    The chunks of a v2 cdict file are only decompressed, not decoded
+    (a mapping file is merged into the mapping table of the new file)
+    :param cdict_file: name of the cdict file to read
+    :param dest_file: name of the cdict file to write
+    :param codec: codec of the new cdict file
+    :param map_file: name of a mapping file (optional)
+    :param from_usec: only keep the chunks that overlap this time window
+        (the summary is only kept if all the chunks overlap the window)
+    :param to_usec: see from_usec (0 = unlimited)
+    '''
+    cdict = read_cdict_file(cdict_file)
+    if cdict[:len(CDICT_MAGIC)] != CDICT_MAGIC:
+        perf_dict = open_cdict(cdict_file, map_file, from_usec, to_usec)
+        write_cdict(dest_file, perf_dict, codec, 0)
+        return
+    footer = read_cdict_footer(cdict)
+    headers = get_chunk_headers(cdict, footer, from_usec, to_usec)
+    writer = CdictWriter(dest_file, codec)
+    writer.columns = footer['columns']
+    writer.tables = footer['tables']
+    writer.metadata = footer.get('metadata', {})
+    writer.task_names = footer.get('task_names', {})
+    writer.task_map = footer.get('task_map', {})
+    if len(headers) == len(footer['chunks']):
+        writer.summary = footer.get('summary')
+    # else the summary has cells of the events that are not copied (the cells are not
+    # aligned on the chunks so they cannot be filtered), the new file has no summary
+    if map_file:
+        writer.task_map.update(read_task_map(map_file))
+    rows = sum(header['rows'] for header in headers)
+    usecs_range = None
+    if headers and all(header.get('usecs') for header in headers):
+        usecs_range = [min(header['usecs'][0] for header in headers),
+                       max(header['usecs'][1] for header in headers)]
+    columns = []
+    buffers = []
+    offset = 0
+    for index, (name, dtype) in enumerate(footer['columns']):
+        pieces = get_column_pieces(cdict, headers, index)
+        if codec == 'zlib':
+            pieces = [zlib.compress(''.join(pieces))]
+            size = len(pieces[0])
+        else:
+            # the size of uncompressed columns is known without decompressing them
+            size = rows * array.array(get_typecode(CDICT_CODE_DTYPE if dtype == 'str' else dtype)).itemsize
+        columns.append([name, dtype, offset, size])
+        buffers.append(pieces)
+        offset = align(offset + size)
+    if rows:
+        writer.write_chunk(rows, usecs_range, columns, {}, buffers)
+    writer.close()
@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+# Copyright 2015 Cisco Systems, Inc.  All rights reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+
+#
+# Stage profiler for perfmap and perfcap (--profile)
+#
+# Every stage of a run (e.g. load, normalize, render) is measured with:
+# - wall time and CPU time (including the CPU time of the child processes waited for during the stage)
+# - peak resident memory of the process during the stage
+# - number of rows processed
+# The stages must not be nested.
+#
+import cProfile
+import json
+import marshal
+import os
+import pstats
+import resource
+import sys
+import time
+
+# list of stage measurements, None = profiling disabled
+profile_stages = None
+# True to run every stage under cProfile
+profile_cprofile = False
+
+def enable_profile(cprofile=False):
+    '''Enable the measurement of the stages
+    :param cprofile: True to also run every stage under cProfile (slows down the stages)
+    '''
+    global profile_stages
+    global profile_cprofile
+    profile_stages = []
+    profile_cprofile = cprofile
+
+def get_peak_rss():
+    '''Get the peak resident memory of this process in KB since the last reset'''
+    try:
+        with open('/proc/self/status') as ff:
+            for line in ff:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def reset_peak_rss():
+    '''Reset the peak resident memory to the current resident memory (Linux 4.0 or later)
+    Without reset support, the peak memory of a stage is the peak since the start of the process
+    '''
+    try:
+        with open('/proc/self/clear_refs', 'w') as ff:
+            ff.write('5')
+    except IOError:
+        pass
+
+def get_cpu_time():
+    '''Get the CPU time of this process and of its terminated child processes in seconds'''
+    times = os.times()
+    return times[0] + times[1] + times[2] + times[3]
+
+class ProfileStage(object):
+    '''Measure a stage when profiling is enabled (no-op otherwise)
+    e.g.:
+        with ProfileStage('load') as stage:
+            df = load()
+            stage.rows = len(df)
+    '''
+    def __init__(self, name, rows=0):
+        self.name = name
+        self.rows = rows
+        self.start = 0
+        self.start_cpu = 0
+        self.profiler = None
+
+    def __enter__(self):
+        if profile_stages is not None:
+            reset_peak_rss()
+            if profile_cprofile:
+                self.profiler = cProfile.Profile()
+                self.profiler.enable()
+            self.start_cpu = get_cpu_time()
+            self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if profile_stages is None:
+            return False
+        elapsed = time.time() - self.start
+        cpu = get_cpu_time() - self.start_cpu
+        if self.profiler:
+            self.profiler.disable()
+        stage = {'name': self.name,
+                 'secs': round(elapsed, 3),
+                 'cpu_secs': round(cpu, 3),
+                 'peak_rss_mb': round(get_peak_rss() / 1000.0, 1),
+                 'rows': self.rows}
+        if self.profiler:
+            self.profiler.create_stats()
+            # marshallable stats (same content as a pstats dump file)
+            stage['cprofile'] = self.profiler.stats
+            self.profiler = None
+        profile_stages.append(stage)
+        return False
+
+def get_profile_stages(first=0):
+    '''Get the stages measured so far
+    :param first: index of the first stage to return
+    :return: a list of stage measurements
+    '''
+    if profile_stages is None:
+        return []
+    return profile_stages[first:]
+
+def add_profile_stages(stages):
+    '''Add the stages measured by another process'''
+    if profile_stages is not None:
+        profile_stages.extend(stages)
+
+def print_profile_report(out=sys.stderr):
+    print >> out, '%-40s %10s %10s %10s %12s' % ('stage', 'secs', 'cpu secs', 'peak MB', 'rows')
+    for stage in profile_stages:
+        print >> out, '%-40s %10.3f %10.3f %10.1f %12s' % \
+            (stage['name'][:40], stage['secs'], stage['cpu_secs'], stage['peak_rss_mb'], stage['rows'] or '-')
+    print >> out, '%-40s %10.3f %10.3f' % ('total', sum(stage['secs'] for stage in profile_stages),
+                                           sum(stage['cpu_secs'] for stage in profile_stages))
+
+def write_profile_json(json_file):
+    stages = [dict((key, value) for key, value in stage.items() if key != 'cprofile')
+              for stage in profile_stages]
+    with open(json_file, 'w') as ff:
+        json.dump({'stages': stages}, ff, indent=2)
+    print >> sys.stderr, 'Stage profile saved to ' + json_file
+
+def dump_slowest_stage(stats_file, count=25):
+    '''Save the cProfile statistics of the slowest stage and show its most expensive functions
+    :param stats_file: file where to save the statistics (can be loaded with pstats)
+    :param count: number of functions to show
+    '''
+    stages = [stage for stage in profile_stages if stage.get('cprofile')]
+    if not stages:
+        return
+    slowest = max(stages, key=lambda stage: stage['secs'])
+    with open(stats_file, 'wb') as ff:
+        marshal.dump(slowest['cprofile'], ff)
+    print >> sys.stderr
+    print >> sys.stderr, 'cProfile of the slowest stage (%s) saved to %s' % (slowest['name'], stats_file)
+    pstats.Stats(stats_file, stream=sys.stderr).sort_stats('cumulative').print_stats(count)
+
+def report_profile(json_file=None, stats_file=None):
+    '''Report all the stages measured (to stderr)
+    :param json_file: file where to also save the measurements in JSON format
+    :param stats_file: file where to save the cProfile statistics of the slowest stage
+    '''
+    if not profile_stages:
+        return
+    print >> sys.stderr
+    print_profile_report()
+    if json_file:
+        write_profile_json(json_file)
+    if stats_file:
+        dump_slowest_stage(stats_file)
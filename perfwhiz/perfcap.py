@@ -20,12 +20,19 @@
 # A wrapper around the perf tool to capture various data related to context switches and
 # KVM events
 #
+import atexit
+import multiprocessing
 import os
 import sys
 from optparse import OptionParser
 import re
 import subprocess
+import time
+import perf_data_reader
 import perf_formatter
+from perf_profile import enable_profile
+from perf_profile import ProfileStage
+from perf_profile import report_profile
 
 perf_binary = 'perf'
 
@@ -75,23 +82,77 @@ def get_curated_latency_table(opts, table):
                     tname += ' ' * pad_len
                 line = header + tname + trailer
         results.append(line)
+    perf_formatter.save_task_cache()
     return '\n'.join(results)
 
-def perf_record(opts, cs=True, kvm=True):
+def get_record_cmd(opts, cs=True, kvm=True, output=None):
     perf_cmd = [perf_binary, 'record', '-a']
     if cs:
         perf_cmd += ['-e', 'sched:*']
     if kvm:
         perf_cmd += ['-e', 'kvm:*']
+    if output:
+        perf_cmd += ['-o', output]
     perf_cmd += ['sleep', str(opts.seconds)]
+    return perf_cmd
+
+def take_task_snapshot(snapshot_file):
+    '''Take a snapshot of the tasks before the capture starts
+    The snapshot is used to resolve the task names of the capture without accessing /proc
+    :param snapshot_file: file where to store the snapshot for the converter
+    :return: the conversion option that passes the snapshot to the converter
+    '''
+    with ProfileStage('task snapshot') as stage:
+        snapshot = perf_formatter.snapshot_tasks()
+        perf_formatter.write_task_snapshot(snapshot_file, snapshot)
+        perf_formatter.load_task_snapshot(snapshot)
+        stage.rows = len(snapshot['tasks']) + len(snapshot['others'])
+    print 'Snapshot of %d tasks taken (%d qemu threads)' % \
+          (len(snapshot['tasks']) + len(snapshot['others']), len(snapshot['tasks']))
+    return 'tasks=' + snapshot_file
+
+def remove_task_snapshot(snapshot_file):
+    '''Remove the task snapshot file once the conversion is done (the snapshot is saved in the cdict)'''
+    try:
+        os.remove(snapshot_file)
+    except OSError:
+        pass
+
+def perf_record(opts, cs=True, kvm=True):
+    perf_cmd = get_record_cmd(opts, cs, kvm)
     print 'Recording with: ' + ' '.join(perf_cmd)
-    rc = subprocess.call(perf_cmd)
+    with ProfileStage('perf record'):
+        rc = subprocess.call(perf_cmd)
     if rc:
         print 'Error recording traces'
         print 'You might need to run this script as root or with sudo'
         return False
     return True
 
+def perf_record_pipe(opts, script_args):
+    '''Record traces and convert them on the fly, the traces are piped from perf record
+    to perf script and are never stored on disk
+    :param opts: the capture options
+    :param script_args: list of conversion options for mkcdict_perf_script
+    :return: 0 on success, 255 if perf is not built with the python scripting extension
+    '''
+    record_cmd = get_record_cmd(opts, output='-')
+    script_cmd = [perf_binary, 'script', '-s', 'mkcdict_perf_script.py', '-i', '-'] + script_args
+    print 'Recording with: ' + ' '.join(record_cmd) + ' | ' + ' '.join(script_cmd)
+    with ProfileStage('perf record | perf script'):
+        record = subprocess.Popen(record_cmd, stdout=subprocess.PIPE)
+        script = subprocess.Popen(script_cmd, stdin=record.stdout)
+        # only perf script should hold the read end of the pipe so that perf record
+        # gets a SIGPIPE if perf script exits early
+        record.stdout.close()
+        rc = script.wait()
+        record_rc = record.wait()
+    if record_rc and not rc:
+        print 'Error recording traces'
+        print 'You might need to run this script as root or with sudo'
+        rc = record_rc
+    return rc
+
 def get_perf_version():
     cmd = [perf_binary, '--version']
     process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=None)
@@ -116,8 +177,9 @@ def capture_stats(opts, stats_filename):
     # in order to get the task name followed by the pid (compatible wth perf 3.x)
     if perf_version >= "4":
         cmd.append("-p")
-    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=None)
-    results, errors = process.communicate()
+    with ProfileStage('perf sched latency'):
+        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=None)
+        results, errors = process.communicate()
     if errors:
         print 'Error displaying scheduling latency'
     else:
@@ -130,7 +192,8 @@ def capture_stats(opts, stats_filename):
         # need to let the results to be flushed out
         ff.flush()
 
-        rc = subprocess.call([perf_binary, 'kvm', 'stat', 'report'], stdout=ff, stderr=ff)
+        with ProfileStage('perf kvm stat report'):
+            rc = subprocess.call([perf_binary, 'kvm', 'stat', 'report'], stdout=ff, stderr=ff)
         if rc:
             print 'Error displaying kvm stats'
         else:
@@ -138,14 +201,137 @@ def capture_stats(opts, stats_filename):
     os.chmod(stats_filename, 0664)
 
 
+def get_codec(opts):
+    return 'raw' if opts.raw else 'zlib'
+
+def get_script_args(opts):
+    '''Get the conversion options common to all capture modes
+    :return: a list of conversion options for mkcdict_perf_script
+    '''
+    return ['codec=' + get_codec(opts), 'summary_usecs=%d' % (opts.summary * 1000)]
+
+# perf record --switch-output renames every completed segment to <output>.<timestamp>
+segment_re = re.compile('perf\.data\.[0-9]+$')
+
+def convert_segment(args):
+    '''Convert a perf data segment into a cdict file (runs in a worker process)
+    :param args: tuple of perf binary, segment file, cdict file, conversion options, native flag, mapping file
+    :return: the cdict file name or None if the conversion failed
+    '''
+    perf, segment_file, cdict_file, script_args, native, map_file = args
+    script_args = script_args + ['output=' + cdict_file]
+    rc = 255
+    if not native:
+        rc = subprocess.call([perf, 'script', '-s', 'mkcdict_perf_script.py', '-i', segment_file] + script_args)
+    if rc == 255:
+        try:
+            perf_data_reader.convert(segment_file, script_args)
+            rc = 0
+        except ValueError as exc:
+            print '   ERROR: cannot read perf data segment %s: %s' % (segment_file, exc)
+    if rc:
+        return None
+    # the segment is no longer needed
+    os.remove(segment_file)
+    if map_file:
+        perf_formatter.set_cdict_task_map(cdict_file, perf_formatter.read_task_map(map_file))
+    return cdict_file
+
+def capture_segments(opts, run_name):
+    '''Capture traces in segments of opts.segment seconds
+    Every segment is converted by a pool of low priority worker processes while the
+    capture continues, the resulting cdict files are grouped by a manifest file that
+    can be opened as a single cdict file
+    '''
+    if opts.all or opts.stats:
+        print 'Stats capture not supported in segmented mode (requires a single perf data file)'
+    if not (opts.all or opts.switches):
+        return
+    segment_folder = opts.dest_folder + run_name + '.segments'
+    if not os.path.isdir(segment_folder):
+        os.mkdir(segment_folder)
+    snapshot_file = os.path.join(segment_folder, 'perf.tasks')
+    script_args = get_script_args(opts) + [take_task_snapshot(snapshot_file)]
+    record_cmd = get_record_cmd(opts, output=os.path.join(segment_folder, 'perf.data'))
+    record_cmd.insert(2, '--switch-output=%ds' % (opts.segment))
+    print 'Capturing perf data for %d seconds in segments of %d seconds...' % (opts.seconds, opts.segment)
+    print 'Recording with: ' + ' '.join(record_cmd)
+    try:
+        record = subprocess.Popen(record_cmd)
+    except OSError:
+        print 'Error: perf does not seems to be installed'
+        remove_task_snapshot(snapshot_file)
+        return
+    # use a new process for every segment as the converter state is global
+    pool = multiprocessing.Pool(initializer=os.nice, initargs=(10,), maxtasksperchild=1)
+    segments = []
+    results = []
+    with ProfileStage('perf record and convert segments'):
+        while True:
+            # check if the capture is finished before looking for segments to not miss the last one
+            done = record.poll() is not None
+            for name in sorted(os.listdir(segment_folder)):
+                if segment_re.match(name) and name not in segments:
+                    segments.append(name)
+                    cdict_file = os.path.join(segment_folder, '%04d.cdict' % (len(results)))
+                    print 'Converting segment %s to %s' % (name, cdict_file)
+                    results.append(pool.apply_async(convert_segment,
+                                                    [(perf_binary, os.path.join(segment_folder, name), cdict_file,
+                                                      script_args, opts.native, opts.map)]))
+            if done:
+                break
+            time.sleep(0.5)
+    pool.close()
+    if record.returncode:
+        print 'Error recording traces'
+        print 'You might need to run this script as root or with sudo'
+    cdict_files = []
+    # the segments still being converted after the end of the capture
+    with ProfileStage('convert last segments') as stage:
+        for name, result in zip(segments, results):
+            cdict_file = result.get()
+            if cdict_file:
+                cdict_files.append(cdict_file)
+            else:
+                print 'Error converting segment ' + name
+        pool.join()
+        stage.rows = sum(perf_formatter.get_cdict_rows(cdict_file) for cdict_file in cdict_files)
+    remove_task_snapshot(snapshot_file)
+    if cdict_files:
+        perf_formatter.write_cdict_manifest(opts.dest_folder + run_name + '.cdict', cdict_files)
+
 def capture(opts, run_name):
 
+    if opts.segment and not opts.perf_data:
+        capture_segments(opts, run_name)
+        return
+
+    if opts.pipe and not opts.perf_data:
+        capture_pipe(opts, run_name)
+        return
+
     # If this is set we skip the capture
     perf_data_filename = opts.perf_data
+    script_args = get_script_args(opts)
+    snapshot_file = None
     if perf_data_filename:
         print 'Skipping capture, using ' + perf_data_filename
     else:
         # need to capture traces
+        snapshot_file = opts.dest_folder + run_name + '.tasks'
+        script_args.append(take_task_snapshot(snapshot_file))
+    try:
+        record_and_convert(opts, run_name, perf_data_filename, script_args)
+    finally:
+        if snapshot_file:
+            remove_task_snapshot(snapshot_file)
+
+def record_and_convert(opts, run_name, perf_data_filename, script_args):
+    '''Capture the traces (unless a perf data file is provided) and convert them
+    :param perf_data_filename: perf data file to convert instead of capturing (None = capture)
+    :param script_args: conversion options
+    '''
+    if not perf_data_filename:
         print 'Capturing perf data for %d seconds...' % (opts.seconds)
         if not perf_record(opts):
             return
@@ -165,22 +351,69 @@ def capture(opts, run_name):
     if opts.all or opts.switches:
         try:
             cdict_filename = opts.dest_folder + run_name + '.cdict'
-            # try to run this script through the perf tool itself as it is faster
-            rc = subprocess.call([perf_binary, 'script', '-s', 'mkcdict_perf_script.py', '-i', perf_data_filename])
+            rc = 255
+            if not opts.native:
+                with ProfileStage('perf script') as stage:
+                    rc = subprocess.call([perf_binary, 'script', '-s', 'mkcdict_perf_script.py',
+                                          '-i', perf_data_filename] + script_args)
+                    if not rc:
+                        stage.rows = perf_formatter.get_cdict_rows('perf.cdict')
+                if rc == 255:
+                    print 'perf is not built with the python scripting extension, using the built-in reader'
             if rc == 255:
-                print '   ERROR: perf is not built with the python scripting extension - aborting...'
-            else:
-                # success result is in perf.cdict, so need to rename it
-                os.rename('perf.cdict', cdict_filename)
-                os.chmod(cdict_filename, 0664)
-                print 'Created file: ' + cdict_filename
-                # remap the task names if a mapping file was provided
-                if opts.map:
-                    perf_dict = perf_formatter.open_cdict(cdict_filename, opts.map)
-                    perf_formatter.write_cdict(cdict_filename, perf_dict)
+                print 'Converting %s with the built-in perf data reader...' % (perf_data_filename)
+                with ProfileStage('convert') as stage:
+                    try:
+                        perf_data_reader.convert(perf_data_filename, script_args)
+                        rc = 0
+                        stage.rows = perf_formatter.get_cdict_rows('perf.cdict')
+                    except ValueError as exc:
+                        print '   ERROR: cannot read perf data file: ' + str(exc)
+            if not rc:
+                with ProfileStage('save cdict'):
+                    save_cdict(opts, cdict_filename)
         except OSError:
             print 'Error: perf does not seems to be installed'
 
+def capture_pipe(opts, run_name):
+    if opts.all or opts.stats:
+        print 'Stats capture not supported in pipe mode (requires a perf data file)'
+    if not (opts.all or opts.switches):
+        return
+    if opts.native:
+        print 'The built-in perf data reader does not support pipe mode, using perf script'
+    snapshot_file = opts.dest_folder + run_name + '.tasks'
+    script_args = get_script_args(opts) + [take_task_snapshot(snapshot_file)]
+    print 'Capturing and converting perf data for %d seconds...' % (opts.seconds)
+    try:
+        rc = perf_record_pipe(opts, script_args)
+    except OSError:
+        print 'Error: perf does not seems to be installed'
+        return
+    finally:
+        remove_task_snapshot(snapshot_file)
+    if rc == 255:
+        print 'perf is not built with the python scripting extension, pipe mode is not available'
+        print 'Capture without --pipe to use the built-in perf data reader'
+    elif not rc:
+        with ProfileStage('save cdict'):
+            save_cdict(opts, opts.dest_folder + run_name + '.cdict')
+
+def save_cdict(opts, cdict_filename):
+    # success result is in perf.cdict, so need to rename it
+    os.rename('perf.cdict', cdict_filename)
+    os.chmod(cdict_filename, 0664)
+    print 'Created file: ' + cdict_filename
+    # remap the task names if a mapping file was provided
+    if opts.map:
+        remap_cdict(opts, cdict_filename)
+
+def remap_cdict(opts, cdict_filename):
+    # only the mapping table of a v2 cdict file needs to be updated
+    if not perf_formatter.set_cdict_task_map(cdict_filename, perf_formatter.read_task_map(opts.map)):
+        perf_dict = perf_formatter.open_cdict(cdict_filename, opts.map)
+        perf_formatter.write_cdict(cdict_filename, perf_dict, get_codec(opts))
+
 def main():
     parser = OptionParser(usage="usage: %prog [options] [<run-name>]")
 
@@ -224,6 +457,39 @@ def main():
                       help="remap task names from mapping csv file"
                       )
 
+    parser.add_option('--raw', dest='raw',
+                      action='store_true',
+                      default=False,
+                      help='store uncompressed cdict columns (larger file that loads faster, without decompression)')
+
+    parser.add_option('--summary', dest='summary',
+                      action='store',
+                      default=100,
+                      type='int',
+                      help='time granularity of the event summary stored in the cdict file, '
+                           'used by perfmap to generate the basic charts without loading the events '
+                           '(default=100, 0 = no summary)',
+                      metavar='<msec>')
+
+    parser.add_option('--native', dest='native',
+                      action='store_true',
+                      default=False,
+                      help='convert the perf data file with the built-in reader instead of perf script')
+
+    parser.add_option('--pipe', dest='pipe',
+                      action='store_true',
+                      default=False,
+                      help='convert the traces while they are captured without storing a perf data file '
+                           '(requires perf with python scripting, stats are not supported)')
+
+    parser.add_option('--segment', dest='segment',
+                      action='store',
+                      default=0,
+                      type='int',
+                      help='capture in segments of the given duration that are converted while the capture '
+                           'continues (requires perf 4.10 or later, stats are not supported)',
+                      metavar='<seconds>')
+
     parser.add_option('--use-perf', dest='perf',
                       action='store',
                       help='use given perf binary',
@@ -246,8 +512,28 @@ def main():
                       help='OpenStack password',
                       metavar='<password>')
 
+    parser.add_option('--profile', dest='profile',
+                      action='store_true',
+                      default=False,
+                      help='report the wall time, CPU time, peak memory and row count of every stage to stderr')
+
+    parser.add_option('--profile-json', dest='profile_json',
+                      action='store',
+                      help='also save the stage report to the given JSON file (implies --profile)',
+                      metavar='<json file>')
+
+    parser.add_option('--cprofile', dest='cprofile',
+                      action='store',
+                      help='run every stage under cProfile and save the statistics of the slowest stage '
+                           'to the given file (implies --profile)',
+                      metavar='<stats file>')
+
     (opts, args) = parser.parse_args()
 
+    if opts.profile or opts.profile_json or opts.cprofile:
+        enable_profile(bool(opts.cprofile))
+        atexit.register(report_profile, opts.profile_json, opts.cprofile)
+
     if len(args) > 1:
         print 'This script requires 1 argument for the run name (any valid file name without extension)'
         sys.exit(0)
@@ -273,8 +559,7 @@ def main():
         if not opts.map:
             print 'ERROR: remap command requires a csv mapping file (--map)'
             sys.exit(1)
-        perf_dict = perf_formatter.open_cdict(opts.remap, opts.map)
-        perf_formatter.write_cdict(opts.remap, perf_dict)
+        remap_cdict(opts, opts.remap)
         sys.exit(0)
 
     if not (opts.all | opts.switches | opts.stats):
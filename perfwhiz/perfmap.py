@@ -18,9 +18,13 @@
 # ---------------------------------------------------------
 
 
+import atexit
+import multiprocessing
 from optparse import OptionParser
 import os
+import shutil
 import sys
+import tempfile
 import warnings
 import pandas
 from pandas import DataFrame
@@ -28,13 +32,31 @@ import json
 import traceback
 
 from perf_formatter import open_cdict
+from perf_formatter import open_cdict_summary
+from perf_formatter import get_cdict_last_usec
+from perf_formatter import transcode_cdict
 
 from perfmap_common import set_html_file
 from perfmap_common import DfDesc
+from perfmap_common import get_run_name
 from perfmap_common import output_svg_html
+from perfmap_common import get_group_counts
+from perfmap_cache import get_cache_key
+from perfmap_cache import get_cdict_digests
+from perfmap_cache import get_file_digest
+from perfmap_cache import load_result
+from perfmap_cache import save_result
+from perfmap_cache import PERFMAP_CACHE_SIZE
 from perfmap_core import get_coremaps
+from perfmap_core import get_cpu_sw_map
 from perfmap_kvm_exit_types import get_swkvm_data
 from perfmap_sw_kvm_exits import get_sw_kvm_events
+from perfmap_sw_kvm_exits import get_column_buffer
+from perf_profile import add_profile_stages
+from perf_profile import enable_profile
+from perf_profile import get_profile_stages
+from perf_profile import ProfileStage
+from perf_profile import report_profile
 
 from jinja2 import Environment
 from jinja2 import FileSystemLoader
@@ -51,6 +73,11 @@ output_chart = None
 from_time = 0
 # cap input file to first cap_time usec, 0 = unlimited
 cap_time = 0
+# dataframe descriptors shared with the batch worker processes (inherited when the pool is forked)
+batch_dfds = None
+
+# chart types
+CHART_TYPES = ['charts', 'heatmaps']
 
 def get_full_task_name(df, task):
     # if task is a number it is considered to be a pid ID
@@ -94,9 +121,9 @@ def show_successors(df, task, label):
     print 'Successors of %s (%s)' % (task, label)
     print pandas.concat([series_count, series_percent], axis=1)
 
-def set_short_names(dfds):
+def get_short_names(name_list):
     '''
-    Reduce the names of a list of dataframe descriptors to minimal non matching characters
+    Reduce a list of names to minimal non matching characters
     This will basically trim from the start and end all common strings and keep only the
     non matching part of the names.
     Example of names: ../../haswell/h1x216.cdict    ../../haswell/h5x113.cdict
@@ -105,9 +132,8 @@ def set_short_names(dfds):
     must return [1x218, 2x208] must not cut out the trailing 8
 
     '''
-    name_list = [dfd.name for dfd in dfds]
     if len(name_list) < 2:
-        return
+        return list(name_list)
     strip_head = None
     strip_tail = None
     for name in name_list:
@@ -135,20 +161,30 @@ def set_short_names(dfds):
                     strip_tail = name[1 + index:]
                 break
 
-    # strip all names and store in the short_name field
-    for dfd in dfds:
-        dfd.short_name = dfd.name[len(strip_head):]
+    # strip all names
+    short_names = []
+    for name in name_list:
+        short_name = name[len(strip_head):]
         if strip_tail:
-            dfd.short_name = dfd.short_name[:-len(strip_tail)]
+            short_name = short_name[:-len(strip_tail)]
+        short_names.append(short_name)
+    return short_names
 
-def get_info(dfd, label, max_core=32):
+def set_short_names(dfds):
+    '''Reduce the names of a list of dataframe descriptors (see get_short_names)
+    and store them in the short_name field
+    '''
+    for dfd, short_name in zip(dfds, get_short_names([dfd.name for dfd in dfds])):
+        dfd.short_name = short_name
+
+def get_info(window_usec, label, max_core=32):
     # allow at least 32 cores
     if max_core < 32:
         max_core = 32
     # Other misc information in the chart
     return {
         "label": label,
-        "window": "{:,d}".format((dfd.to_usec - dfd.from_usec) / 1000),
+        "window": "{:,d}".format(window_usec / 1000),
         "date": time.strftime("%d-%b-%Y"),    # 01-Jan-2016 format
         "max_cores": max_core,
         "version": __version__
@@ -160,33 +196,216 @@ def get_tpl(tpl_file):
     template_env = Environment(loader=template_loader, trim_blocks=True, lstrip_blocks=True)
     return template_env.get_template(tpl_file)
 
-def create_charts(dfds, cap_time_usec, task_re, label):
-    coremaps, max_core = get_coremaps(dfds, cap_time_usec, task_re)
-    task_list, exit_reason_list, colormap_list = get_swkvm_data(dfds, cap_time_usec, task_re)
-    tpl = get_tpl('perfmap_charts.jinja')
-
-    svg_html = tpl.render(exit_reason_list=str(exit_reason_list),
-                          task_list=task_list,
-                          colormap_list=str(colormap_list),
-                          coremaps=coremaps,
-                          info=get_info(dfds[0], label, max_core))
-    output_svg_html(svg_html, 'charts', task_re)
-
-def create_heatmaps(dfd, cap_time_usec, task_re, label):
-    swk_events = get_sw_kvm_events(dfd, task_re)
+def get_rows(dfds):
+    return sum(len(dfd.df) for dfd in dfds)
+
+def get_charts_data(dfds, cap_time_usec, task_re):
+    '''Get all the data of the basic charts (can be cached)'''
+    with ProfileStage('get_coremaps ' + task_re, get_rows(dfds)):
+        coremaps, max_core = get_coremaps(dfds, cap_time_usec, task_re)
+    with ProfileStage('get_cpu_sw_map ' + task_re, get_rows(dfds)):
+        cpu_sw_map = get_cpu_sw_map(dfds, cap_time_usec, task_re)
+    with ProfileStage('get_swkvm_data ' + task_re, get_rows(dfds)):
+        task_list, exit_reason_list, colormap_list = get_swkvm_data(dfds, task_re, cpu_sw_map)
+    return {'coremaps': coremaps,
+            'max_core': max_core,
+            'task_list': task_list,
+            'exit_reason_list': exit_reason_list,
+            'colormap_list': colormap_list,
+            'window_usec': dfds[0].to_usec - dfds[0].from_usec}
+
+def create_charts(charts_data, task_re, label):
+    with ProfileStage('render charts ' + task_re):
+        tpl = get_tpl('perfmap_charts.jinja')
+
+        svg_html = tpl.render(exit_reason_list=str(charts_data['exit_reason_list']),
+                              task_list=charts_data['task_list'],
+                              colormap_list=str(charts_data['colormap_list']),
+                              coremaps=charts_data['coremaps'],
+                              info=get_info(charts_data['window_usec'], label, charts_data['max_core']))
+    with ProfileStage('write charts ' + task_re):
+        output_svg_html(svg_html, 'charts', task_re)
+
+def get_heatmaps_data(dfd, task_re):
+    '''Get all the data of the heatmaps (can be cached)'''
+    with ProfileStage('get_sw_kvm_events ' + task_re, len(dfd.df)):
+        swk_events = get_sw_kvm_events(dfd, task_re)
+    return {'swk_events': swk_events,
+            'window_usec': dfd.to_usec - dfd.from_usec}
+
+def create_heatmaps(heatmaps_data, task_re, label):
+    with ProfileStage('render heatmaps ' + task_re):
+        swk_events, swk_columns = get_column_buffer(heatmaps_data['swk_events'])
+
+        tpl = get_tpl('perfmap_heatmaps.jinja')
+        # the events description is JSON, the event columns are a binary buffer
+        json_swk = json.dumps(swk_events, separators=(',', ':'))
+        svg_html = tpl.render(swk_events=base64.b64encode(zlib.compress(json_swk)),
+                              swk_columns=base64.b64encode(zlib.compress(swk_columns)),
+                              info=get_info(heatmaps_data['window_usec'], label))
+    with ProfileStage('write heatmaps ' + task_re):
+        output_svg_html(svg_html, 'heatmaps', task_re)
+
+def create_results(kind, results, task_re, label):
+    if kind == 'heatmaps':
+        create_heatmaps(results, task_re, label)
+    else:
+        create_charts(results, task_re, label)
 
-    tpl = get_tpl('perfmap_heatmaps.jinja')
-    json_swk = json.dumps(swk_events, separators=(',', ':'))
-    b64_zlib = base64.b64encode(zlib.compress(json_swk))
-    svg_html = tpl.render(swk_events=b64_zlib,
-                          info=get_info(dfd, label))
-    output_svg_html(svg_html, 'heatmaps', task_re)
+def decode_cdict(args):
+    '''Decode a cdict file into an uncompressed cdict file (process pool worker)
+    :param args: tuple of cdict file name, map file name, from usec, to usec, uncompressed file name
+    :return: the uncompressed cdict file name
+    '''
+    cdict_file, map_file, from_usec, to_usec, raw_file = args
+    transcode_cdict(cdict_file, raw_file, 'raw', map_file, from_usec, to_usec)
+    return raw_file
+
+def get_tmp_folder(cdict_file):
+    '''Get the folder of the temporary uncompressed cdict files
+    The folder of the cdict file is used by default as the system temporary folder is often
+    a tmpfs (backed by memory)
+    :param cdict_file: name of the first cdict file
+    :return: the folder or None to use the system temporary folder
+    '''
+    folder = os.path.dirname(os.path.abspath(cdict_file))
+    return folder if os.access(folder, os.W_OK) else None
+
+def load_cdicts(cdict_files, map_file, from_usec, to_usec, tmp_folder=None):
+    '''Load a list of cdict files
+    When there are more than 1 file, they are decompressed in parallel by a pool of processes into
+    temporary uncompressed cdict files that are then memory mapped by this process
+    (the columns never have to be pickled back from the worker processes)
+    :param tmp_folder: folder of the temporary uncompressed cdict files
+        (default: folder of the first cdict file if writable)
+    :return: a list of perf dicts (1 per cdict file)
+    '''
+    if len(cdict_files) == 1:
+        return [open_cdict(cdict_files[0], map_file, from_usec, to_usec, categorical=True)]
+    tmp_dir = tempfile.mkdtemp(prefix='.perfmap-', dir=tmp_folder or get_tmp_folder(cdict_files[0]))
+    try:
+        args = [(cdict_file, map_file, from_usec, to_usec, os.path.join(tmp_dir, '%d.cdict' % (index)))
+                for index, cdict_file in enumerate(cdict_files)]
+        pool = multiprocessing.Pool(min(len(args), multiprocessing.cpu_count()))
+        try:
+            raw_files = pool.map(decode_cdict, args)
+        finally:
+            pool.close()
+            pool.join()
+        perf_dicts = []
+        for raw_file in raw_files:
+            perf_dicts.append(open_cdict(raw_file, categorical=True))
+            # the file remains mapped after it is removed
+            os.remove(raw_file)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return perf_dicts
+
+def is_summary_window(usecs_range, interval, from_time_usec, to_time_usec):
+    '''Check if a time window can be selected exactly from the cells of a summary
+    The cells aggregate the events of an interval so the window must start and end on
+    cell boundaries (or beyond the events)
+    :param usecs_range: [first, last] usecs of the events of the summary
+    :param interval: interval of the cells in usecs (None if the cells are not on a common time grid)
+    :param from_time_usec: start of the window (0 = first event)
+    :param to_time_usec: end of the window (0 = last event)
+    :return: True if the window only has complete cells
+    '''
+    for bound in [from_time_usec, to_time_usec]:
+        if bound and usecs_range[0] < bound < usecs_range[1] and (not interval or bound % interval):
+            return False
+    return True
+
+def load_summaries(cdict_files, map_file, from_time_usec=0, to_time_usec=0):
+    '''Load the summaries of a list of cdict files
+    :param from_time_usec: start of the requested window (0 = first event)
+    :param to_time_usec: end of the requested window (0 = last event)
+    :return: a list of (perf dict, usecs range) tuples (1 per cdict file)
+        or None if any of the files has no summary or if the requested window
+        does not start and end on the cell boundaries of a summary
+    '''
+    summaries = []
+    for cdict_file in cdict_files:
+        perf_dict, usecs_range, interval = open_cdict_summary(cdict_file, map_file)
+        if perf_dict is None:
+            return None
+        if not is_summary_window(usecs_range, interval, from_time_usec, to_time_usec):
+            print 'The time window does not match the summary interval (%s msec) of %s, loading all the events' % \
+                (interval / 1000.0 if interval else 'unaligned segments', cdict_file)
+            return None
+        summaries.append((perf_dict, usecs_range))
+    return summaries
+
+def fix_task_re(task_re):
+    # A common mistake is to forget the head "." before a star ("*.vcpu0")
+    # Better detect and fix to avoid frustration
+    if task_re.startswith("*"):
+        return "." + task_re
+    return task_re
+
+def read_batch_file(batch_file):
+    '''Read the queries of a batch file
+    Each line has a chart type (charts or heatmaps) followed by a task regex,
+    empty lines and lines starting with # are ignored
+    e.g.:
+        charts .*vcpu0
+        heatmaps CSR.01.vcpu0
+    :param batch_file: name of the batch file
+    :return: a list of (chart type, task regex)
+    '''
+    queries = []
+    with open(batch_file, 'r') as ff:
+        for line in ff:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            kind, _, task_re = line.partition(' ')
+            task_re = task_re.strip()
+            if kind not in CHART_TYPES or not task_re:
+                raise ValueError('Invalid query in %s: %s' % (batch_file, line))
+            queries.append((kind, fix_task_re(task_re)))
+    return queries
+
+def run_query(query):
+    '''Generate the charts of a query from the batch dataframes (can run in a process pool worker)
+    :param query: tuple of chart type, task regex, cache key (None = no cache), label and cache size
+    :return: the stages measured while running the query (see --profile)
+    '''
+    first_stage = len(get_profile_stages())
+    kind, task_re, cache_key, label, cache_size = query
+    if kind == 'heatmaps':
+        results = get_heatmaps_data(batch_dfds[0], task_re)
+    else:
+        results = get_charts_data(batch_dfds, cap_time, task_re)
+    if cache_key:
+        with ProfileStage('save cache ' + task_re):
+            save_result(cache_key, results, cache_size)
+    create_results(kind, results, task_re, label)
+    return get_profile_stages(first_stage)
+
+def run_queries(queries, jobs):
+    '''Generate the charts of a list of queries
+    :param queries: list of queries (see run_query)
+    :param jobs: maximum number of queries processed in parallel
+    '''
+    if jobs > 1 and len(queries) > 1:
+        pool = multiprocessing.Pool(min(jobs, len(queries)))
+        try:
+            for stages in pool.map(run_query, queries):
+                add_profile_stages(stages)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for query in queries:
+            run_query(query)
 
 # ---------------------------------- MAIN -----------------------------------------
 
 def main():
     global from_time
     global cap_time
+    global batch_dfds
 
     # Suppress future warnings
     warnings.simplefilter(action='ignore', category=FutureWarning)
@@ -195,8 +414,10 @@ def main():
 
     parser.add_option("-t", "--task",
                       dest="task",
+                      action="append",
                       metavar="task name (regex)",
-                      help="selected task(s) (regex on task name)"
+                      help="selected task(s) (regex on task name), can be repeated to generate the charts "
+                           "of several selections from a single load of the cdict files"
                       )
     parser.add_option("--label",
                       dest="label",
@@ -220,6 +441,24 @@ def main():
                       action="store_true",
                       help="generate heatmap charts only (default: generate basic charts only)"
                       )
+    parser.add_option("--charts",
+                      dest="charts",
+                      action="store_true",
+                      help="generate the basic charts, to combine with --heatmaps to generate both"
+                      )
+    parser.add_option("--batch",
+                      dest="batch",
+                      metavar="batch file",
+                      help="file with one query per line: chart type (charts or heatmaps) and task regex, "
+                           "e.g. 'heatmaps .*vcpu0' (in addition to the queries of the --task options)"
+                      )
+    parser.add_option("-j", "--jobs",
+                      dest="jobs",
+                      type="int",
+                      default=1,
+                      metavar="<count>",
+                      help="number of queries processed in parallel (default=1)"
+                      )
     parser.add_option("--headless",
                       dest="headless",
                       action="store_true",
@@ -255,8 +494,57 @@ def main():
                       default=False,
                       help="only show list of all tasks with event count"
                       )
+    parser.add_option("--no-summary",
+                      dest="no_summary",
+                      action="store_true",
+                      default=False,
+                      help="always load all the events (by default the basic charts and the list of tasks "
+                           "are generated from the summary stored in the cdict files if available)"
+                      )
+    parser.add_option("--no-cache",
+                      dest="no_cache",
+                      action="store_true",
+                      default=False,
+                      help="do not use the cache of chart data (by default the chart data derived from "
+                           "the same cdict files and options is reused from ~/.cache/perfwhiz/perfmap)"
+                      )
+    parser.add_option("--cache-size",
+                      dest="cache_size",
+                      type="int",
+                      default=PERFMAP_CACHE_SIZE,
+                      metavar="<MB>",
+                      help="size budget of the cache of chart data (default=%d)" % (PERFMAP_CACHE_SIZE)
+                      )
+    parser.add_option("--tmp-dir",
+                      dest="tmp_dir",
+                      metavar="dir pathname",
+                      help="folder of the temporary uncompressed files used to load several cdict files "
+                           "(default: folder of the first cdict file)"
+                      )
+    parser.add_option("--profile",
+                      dest="profile",
+                      action="store_true",
+                      default=False,
+                      help="report the wall time, CPU time, peak memory and row count of every stage to stderr"
+                      )
+    parser.add_option("--profile-json",
+                      dest="profile_json",
+                      metavar="json file",
+                      help="also save the stage report to the given JSON file (implies --profile)"
+                      )
+    parser.add_option("--cprofile",
+                      dest="cprofile",
+                      metavar="stats file",
+                      help="run every stage under cProfile and save the statistics of the slowest stage "
+                           "to the given file (implies --profile, slows down all the stages)"
+                      )
     (options, args) = parser.parse_args()
 
+    if options.profile or options.profile_json or options.cprofile:
+        enable_profile(bool(options.cprofile))
+        # also report when exiting early (e.g. --list)
+        atexit.register(report_profile, options.profile_json, options.cprofile)
+
     if options.from_time:
         from_time = int(options.from_time) * 1000
     if options.cap_time:
@@ -272,6 +560,18 @@ def main():
             print('Invalid output directory: ' + options.output_dir)
             sys.exit(1)
 
+    # list of (chart type, task regex)
+    queries = []
+    kinds = []
+    if options.charts or not options.heatmaps:
+        kinds.append('charts')
+    if options.heatmaps:
+        kinds.append('heatmaps')
+    for task_re in options.task or []:
+        queries.extend([(kind, fix_task_re(task_re)) for kind in kinds])
+    if options.batch:
+        queries.extend(read_batch_file(options.batch))
+
     dfds = []
     cdict_files = args
     if len(cdict_files):
@@ -281,16 +581,79 @@ def main():
             html_filename = cdict_files[0]
     else:
         html_filename = cdict_files[0] if len(cdict_files) else 'perfwhiz'
-    set_html_file(html_filename, options.headless, options.label, options.output_dir)
+    # the output files of different queries must have different names
+    set_html_file(html_filename, options.headless, options.label, options.output_dir,
+                  len(set(task_re for _, task_re in queries)) > 1)
+
+    if not options.label:
+        if len(cdict_files) > 1:
+            options.label = 'diff'
+        else:
+            options.label = os.path.splitext(os.path.basename(cdict_files[0]))[0]
+
+    # the basic charts and the task list only need the event aggregates of the summaries
+    # (all the events are loaded if any query needs them)
+    use_summary = not (options.no_summary or options.successor_of_task or
+                       any(kind == 'heatmaps' for kind, _ in queries))
+    use_cache = not (options.no_cache or options.list or options.successor_of_task)
+    if use_cache:
+        # the input files are only digested once for all the queries
+        with ProfileStage('digest inputs'):
+            cdict_digests = get_cdict_digests(cdict_files)
+            map_digest = get_file_digest(options.map) if options.map else None
+    # queries that are not in the cache, see run_query
+    pending = []
+    for kind, task_re in queries:
+        cache_key = None
+        if use_cache:
+            # all the options that change the chart data
+            cache_key = get_cache_key(kind, cdict_digests, map_digest,
+                                      {'runs': get_short_names([get_run_name(cdict_file)
+                                                                for cdict_file in cdict_files]),
+                                       'task': task_re,
+                                       'from': from_time,
+                                       'cap': cap_time,
+                                       'merge_sys_tasks': bool(options.merge_sys_tasks),
+                                       'append_tid': bool(options.append_tid),
+                                       'summary': use_summary})
+            with ProfileStage('load cache ' + task_re):
+                results = load_result(cache_key)
+            if results:
+                print 'Using cached chart data for ' + task_re
+                create_results(kind, results, task_re, options.label)
+                continue
+        pending.append((kind, task_re, cache_key, options.label, options.cache_size))
+    if queries and not pending and not (options.list or options.successor_of_task):
+        return
 
     # get smallest capture window of all cdicts
     min_cap_usec = 0
-    for cdict_file in cdict_files:
-        perf_dict = open_cdict(cdict_file, options.map)
-        df = DataFrame(perf_dict)
-        dfd = DfDesc(cdict_file, df, options.merge_sys_tasks, options.append_tid)
-        dfds.append(dfd)
-        last_usec = df['usecs'].iloc[-1]
+    summaries = None
+    with ProfileStage('load') as stage:
+        if use_summary:
+            summaries = load_summaries(cdict_files, options.map, from_time, cap_time)
+        if summaries:
+            print 'Using the summaries of the cdict files'
+            perf_dicts = [perf_dict for perf_dict, _ in summaries]
+            usecs_ranges = [usecs_range for _, usecs_range in summaries]
+            last_usecs = [None] * len(perf_dicts)
+        else:
+            # only decode the parts of the cdict files that overlap the requested window
+            perf_dicts = load_cdicts(cdict_files, options.map, from_time, cap_time, options.tmp_dir)
+            usecs_ranges = [None] * len(perf_dicts)
+            # the last decoded chunk is not the end of the capture if the window ends before it
+            last_usecs = [get_cdict_last_usec(cdict_file) if cap_time else None for cdict_file in cdict_files]
+        for cdict_file, perf_dict, usecs_range, last_usec in zip(cdict_files, perf_dicts, usecs_ranges, last_usecs):
+            # avoid copying the columns (which can be backed by a memory mapped cdict file)
+            df = DataFrame(perf_dict, copy=False)
+            if df.empty:
+                print 'Error: no events in the requested time window in ' + cdict_file
+                sys.exit(2)
+            dfds.append(DfDesc(cdict_file, df, options.merge_sys_tasks, options.append_tid, usecs_range,
+                               last_usec))
+        stage.rows = get_rows(dfds)
+    for dfd in dfds:
+        last_usec = dfd.get_last_usec()
         if min_cap_usec == 0:
             min_cap_usec = last_usec
         else:
@@ -303,8 +666,10 @@ def main():
         cap_time = min_cap_usec
 
     # normalize all dataframes
-    for dfd in dfds:
-        dfd.normalize(from_time, cap_time)
+    with ProfileStage('normalize') as stage:
+        for dfd in dfds:
+            dfd.normalize(from_time, cap_time)
+        stage.rows = get_rows(dfds)
 
     # at this point some cdict entries may have "missing" data
     # if the requested cap_time is > the cdict cap time
@@ -313,17 +678,11 @@ def main():
     # reduce all names to minimize the length of the cdict file name
     set_short_names(dfds)
 
-    if not options.label:
-        if len(dfds) > 1:
-            options.label = 'diff'
-        else:
-            options.label = os.path.splitext(os.path.basename(cdict_file))[0]
-
     if options.list:
         print 'List of tids and task names sorted by context switches and kvm event count'
         for dfd in dfds:
             print dfd.name + ':'
-            res = dfd.df.groupby(['pid', 'task_name']).size()
+            res = get_group_counts(dfd.df.groupby(['pid', 'task_name'], observed=True), dfd.df)
             res.sort_values(ascending=False, inplace=True)
             pandas.set_option('display.max_rows', len(res))
             print res
@@ -336,23 +695,17 @@ def main():
         sys.exit(0)
 
     # These options can be cumulative and all require a --task parameter to select tasks
-    if not options.task:
-        print '--task <task_regex> is required'
+    if not queries:
+        print '--task <task_regex> or --batch <batch_file> is required'
         sys.exit(1)
-    # A common mistake is to forget the head "." before a star ("*.vcpu0")
-    # Better detect and fix to avoid frustration
-    if options.task.startswith("*"):
-        options.task = "." + options.task
 
     # create heatmaps only if one cdict was given
-    if options.heatmaps:
-        if len(dfds) == 1:
-            create_heatmaps(dfds[0], cap_time, options.task, options.label)
-        else:
-            print 'Error: --heat-maps requires 1 cdict file only'
-            sys.exit(1)
-    else:
-        create_charts(dfds, cap_time, options.task, options.label)
+    if len(dfds) > 1 and any(kind == 'heatmaps' for kind, _, _, _, _ in pending):
+        print 'Error: --heat-maps requires 1 cdict file only'
+        sys.exit(1)
+    # all the queries share the same dataframes
+    batch_dfds = dfds
+    run_queries(pending, options.jobs)
 
 if __name__ == '__main__':
     try:
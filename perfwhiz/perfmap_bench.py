@@ -0,0 +1,342 @@
+#!/usr/bin/env python
+# Copyright 2015 Cisco Systems, Inc.  All rights reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+
+#
+# Benchmark of the perfmap pipeline on synthetic cdict files
+#
+# Generates cdict files with a configurable number of cores, tasks, VMs, event rate,
+# kvm exit reason mix and event duration, then measures the elapsed time, cpu time and
+# peak memory of every stage of perfmap for each file:
+#   open_cdict, DfDesc, normalize, get_coremaps, get_cpu_sw_map, get_swkvm_data, get_sw_kvm_events
+# Each file is benchmarked in a new process so that the memory measurements of a file
+# are not affected by the previous ones. The results can be saved as JSON to compare runs.
+#
+# Usage: python perfmap_bench.py [options] [<cdict_file>...]
+# (benchmarks the given cdict files instead of synthetic ones if any)
+#
+import json
+import multiprocessing
+from optparse import OptionParser
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import zlib
+
+import numpy as np
+import pandas
+from pandas import DataFrame
+
+from perf_formatter import align
+from perf_formatter import CdictWriter
+from perf_formatter import CDICT_CHUNK_ROWS
+from perf_formatter import CDICT_CODE_DTYPE
+from perf_formatter import CDICT_COLUMNS
+from perf_formatter import CDICT_NONE_CODE
+from perf_formatter import open_cdict
+from perf_profile import get_peak_rss
+from perf_profile import reset_peak_rss
+from perfmap_common import DfDesc
+from perfmap_core import get_coremaps
+from perfmap_core import get_cpu_sw_map
+from perfmap_kvm_exit_types import get_swkvm_data
+from perfmap_sw_kvm_exits import get_sw_kvm_events
+
+# event names in the order of their code in the synthetic cdict files
+EVENTS = ['sched__sched_switch', 'sched__sched_stat_sleep', 'kvm_exit', 'kvm_entry']
+# event mix of the vcpu tasks and of the other tasks (probability of each event)
+VCPU_EVENT_MIX = [0.1, 0.05, 0.425, 0.425]
+TASK_EVENT_MIX = [0.7, 0.3, 0, 0]
+# default kvm exit reason mix (exit reason:weight)
+DEFAULT_EXIT_MIX = '1:25,12:20,28:5,32:15,44:10,48:20,56:5'
+
+def parse_count(count):
+    '''Parse a count with an optional k, M or G suffix (e.g. 10M)'''
+    multipliers = {'k': 1000, 'M': 1000000, 'G': 1000000000}
+    if count[-1] in multipliers:
+        return int(float(count[:-1]) * multipliers[count[-1]])
+    return int(count)
+
+def parse_exit_mix(exit_mix):
+    '''Parse an exit reason mix
+    :param exit_mix: comma separated list of <exit reason>:<weight>
+    :return: a tuple of the list of exit reasons and the array of their probabilities
+    '''
+    reasons = []
+    weights = []
+    for item in exit_mix.split(','):
+        reason, _, weight = item.partition(':')
+        reasons.append(int(reason))
+        weights.append(float(weight or 1))
+    weights = np.array(weights)
+    return reasons, weights / weights.sum()
+
+def get_tasks(opts):
+    '''Get the tasks of a synthetic capture
+    :return: a tuple of the list of task names, array of pids, array of vcpu flags and
+        array of pinned cpus (-1 if not pinned)
+    '''
+    names = []
+    pids = []
+    pinned = []
+    for cpu in range(opts.cores):
+        names.append('ksoftirqd/%d' % (cpu))
+        pids.append(10 + cpu)
+        pinned.append(cpu)
+    for index in range(opts.tasks):
+        names.append('task%d' % (index))
+        pids.append(1000 + index)
+        pinned.append(-1)
+    vcpu = [False] * len(names)
+    for vm in range(opts.vms):
+        names.append('vm%02d.emulator' % (vm))
+        pids.append(20000 + vm * 100)
+        pinned.append(-1)
+        vcpu.append(False)
+        for index in range(opts.vcpus):
+            names.append('vm%02d.vcpu%d' % (vm, index))
+            pids.append(20000 + vm * 100 + 1 + index)
+            # vcpus are pinned round robin
+            pinned.append((vm * opts.vcpus + index) % opts.cores)
+            vcpu.append(True)
+    return names, np.array(pids), np.array(vcpu), np.array(pinned)
+
+def generate_chunk(rng, opts, tasks, reasons, reason_probs, first_usecs, rows):
+    '''Generate the columns of a chunk of synthetic events
+    :return: a dict of column arrays (string columns are codes into the value tables)
+    '''
+    names, pids, vcpu, pinned = tasks
+    task = rng.randint(0, len(names), rows)
+    # events of vcpu tasks include kvm exits and entries
+    mixes = np.cumsum([TASK_EVENT_MIX, VCPU_EVENT_MIX], axis=1)
+    draw = rng.random_sample(rows)
+    event = np.where(vcpu[task],
+                     np.searchsorted(mixes[1], draw, side='right'),
+                     np.searchsorted(mixes[0], draw, side='right'))
+    event = np.minimum(event, len(EVENTS) - 1)
+    cpu = np.where(pinned[task] >= 0, pinned[task], rng.randint(0, opts.cores, rows))
+    usecs = first_usecs + np.cumsum(rng.exponential(1000000.0 / opts.rate, rows)).astype(np.int64)
+    duration = rng.exponential(opts.duration, rows).astype(np.int64)
+    # the next task of a switch is any task, the next_comm of a kvm exit is the exit reason
+    # (the exit reasons are stored after the task names in the next_comm value table)
+    next_task = rng.randint(0, len(names), rows)
+    is_switch = event == 0
+    is_exit = event == 2
+    next_comm = np.full(rows, CDICT_NONE_CODE, dtype=np.int64)
+    next_comm[is_switch] = next_task[is_switch]
+    next_comm[is_exit] = len(names) + rng.choice(len(reasons), int(is_exit.sum()), p=reason_probs)
+    return {'event': event,
+            'cpu': cpu,
+            'usecs': usecs,
+            'pid': pids[task],
+            'task_name': task,
+            'duration': duration,
+            'next_pid': np.where(is_switch, pids[next_task], 0),
+            'next_comm': next_comm}
+
+def generate_cdict(cdict_file, rows, opts):
+    '''Write a synthetic cdict file
+    The chunks are encoded directly from the generated codes (no per value encoding)
+    :param cdict_file: name of the cdict file
+    :param rows: number of events
+    :param opts: generator options (cores, tasks, vms, vcpus, rate, exit_mix, duration, seed...)
+    :return: the size of the file in bytes
+    '''
+    rng = np.random.RandomState(opts.seed)
+    tasks = get_tasks(opts)
+    names = tasks[0]
+    reasons, reason_probs = parse_exit_mix(opts.exit_mix)
+    writer = CdictWriter(cdict_file, opts.codec, opts.summary * 1000)
+    dtypes = dict(CDICT_COLUMNS)
+    writer.columns = [[name, dtypes[name]] for name in sorted(dtypes)]
+    writer.tables = {'event': list(EVENTS), 'task_name': list(names), 'next_comm': list(names) + reasons}
+    writer.metadata = {'synthetic': dict((name, getattr(opts, name))
+                                         for name in ['cores', 'tasks', 'vms', 'vcpus', 'rate',
+                                                      'exit_mix', 'duration', 'seed'])}
+    first_usecs = 0
+    for start in xrange(0, rows, opts.chunk_rows):
+        chunk_rows = min(opts.chunk_rows, rows - start)
+        chunk = generate_chunk(rng, opts, tasks, reasons, reason_probs, first_usecs, chunk_rows)
+        first_usecs = int(chunk['usecs'][-1])
+        if writer.summary:
+            writer.summary.add_chunk(get_chunk_values(chunk, writer.tables))
+        columns = []
+        buffers = []
+        offset = 0
+        for name, dtype in writer.columns:
+            buf = chunk[name].astype(CDICT_CODE_DTYPE if dtype == 'str' else dtype).tostring()
+            if opts.codec == 'zlib':
+                buf = zlib.compress(buf)
+            columns.append([name, dtype, offset, len(buf)])
+            buffers.append([buf])
+            offset = align(offset + len(buf))
+        # the value tables are complete from the first chunk
+        new_values = writer.tables if not start else {}
+        writer.write_chunk(chunk_rows, [int(chunk['usecs'][0]), first_usecs], columns, new_values, buffers)
+    return writer.close()
+
+def get_chunk_values(chunk, tables):
+    '''Get the values of the string columns of a generated chunk (for the summary)'''
+    values = dict(chunk)
+    for name, table in tables.items():
+        objects = np.empty(len(table) + 1, dtype=object)
+        objects[:-1] = table
+        # the None code maps to the last entry
+        values[name] = objects[np.where(chunk[name] == CDICT_NONE_CODE, len(table), chunk[name])]
+    return values
+
+def run_stages(cdict_file, task_re):
+    '''Run and measure all the stages of perfmap on a cdict file (runs in a worker process)
+    :return: a list of stage measurements
+    '''
+    stages = []
+    state = {}
+
+    def run_stage(name, func, *args):
+        # the stages print progress and warnings
+        stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+        reset_peak_rss()
+        start_cpu = time.clock()
+        start = time.time()
+        try:
+            result = func(*args)
+        finally:
+            elapsed = time.time() - start
+            cpu = time.clock() - start_cpu
+            sys.stdout.close()
+            sys.stdout = stdout
+        dfd = result if isinstance(result, DfDesc) else state.get('dfd')
+        rows = len(dfd.df) if dfd else len(result['usecs'])
+        stages.append({'name': name,
+                       'secs': round(elapsed, 3),
+                       'cpu_secs': round(cpu, 3),
+                       'peak_rss_mb': round(get_peak_rss() / 1000.0, 1),
+                       'rows': rows})
+        return result
+
+    perf_dict = run_stage('open_cdict', open_cdict, cdict_file, None, 0, 0, True)
+    state['dfd'] = run_stage('DfDesc', lambda columns: DfDesc(cdict_file, DataFrame(columns, copy=False)),
+                             perf_dict)
+    del perf_dict
+    dfd = state['dfd']
+    cap_time = dfd.get_last_usec()
+    run_stage('normalize', dfd.normalize, 0, cap_time)
+    run_stage('get_coremaps', get_coremaps, [dfd], cap_time, task_re)
+    cpu_sw_map = run_stage('get_cpu_sw_map', get_cpu_sw_map, [dfd], cap_time, task_re)
+    run_stage('get_swkvm_data', get_swkvm_data, [dfd], task_re, cpu_sw_map)
+    run_stage('get_sw_kvm_events', get_sw_kvm_events, dfd, task_re)
+    return stages
+
+def benchmark_cdict(cdict_file, task_re):
+    '''Run all the stages on a cdict file in a new process
+    :return: a list of stage measurements
+    '''
+    pool = multiprocessing.Pool(1, maxtasksperchild=1)
+    try:
+        return pool.apply(run_stages, (cdict_file, task_re))
+    finally:
+        pool.close()
+        pool.join()
+
+def print_stages(stages):
+    print '  %-20s %10s %10s %12s %12s' % ('stage', 'secs', 'cpu secs', 'peak MB', 'rows')
+    for stage in stages:
+        print '  %-20s %10.3f %10.3f %12.1f %12d' % (stage['name'], stage['secs'], stage['cpu_secs'],
+                                                     stage['peak_rss_mb'], stage['rows'])
+
+def main():
+    parser = OptionParser(usage="usage: %prog [options] [<cdict_file>...]")
+    parser.add_option("--rows", dest="rows",
+                      default="1M,10M",
+                      metavar="<counts>",
+                      help="comma separated list of synthetic cdict sizes in events, e.g. 1M,10M,100M "
+                           "(default=1M,10M)")
+    parser.add_option("--cores", dest="cores", type="int", default=32, metavar="<count>",
+                      help="number of cores (default=32)")
+    parser.add_option("--tasks", dest="tasks", type="int", default=200, metavar="<count>",
+                      help="number of non VM tasks (default=200)")
+    parser.add_option("--vms", dest="vms", type="int", default=10, metavar="<count>",
+                      help="number of VMs (default=10)")
+    parser.add_option("--vcpus", dest="vcpus", type="int", default=2, metavar="<count>",
+                      help="number of vcpus per VM (default=2)")
+    parser.add_option("--rate", dest="rate", type="int", default=1000000, metavar="<events/sec>",
+                      help="average event rate (default=1000000)")
+    parser.add_option("--exit-mix", dest="exit_mix", default=DEFAULT_EXIT_MIX, metavar="<mix>",
+                      help="kvm exit reason mix as a list of <exit reason>:<weight> (default=%s)" %
+                           (DEFAULT_EXIT_MIX))
+    parser.add_option("--duration", dest="duration", type="int", default=50, metavar="<usec>",
+                      help="average event duration (default=50)")
+    parser.add_option("--seed", dest="seed", type="int", default=1, metavar="<seed>",
+                      help="random seed (default=1)")
+    parser.add_option("--raw", dest="codec", action="store_const", const="raw", default="zlib",
+                      help="store uncompressed cdict columns")
+    parser.add_option("--summary", dest="summary", type="int", default=0, metavar="<msec>",
+                      help="time granularity of the summary stored in the synthetic cdict files "
+                           "(default=0, no summary)")
+    parser.add_option("--chunk-rows", dest="chunk_rows", type="int", default=CDICT_CHUNK_ROWS,
+                      metavar="<rows>",
+                      help="number of rows per cdict chunk (default=%d)" % (CDICT_CHUNK_ROWS))
+    parser.add_option("-t", "--task", dest="task", default=".*vcpu0", metavar="<regex>",
+                      help="task regex of the chart stages (default=.*vcpu0)")
+    parser.add_option("--keep-dir", dest="keep_dir", metavar="<dir>",
+                      help="write the synthetic cdict files to this folder and keep them "
+                           "(default: temporary folder)")
+    parser.add_option("--json", dest="json", metavar="<file>",
+                      help="save the results to a JSON file")
+    (opts, args) = parser.parse_args()
+
+    results = {'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+               'host': platform.node(),
+               'python': platform.python_version(),
+               'numpy': np.__version__,
+               'pandas': pandas.__version__,
+               'task': opts.task,
+               'runs': []}
+    work_dir = opts.keep_dir or tempfile.mkdtemp(prefix='perfmap-bench-')
+    try:
+        if args:
+            cdict_files = [(cdict_file, None) for cdict_file in args]
+        else:
+            cdict_files = [(os.path.join(work_dir, 'synthetic-%s.cdict' % (rows)), parse_count(rows))
+                           for rows in opts.rows.split(',')]
+        for cdict_file, rows in cdict_files:
+            run = {'cdict': cdict_file}
+            if rows:
+                print 'Generating %s (%d events)...' % (cdict_file, rows)
+                start = time.time()
+                generate_cdict(cdict_file, rows, opts)
+                run['generate_secs'] = round(time.time() - start, 3)
+                run['generator'] = dict((name, getattr(opts, name))
+                                        for name in ['cores', 'tasks', 'vms', 'vcpus', 'rate', 'exit_mix',
+                                                     'duration', 'seed', 'codec', 'summary', 'chunk_rows'])
+            run['size'] = os.path.getsize(cdict_file)
+            run['stages'] = benchmark_cdict(cdict_file, opts.task)
+            print '%s (%d bytes):' % (cdict_file, run['size'])
+            print_stages(run['stages'])
+            results['runs'].append(run)
+    finally:
+        if not opts.keep_dir:
+            shutil.rmtree(work_dir)
+    if opts.json:
+        with open(opts.json, 'w') as ff:
+            json.dump(results, ff, indent=4, sort_keys=True)
+        print 'Results saved to ' + opts.json
+
+if __name__ == '__main__':
+    main()
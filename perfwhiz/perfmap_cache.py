@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+# Copyright 2015 Cisco Systems, Inc.  All rights reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+#
+# ---------------------------------------------------------
+
+# Cache of the results derived from cdict files by perfmap (chart and heatmap data)
+#
+# Every result is stored in its own file named after a key that is the digest of:
+# - the content of the cdict files (see get_cdict_digest) and of the mapping file
+# - all the options that change the result (run names, task regex, time window, task name options...)
+# The least recently used results are removed when the cache is larger than its size budget.
+# The digests of the cdict files are also kept in the cache so that the content of a file
+# is only hashed again when its size, modification time, inode or footer change.
+
+import cPickle as pickle
+import hashlib
+import json
+import os
+import time
+
+from perf_formatter import get_cdict_digest
+from perf_formatter import get_cdict_identity
+
+PERFMAP_CACHE_DIR = os.path.expanduser('~/.cache/perfwhiz/perfmap')
+# default size budget of the cache in MB
+PERFMAP_CACHE_SIZE = 512
+# version of the cached results, to change whenever the format of a result changes
+PERFMAP_CACHE_VERSION = 1
+# digests of the cdict files indexed by the digest of their identity (see get_cdict_digests)
+PERFMAP_DIGEST_FILE = 'digests.json'
+# maximum number of cdict digests remembered
+PERFMAP_MAX_DIGESTS = 1024
+
+def get_file_digest(file_name):
+    digest = hashlib.sha1()
+    with open(file_name, 'rb') as ff:
+        for block in iter(lambda: ff.read(1024 * 1024), ''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def load_digests():
+    try:
+        with open(os.path.join(PERFMAP_CACHE_DIR, PERFMAP_DIGEST_FILE), 'r') as ff:
+            return json.load(ff)
+    except Exception:
+        # missing or invalid digest file
+        return {}
+
+def save_digests(digests):
+    '''Save the digests of the cdict files, only the most recently used ones are kept'''
+    if len(digests) > PERFMAP_MAX_DIGESTS:
+        recent = sorted(digests.items(), key=lambda item: item[1][1])[-PERFMAP_MAX_DIGESTS:]
+        digests = dict(recent)
+    try:
+        if not os.path.isdir(PERFMAP_CACHE_DIR):
+            os.makedirs(PERFMAP_CACHE_DIR)
+        digest_file = os.path.join(PERFMAP_CACHE_DIR, PERFMAP_DIGEST_FILE)
+        tmp_file = '%s.%d' % (digest_file, os.getpid())
+        with open(tmp_file, 'w') as ff:
+            json.dump(digests, ff)
+        os.rename(tmp_file, digest_file)
+    except (IOError, OSError) as exc:
+        print 'Warning: cannot save the cdict digests in the cache: ' + str(exc)
+
+def get_cdict_digests(cdict_files):
+    '''Get the digests of the content of a list of cdict files
+    The content of a file is only hashed when its identity (path, size, modification time,
+    inode and footer, see get_cdict_identity) is not known yet
+    :param cdict_files: list of cdict file names
+    :return: the list of digests (see get_cdict_digest)
+    '''
+    digests = load_digests()
+    result = []
+    for cdict_file in cdict_files:
+        identity = hashlib.sha1(json.dumps(get_cdict_identity(cdict_file))).hexdigest()
+        if identity in digests:
+            digest = digests[identity][0]
+        else:
+            digest = get_cdict_digest(cdict_file)
+        # the time of use gives the least recently used digests
+        digests[identity] = [digest, time.time()]
+        result.append(digest)
+    save_digests(digests)
+    return result
+
+def get_cache_key(kind, cdict_digests, map_digest, params):
+    '''Get the cache key of a result
+    :param kind: type of result ('charts' or 'heatmaps')
+    :param cdict_digests: digests of the cdict files the result is derived from (see get_cdict_digests)
+    :param map_digest: digest of the mapping file (see get_file_digest, None if no mapping file)
+    :param params: dict of all other parameters that change the result (must be json serializable)
+    :return: the key as an hex string
+    '''
+    # the file names are not part of the key (the run names in the results must be in params)
+    key = {'version': PERFMAP_CACHE_VERSION,
+           'kind': kind,
+           'cdicts': cdict_digests,
+           'map': map_digest,
+           'params': params}
+    return hashlib.sha1(json.dumps(key, sort_keys=True)).hexdigest()
+
+def get_cache_file(key):
+    return os.path.join(PERFMAP_CACHE_DIR, key + '.result')
+
+def load_result(key):
+    '''Load a result from the cache
+    :param key: the cache key (see get_cache_key)
+    :return: the result or None if not in the cache
+    '''
+    cache_file = get_cache_file(key)
+    try:
+        with open(cache_file, 'rb') as ff:
+            result = pickle.load(ff)
+        # the modification time gives the least recently used results
+        os.utime(cache_file, None)
+        return result
+    except Exception:
+        # missing or invalid cache file
+        return None
+
+def save_result(key, result, max_size=PERFMAP_CACHE_SIZE):
+    '''Store a result in the cache and evict the least recently used results
+    :param key: the cache key (see get_cache_key)
+    :param result: the result to store (must be picklable)
+    :param max_size: size budget of the cache in MB
+    '''
+    try:
+        if not os.path.isdir(PERFMAP_CACHE_DIR):
+            os.makedirs(PERFMAP_CACHE_DIR)
+        cache_file = get_cache_file(key)
+        tmp_file = '%s.%d' % (cache_file, os.getpid())
+        with open(tmp_file, 'wb') as ff:
+            pickle.dump(result, ff, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_file, cache_file)
+        evict_results(max_size * 1000000)
+    except (IOError, OSError, pickle.PicklingError) as exc:
+        print 'Warning: cannot save the result in the cache: ' + str(exc)
+
+def evict_results(max_bytes):
+    '''Remove the least recently used results until the cache fits in a size budget
+    :param max_bytes: size budget in bytes
+    '''
+    entries = []
+    for name in os.listdir(PERFMAP_CACHE_DIR):
+        if name.endswith('.result'):
+            path = os.path.join(PERFMAP_CACHE_DIR, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                # removed by a concurrent run
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        total -= size
@@ -16,21 +16,23 @@
 #
 # ---------------------------------------------------------
 import os
+import pandas
 import webbrowser
 
-def set_html_file(cdict_file, headless, label, output_dir):
+def set_html_file(cdict_file, headless, label, output_dir, append_task_re=False):
     '''Sets the final html file name prefix and output directory
     if output_dir is None then use same output directory as cdict_file (can be relative)
     else use that directory
 
     prefix is set as following:
     if label is None use cdict basename, remove the .cdict extension and append the task_re
-    else use label as prefix and do not append the task_re
+    else use label as prefix and do not append the task_re (unless append_task_re is True)
 
     :param cdict_file: e.g. ../../perf.cdict
     :param headless:
     :param label: will replace all space with _
     :param output_dir:
+    :param append_task_re: always append the task_re (e.g. several task_re with the same label)
     :return:
     '''
     global headless_mode
@@ -42,7 +44,7 @@ def set_html_file(cdict_file, headless, label, output_dir):
     global ignore_task_re
 
     if label:
-        ignore_task_re = True
+        ignore_task_re = not append_task_re
         output_file_base = label.replace(' ', '-')
     else:
         ignore_task_re = False
@@ -63,6 +65,18 @@ def get_time_span_usec(df):
     max_usec = df['usecs'].iloc[-1]
     return max_usec - min_usec
 
+def get_group_counts(gb, df):
+    '''Get the number of events in every group of a group by
+    The rows of a summary dataframe are aggregates of events with the number of events
+    in the count column
+    :param gb: the group by
+    :param df: the grouped dataframe
+    :return: a series of event counts indexed by group
+    '''
+    if 'count' in df:
+        return gb['count'].sum()
+    return gb.size()
+
 # For sorting
 # 'CSR.1.vcpu0' => '0001.CSR.vcpu0'
 def normalize_task_name(task):
@@ -129,38 +143,115 @@ def get_full_task_name(df, task):
     task = task + ':' + str(tid)
     return (df, task)
 
+# columns that have few distinct values and are stored as categoricals
+CATEGORY_COLUMNS = ['event', 'task_name', 'next_comm']
+# integer columns that are stored with the smallest integer type that fits their values
+# (only identifiers: the duration and count columns are summed and must keep their 64-bit type
+# so that the sums do not overflow)
+DOWNCAST_COLUMNS = ['cpu', 'pid', 'next_pid']
+
+def compact_df(df):
+    '''Convert the string columns to categoricals and downcast the integer columns
+    All equality filters, regex matches and group by on the string columns then work on
+    integer codes (and regex matches are only evaluated once per distinct value)
+    :param df: the dataframe to compact in place
+    :return: a tuple with the memory usage of the dataframe before and after in bytes
+    '''
+    mem_before = df.memory_usage(deep=True).sum()
+    for col in CATEGORY_COLUMNS:
+        if col in df:
+            df[col] = df[col].astype('category')
+    for col in DOWNCAST_COLUMNS:
+        if col in df:
+            df[col] = pandas.to_numeric(df[col], downcast='integer')
+    return mem_before, df.memory_usage(deep=True).sum()
+
+def get_run_name(cdict_file):
+    '''Get the name of the run of a cdict file (the file path without the cdict extension)
+    e.g. ./h1x216.cdict -> h1x216
+    '''
+    cdict_file = os.path.normpath(cdict_file)
+    if cdict_file.endswith('.cdict'):
+        cdict_file = cdict_file[:-6]
+    return cdict_file
+
 class DfDesc(object):
     '''A class to store a dataframe and its metadata:
     - time constrained df
     - multiplier (to indicate if the df is under sampled)
     - name
+    The string columns of the dataframe are categoricals (group by on these columns
+    must use observed=True to only get the groups that are present)
+    A summary dataframe has one row per aggregate of events (see CdictSummary) with the
+    number of events in the count column and the time range of the events in usecs_range
     '''
-    def __init__(self, cdict_file, df, merge_sys_tasks=False, append_tid=False):
-        # remove the cdict extension if any
-        if cdict_file.endswith('.cdict'):
-            cdict_file = cdict_file[:-6]
-        self.name = cdict_file
+    def __init__(self, cdict_file, df, merge_sys_tasks=False, append_tid=False, usecs_range=None,
+                 last_usec=None):
+        self.name = get_run_name(cdict_file)
         self.multiplier = 1.0
         self.df = df
-        self.short_name = cdict_file
+        self.short_name = self.name
         self.from_usec = 0
         self.to_usec = 0
+        self.usecs_range = usecs_range
+        # usecs of the last event of the capture when only a time window of the events was decoded
+        self.last_usec = last_usec
+        # rows of every event type indexed by event name (see get_event_df)
+        self.event_dfs = {}
         if merge_sys_tasks:
             # aggregate all the per core tasks (e.g. swapper/0 -> swapper)
             self.df['task_name'] = self.df['task_name'].str.replace(r'/.*$', '')
         if append_tid:
-            self.df['task_name'] = self.df['task_name'] + ':' + self.df['pid'].astype(str)
+            self.df['task_name'] = self.df['task_name'].astype(str) + ':' + self.df['pid'].astype(str)
+        mem_before, mem_after = compact_df(self.df)
+        if usecs_range:
+            rows = '%d summary cells (%d events)' % (len(self.df), self.df['count'].sum())
+        else:
+            rows = '%d events' % (len(self.df))
+        print '%s: %s, memory %d MB -> %d MB' % (self.name, rows, mem_before / 1000000, mem_after / 1000000)
+
+    def get_event_df(self, event):
+        '''Get the rows of an event type
+        The rows are only selected once and shared by all the queries on this dataframe
+        :param event: event name (e.g. 'sched__sched_switch')
+        :return: a dataframe with only the rows of that event
+        '''
+        try:
+            return self.event_dfs[event]
+        except KeyError:
+            df = self.df[self.df['event'] == event]
+            self.event_dfs[event] = df
+            return df
+
+    def get_last_usec(self):
+        if self.usecs_range:
+            return self.usecs_range[1]
+        if self.last_usec is not None:
+            return self.last_usec
+        return self.df['usecs'].iloc[-1]
+
+    def get_time_span_usec(self):
+        if self.usecs_range:
+            last_usec = min(self.usecs_range[1], self.to_usec) if self.to_usec else self.usecs_range[1]
+            return last_usec - max(self.usecs_range[0], self.from_usec)
+        return get_time_span_usec(self.df)
 
     def normalize(self, from_time_usec, to_time_usec):
         # remove all samples that are under the start time
         if from_time_usec:
             self.df = self.df[self.df['usecs'] >= from_time_usec]
-        last_time_usec = self.df['usecs'].iloc[-1]
+        last_time_usec = self.get_last_usec()
         if to_time_usec > last_time_usec:
             # eg if the requested cap is 1 sec and the df only contains
             # 500 msec of samples, the multiplier is 2.0
             self.multiplier = float(to_time_usec - from_time_usec) / (last_time_usec - from_time_usec)
         # remove all samples that are over the cap
-        self.df = self.df[self.df['usecs'] <= to_time_usec]
+        if self.usecs_range and to_time_usec < last_time_usec:
+            # the cap is on a cell boundary (see perfmap.load_summaries)
+            # and the cell that starts there is after the window
+            self.df = self.df[self.df['usecs'] < to_time_usec]
+        else:
+            self.df = self.df[self.df['usecs'] <= to_time_usec]
+        self.event_dfs = {}
         self.from_usec = from_time_usec
         self.to_usec = to_time_usec
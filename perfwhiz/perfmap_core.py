@@ -22,7 +22,7 @@ from pandas import DataFrame
 import pandas
 import numpy as np
 
-from perfmap_common import get_time_span_usec
+from perfmap_common import get_group_counts
 
 # For sorting
 # 'CSR.1.vcpu0' => '0001.CSR.vcpu0'
@@ -43,18 +43,30 @@ def normalize_task_name(task):
 def normalize_df_task_name(df):
     df['task_name'] = df.apply(lambda row: normalize_task_name(row['task_name']), axis=1)
 
-def filter_df_core(df, task_re, remove_cpu=False):
+def filter_df_core(dfd, task_re, remove_cpu=False):
+    # filter out all events except the switch events
+    df = dfd.get_event_df('sched__sched_switch')
     # remove unneeded columns
-    df = df.drop(['next_pid', 'pid', 'usecs', 'next_comm'], axis=1)
+    df = df.drop(['next_pid', 'pid', 'usecs', 'next_comm', 'event'], axis=1)
     if remove_cpu:
         df = df.drop('cpu', axis=1)
 
-    # filter out all events except the switch events
-    df = df[df.event == 'sched__sched_switch']
-    df = df.drop('event', axis=1)
     df = df[df['task_name'].str.match(task_re)]
     return df
 
+def get_coremap_counts(cpus, percents, counts, all_percent, all_count):
+    '''Get the counts of one row of the coremap
+    :param cpus: array of the cpus that have switches
+    :param percents: array of percent indexed by cpu
+    :param counts: array of switch counts indexed by cpu
+    :param all_percent: percent for all cpus
+    :param all_count: switch count for all cpus
+    :return: a list of [cpu, percent, count] followed by ['all', all_percent, all_count]
+    '''
+    cells = [list(cell) for cell in zip(cpus.tolist(), percents[cpus].tolist(), counts[cpus].tolist())]
+    cells.append(['all', float(all_percent), int(all_count)])
+    return cells
+
 def get_coremaps(dfds, cap_time_usec, task_re):
     '''
     coremaps =  [
@@ -80,11 +92,10 @@ def get_coremaps(dfds, cap_time_usec, task_re):
     coremaps = []
     max_core = 0
     for dfd in dfds:
-        df = dfd.df
-        time_span_usec = get_time_span_usec(df)
+        time_span_usec = dfd.get_time_span_usec()
 
         # remove unneeded columns
-        df = filter_df_core(df, task_re)
+        df = filter_df_core(dfd, task_re)
 
         # at this point we have a df that looks like this:
         #         task_name  cpu  duration
@@ -101,77 +112,51 @@ def get_coremaps(dfds, cap_time_usec, task_re):
             return None, 0
         largest_core = df['cpu'].max()
         max_core = max(max_core, largest_core)
-        gb = df.groupby(['task_name', 'cpu'], as_index=False)
-
-        # because we only show percentages, there is no need to apply the multiplier
-        # add duration values
-        df = gb.aggregate(np.sum)
-        #         task_name  cpu  duration
-        # 0     ASA.1.vcpu0    8      7954
-        # 1     ASA.1.vcpu0    9      6475
-        # 2     ASA.1.vcpu0   11     12391
 
-        # Add a % column
-        df['percent'] = np.round((df['duration'] * 100) / time_span_usec, 2)
+        # accumulate the durations and number of switches in a task x cpu matrix
+        # (each task is coded with its index in task_names)
+        task_codes, task_names = pandas.factorize(np.asarray(df['task_name']))
+        cpu_count = int(largest_core) + 1
+        cells = task_codes * cpu_count + df['cpu'].values
+        shape = (len(task_names), cpu_count)
+        durations = np.bincount(cells, weights=df['duration'].values, minlength=shape[0] * cpu_count).reshape(shape)
+        # summary rows are aggregates of several switches
+        weights = df['count'].values if 'count' in df else None
+        counts = np.bincount(cells, weights=weights, minlength=shape[0] * cpu_count).reshape(shape).astype(int)
+        present = counts > 0
 
+        # because we only show percentages, there is no need to apply the multiplier
+        with np.errstate(divide='ignore', invalid='ignore'):
+            percents = np.round((durations * 100) / time_span_usec, 2)
         # many core-pinned system tasks have a duration of 0 (swapper, watchdog...)
-        df.fillna(100, inplace=True)
-        df.drop(['duration'], axis=1, inplace=True)
+        percents[np.isnan(percents)] = 100
+        percents[~present] = 0
 
-        # count number of rows with same task and cpu
-        dfsw = DataFrame(gb.size())
-        dfsw.reset_index(inplace=True)
-        dfsw.rename(columns={0: 'count'}, inplace=True)
         # adjust context switch count if the requested cap time is > time_span
         if dfd.multiplier > 1.0:
-            dfsw['count'] = (dfsw['count'].astype(int) * dfd.multiplier).astype(int)
-        min_count = dfsw['count'].min()
-        max_count = dfsw['count'].max()
-        #       task_name  cpu  count
-        # 0  ASA.01.vcpu0    8   9853
-        # 1  ASA.01.vcpu0    9    348
-        # 1  ASA.01.vcpu0   11    619
-
-        # Merge the 2 df using the task_name/cpu as the joining key
-        dfm = pandas.merge(df, dfsw, how="left", on=['task_name', 'cpu'])
-
-        alltasks_label = 'all tasks'
-
-        # calculate the sum of all percent and switches per task
-        dfallcores = dfm.drop('cpu', axis=1)
-        gball = dfallcores.groupby('task_name')
-        dfallcores = gball.aggregate(np.sum)
-        dfallcores['percent'] = np.round(dfallcores['percent'], 2)
-        dfallcores['task_name'] = dfallcores.index
-        dfallcores['cpu'] = 'all'
-
-        # sort all the tasks in reverse order (without the 'all tasks')
-        task_list = gball.groups.keys()
-        task_list.sort(reverse=True)
-        task_list.append(alltasks_label)
-        # concatenate the 2 dfs
-        dfm = pandas.concat([dfm, dfallcores], ignore_index=True)
-
-        # calculate the sum of all percent and switches per cpu
-        dfalltasks = dfm.drop('task_name', axis=1)
-        gball = dfalltasks.groupby('cpu')
-        dfalltasks = gball.aggregate(np.sum)
-        dfalltasks['task_name'] = alltasks_label
-        dfalltasks['cpu'] = dfalltasks.index
-        dfalltasks['percent'] = np.round(dfalltasks['percent'], 2)
-        # concatenate all dfs
-        dfm = pandas.concat([dfm, dfalltasks], ignore_index=True)
+            counts = (counts * dfd.multiplier).astype(int)
+        min_count = int(counts[present].min())
+        max_count = int(counts[present].max())
+
+        # sum of all percent and switches per task (all cores) and per core (all tasks)
+        task_percents = np.round(percents.sum(axis=1), 2)
+        task_counts = counts.sum(axis=1)
+        cpu_percents = np.round(percents.sum(axis=0), 2)
+        cpu_counts = counts.sum(axis=0)
 
         # generate the data structure for the jinja template
+        # with all the tasks in reverse order followed by 'all tasks'
         cml = []
-        gb = dfm.groupby('task_name')
-
-        for task in task_list:
-            counts = []
-            dfg = gb.get_group(task)
-            for index, row in dfg.iterrows():
-                counts.append([row['cpu'], row['percent'], row['count']])
-            cml.append({"task": task, "counts": counts})
+        task_labels = [str(task) for task in task_names]
+        for index in sorted(range(len(task_labels)), key=task_labels.__getitem__, reverse=True):
+            cpus = np.flatnonzero(present[index])
+            cml.append({"task": task_labels[index],
+                        "counts": get_coremap_counts(cpus, percents[index], counts[index],
+                                                     task_percents[index], task_counts[index])})
+        cpus = np.flatnonzero(present.any(axis=0))
+        cml.append({"task": 'all tasks',
+                    "counts": get_coremap_counts(cpus, cpu_percents, cpu_counts,
+                                                 np.round(task_percents.sum(), 2), task_counts.sum())})
 
         coremap = {"run": dfd.short_name, "coremap": cml, "extent": str([min_count, max_count])}
         coremaps.append(coremap)
@@ -181,7 +166,7 @@ def get_cpu_sw_map(dfds, cap_time_usec, task_re):
     df_list = []
     dfsw_list = []
     for dfd in dfds:
-        df = filter_df_core(dfd.df, task_re, True)
+        df = filter_df_core(dfd, task_re, True)
         # at this point we have a set of df that look like this:
         #         task_name  duration
         # 0     ASA.1.vcpu0      7954
@@ -189,19 +174,24 @@ def get_cpu_sw_map(dfds, cap_time_usec, task_re):
         # 2     ASA.1.vcpu0      4151
         if df.empty:
             continue
-        gb = df.groupby('task_name', as_index=False)
+        # count number of switches for each task
+        sw_counts = get_group_counts(df.groupby('task_name', observed=True), df)
+        gb = df.groupby('task_name', as_index=False, observed=True)
 
         # sum all duration for each task
         df = gb.aggregate(np.sum)
+        if 'count' in df:
+            df = df.drop('count', axis=1)
+        # the percent arithmetic must not overflow a narrow integer type
+        df['duration'] = df['duration'].astype(np.int64)
         if dfd.multiplier > 1.0:
             df['duration'] = (df['duration'] * dfd.multiplier).astype(int)
         df['percent'] = ((df['duration'] * 100 * 10) // cap_time_usec) / 10
         if len(dfds) > 1:
-            df['task_name'] = df['task_name'] + '.' + dfd.short_name
+            df['task_name'] = df['task_name'].astype(str) + '.' + dfd.short_name
         df_list.append(df)
 
-        # count number of rows with same task and cpu
-        dfsw = DataFrame(gb.size())
+        dfsw = DataFrame(sw_counts)
         dfsw.reset_index(inplace=True)
         dfsw.rename(columns={0: 'count'}, inplace=True)
 
@@ -19,7 +19,7 @@
 
 import pandas
 
-from perfmap_core import get_cpu_sw_map
+from perfmap_common import get_group_counts
 
 import itertools
 import numpy as np
@@ -124,8 +124,7 @@ def aggregate_dfs(dfds, task_re):
     # annotate the task name with the cdict ID it comes from
     dfl = []
     for dfd in dfds:
-        df = dfd.df
-        df = df[df['event'] == 'kvm_exit']
+        df = dfd.get_event_df('kvm_exit')
         df = df[df['task_name'].str.match(task_re)]
         # add the cdict name to the task name unless there is only 1 cdict file
         if len(dfds) > 1:
@@ -167,12 +166,13 @@ def update_task_list(task_list, cpu_sw_map):
     # horizontal stacked bar chart
     return sorted(task_list, key=lambda k: k['name'], reverse=True) 
 
-def get_swkvm_data(dfds, cap_time_usec, task_re):
+def get_swkvm_data(dfds, task_re, cpu_sw_map):
+    '''Get the task list and the kvm exit reasons of the tasks matching a regex
+    :param cpu_sw_map: the total cpu and total context switches per task (see perfmap_core.get_cpu_sw_map)
+    :return: a tuple (task list, exit reason list, colormap list)
+    '''
     task_list = []
 
-    # calculate the total cpu and total context switches per task
-    cpu_sw_map = get_cpu_sw_map(dfds, cap_time_usec, task_re)
-
     # a dict of adjustment ratios indexed by task name for cdicts
     # that require count adjustment due to
     # capture window being too small
@@ -185,7 +185,7 @@ def get_swkvm_data(dfds, cap_time_usec, task_re):
     df.drop(['cpu', 'duration', 'event', 'next_pid', 'pid', 'usecs'], inplace=True, axis=1)
 
     # Get the list of exit reason codes, sorted numerically
-    exit_code_list = pandas.unique(df.next_comm.ravel()).tolist()
+    exit_code_list = df.next_comm.unique().tolist()
     exit_code_list.sort()
 
     # key = exit code, value = exit index
@@ -211,13 +211,14 @@ def get_swkvm_data(dfds, cap_time_usec, task_re):
             return
 
     # group by task name then exit reasons
-    gb = df.groupby(['task_name', 'next_comm'])
+    gb = df.groupby(['task_name', 'next_comm'], observed=True)
     # number of exit types in each group
     # result is a series with 2-level index (task_name, next_comm)
-    size_series = gb.size()
+    size_series = get_group_counts(gb, df)
 
     # Get the list of all level 0 indices
-    task_names = size_series.index.levels[0]
+    # (the levels of categorical columns can contain categories that are not present)
+    task_names = size_series.index.get_level_values(0).unique()
 
     #     task_list = [
     #    {"name":"Router", "exit_list":[{"name":"EPT violation", "count":400}, {"name":"APIC_WRITE", "count":300}]},
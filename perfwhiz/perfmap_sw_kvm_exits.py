@@ -18,21 +18,58 @@
 # ---------------------------------------------------------
 
 
-def get_groupby(df, task_re):
+import numpy as np
+import pandas
+
+# events shown in the heatmaps
+HEATMAP_EVENTS = ['sched__sched_switch', 'sched__sched_stat_sleep', 'kvm_exit', 'kvm_entry']
+# series with more events are aggregated into levels of detail
+# (also the maximum number of events drawn individually when zooming in)
+MAX_SERIES_EVENTS = 50000
+# maximum number of raw events kept in an aggregated series (the first events in time), the raw events
+# are drawn when zooming in on few enough of them and in the core locality chart
+MAX_RAW_EVENTS = 1000000
+# number of log(duration) bins and number of time bins of each level of detail (coarsest first)
+LOD_DURATION_BINS = 64
+LOD_TIME_BINS = [250, 1000, 5000]
+# little endian column types and the corresponding javascript typed arrays
+# ("f8": Float64Array, "u4": Uint32Array)
+COLUMN_TYPES = {'<f8': 'f8', '<u4': 'u4'}
+
+def get_task_column(df, task_re):
+    '''Select the rows of the tasks to display
+    :return: the selected rows and the name of the column that identifies a task
+    '''
     # if task is a number it is considered to be a pid ID
     # if text it is a task name
     try:
         tid = int(task_re)
         # tid given
-        df = df[df['pid'] == tid]
-        # a groupby with only 1 group since we already filtered on the pid
-        gb = df.groupby('pid')
+        return df[df['pid'] == tid], 'pid'
     except ValueError:
         # task given: find corresponding tid
-        df = df[df['task_name'].str.match(task_re)]
-        gb = df.groupby('task_name')
+        return df[df['task_name'].str.match(task_re)], 'task_name'
 
-    return gb
+def get_lod_levels(usecs, durations, usecs_min, usecs_max, duration_max):
+    '''Aggregate the events of a series into time x log(duration) cells at several resolutions
+    Duration bin b covers the durations from 10^(b * log10(duration_max) / LOD_DURATION_BINS) usec
+    :return: a list of levels of detail (coarsest first), each with the number of time bins
+        and the columns of the non empty cells (time bin, duration bin, number of events)
+    '''
+    span = max(usecs_max - usecs_min, 1)
+    log_max = np.log10(max(duration_max, 2))
+    duration_bins = (np.log10(np.maximum(durations, 1)) * (LOD_DURATION_BINS / log_max)).astype(np.int64)
+    np.clip(duration_bins, 0, LOD_DURATION_BINS - 1, out=duration_bins)
+    levels = []
+    for time_bins in LOD_TIME_BINS:
+        time_bin = np.clip((usecs - usecs_min) * time_bins // span, 0, time_bins - 1)
+        counts = np.bincount(time_bin * LOD_DURATION_BINS + duration_bins, minlength=time_bins * LOD_DURATION_BINS)
+        cells = np.flatnonzero(counts)
+        levels.append({'time_bins': time_bins,
+                       'time': (cells // LOD_DURATION_BINS).astype('<u4'),
+                       'duration': (cells % LOD_DURATION_BINS).astype('<u4'),
+                       'count': counts[cells].astype('<u4')})
+    return levels
 
 def get_sw_kvm_events(dfd, task_re):
     '''
@@ -45,49 +82,97 @@ def get_sw_kvm_events(dfd, task_re):
           "task_events": [
              {"task": "CSR",
               "events":
-                { "kvm_exit": [ [0,1,30], [20, 421, 30], ...],
-                  "kvm_entry": [],
-                  "sched__sched_switch": [],
-                  "sched__sched_stat_sleep": []
+                { "kvm_exit": {"count": 2, "usecs": [0, 20], "duration": [1, 421], "cpu": [30, 30]},
+                  "kvm_entry": {"count": 0, "usecs": [], "duration": [], "cpu": []},
+                  "sched__sched_switch": {"count": 80000, "lod": [
+                      {"time_bins": 250, "time": [0, 0, 1, ...], "duration": [3, 12, 3, ...],
+                       "count": [120, 4, 98, ...]}, ...],
+                      "usecs": [...], "duration": [...], "cpu": [...], "raw_usecs_max": 1873291},
+                  "sched__sched_stat_sleep": {...}
                 }
              },...
-          ]
+          ],
+          "lod_duration_bins": 64,
+          "max_drawn_events": 50000
         }
+        series with more than MAX_SERIES_EVENTS events also have levels of detail (see get_lod_levels)
+        and only their first MAX_RAW_EVENTS events, up to raw_usecs_max
+        all columns are little endian numpy arrays (see get_column_buffer)
 
     '''
-    gb = get_groupby(dfd.df, task_re)
-    nb_tasks = len(gb.groups)
-    if nb_tasks == 0:
+    df, task_column = get_task_column(dfd.df, task_re)
+    # code every row with its task (sorted) and event (-1 for the events not displayed)
+    task_codes, task_list = pandas.factorize(np.asarray(df[task_column]), sort=True)
+    if not len(task_list):
         raise RuntimeError('No selection matching: ' + task_re)
-    event_list = ['sched__sched_switch', 'sched__sched_stat_sleep', 'kvm_exit', 'kvm_entry']
-    task_list = gb.groups.keys()
-    task_list.sort()
-    duration_max = -1
+    event_codes = pandas.Categorical(np.asarray(df['event']), categories=HEATMAP_EVENTS).codes
+    rows = event_codes >= 0
+    series_codes = task_codes[rows] * len(HEATMAP_EVENTS) + event_codes[rows]
+    # a single stable sort groups the rows of every series (task, event) in time order
+    order = np.argsort(series_codes, kind='mergesort')
+    usecs = df['usecs'].values[rows][order]
+    durations = df['duration'].values[rows][order]
+    cpus = df['cpu'].values[rows][order]
+    # offsets of every series in the sorted columns
+    offsets = np.zeros(len(task_list) * len(HEATMAP_EVENTS) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(series_codes, minlength=len(offsets) - 1), out=offsets[1:])
+    duration_max = int(durations.max()) if len(durations) else -1
 
     task_event_list = []
-    for task in task_list:
-        dfg = gb.get_group(task)
-        dfg = dfg.drop(['task_name', 'pid', 'next_pid', 'next_comm'], axis=1)
-        dfg = dfg[dfg.columns[::-1]]
+    series = 0
+    for task in task_list.tolist():
         task_events = {}
-        for event in event_list:
-            events = []
-            dfe = dfg[dfg.event == event]
-            duration_max = max(duration_max, dfe['duration'].max())
-            dfe = dfe.drop('event', axis=1)
-
-            # limit to 50k events
-            if len(dfe) > 50000:
-                dfe = dfe[:50000]
-                print 'Series for %s display truncated to 50000 events' % (event)
-            itt = dfe.itertuples(index=False)
-            for row in itt:
-                # each row is a tuple with usec, duration and core
-                events.append(list(row))
-            task_events[event] = events
+        for event in HEATMAP_EVENTS:
+            start = offsets[series]
+            end = offsets[series + 1]
+            series += 1
+            series_events = {'count': int(end - start)}
+            if end - start > MAX_SERIES_EVENTS:
+                print 'Series for %s %s aggregated (%d events)' % (task, event, end - start)
+                series_events['lod'] = get_lod_levels(usecs[start:end], durations[start:end],
+                                                      dfd.from_usec, dfd.to_usec, duration_max)
+                if end - start > MAX_RAW_EVENTS:
+                    end = start + MAX_RAW_EVENTS
+                    series_events['raw_usecs_max'] = int(usecs[end - 1])
+                else:
+                    series_events['raw_usecs_max'] = dfd.to_usec
+            # each series is stored column wise
+            series_events['usecs'] = usecs[start:end].astype('<f8')
+            series_events['duration'] = durations[start:end].astype('<f8')
+            series_events['cpu'] = cpus[start:end].astype('<u4')
+            task_events[event] = series_events
         task_event_list.append({"task": task, "events": task_events})
     return {'run': dfd.short_name,
             'task_events': task_event_list,
             'usecs_min': dfd.from_usec,
             'usecs_max': dfd.to_usec,
-            'usecs_duration_max': duration_max}
+            'usecs_duration_max': duration_max,
+            'lod_duration_bins': LOD_DURATION_BINS,
+            'max_drawn_events': MAX_SERIES_EVENTS}
+
+def get_column_buffer(swk_events):
+    '''Move the columns of the heatmap events into a single binary buffer
+    Every column is replaced by a {"buffer_offset", "length", "type"} descriptor that the heatmaps
+    page maps directly to a typed array view of the buffer (no JSON parsing of the events),
+    columns are aligned on 8 bytes in the buffer
+    :param swk_events: heatmap events as returned by get_sw_kvm_events
+    :return: a tuple of the heatmap events with column descriptors and the buffer (string)
+    '''
+    chunks = []
+    size = [0]
+
+    def pack(value):
+        if isinstance(value, np.ndarray):
+            data = value.tostring()
+            desc = {'buffer_offset': size[0], 'length': len(value), 'type': COLUMN_TYPES[value.dtype.str]}
+            padding = -len(data) % 8
+            chunks.append(data + '\0' * padding)
+            size[0] += len(data) + padding
+            return desc
+        if isinstance(value, dict):
+            return dict((key, pack(item)) for key, item in value.iteritems())
+        if isinstance(value, list):
+            return [pack(item) for item in value]
+        return value
+    swk_info = pack(swk_events)
+    return swk_info, ''.join(chunks)
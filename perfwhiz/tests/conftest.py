@@ -0,0 +1,44 @@
+# Copyright 2015 Cisco Systems, Inc.  All rights reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+import os
+import sys
+
+import pytest
+
+# the perfwhiz modules import each other as top level modules
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+DATA_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+@pytest.fixture(autouse=True)
+def task_cache(tmpdir, monkeypatch):
+    '''Keep the persistent task cache of the tests out of the home folder'''
+    import perf_formatter
+    monkeypatch.setattr(perf_formatter, 'TASK_CACHE_FILE', str(tmpdir.join('tasks')))
+
+def write_synthetic_cdict(cdict_file, rows=20000, **options):
+    '''Write a small synthetic cdict file (see perfmap_bench.generate_cdict)
+    4 cores, 6 tasks and 2 VMs with 2 vcpus each (vm00.vcpu0, vm00.vcpu1, vm01.vcpu0...)
+    :param options: generator options to override
+    '''
+    import optparse
+    import perfmap_bench
+    opts = optparse.Values({'cores': 4, 'tasks': 6, 'vms': 2, 'vcpus': 2, 'rate': 100000,
+                            'exit_mix': perfmap_bench.DEFAULT_EXIT_MIX, 'duration': 50, 'seed': 1,
+                            'codec': 'zlib', 'summary': 0, 'chunk_rows': 8192})
+    for name, value in options.items():
+        setattr(opts, name, value)
+    perfmap_bench.generate_cdict(cdict_file, rows, opts)
+    return cdict_file
@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+# Copyright 2015 Cisco Systems, Inc.  All rights reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+
+#
+# Builder of small perf.data files with sched and kvm tracepoint samples
+# (only the parts read by perf_data_reader.py are written)
+#
+# Regenerate the checked-in fixture with:
+#   python perf_data_builder.py data/sched-kvm.perf.data
+#
+import random
+import struct
+import sys
+
+COMMON_FIELDS = '''\
+\tfield:unsigned short common_type;\toffset:0;\tsize:2;\tsigned:0;
+\tfield:unsigned char common_flags;\toffset:2;\tsize:1;\tsigned:0;
+\tfield:unsigned char common_preempt_count;\toffset:3;\tsize:1;\tsigned:0;
+\tfield:int common_pid;\toffset:4;\tsize:4;\tsigned:1;
+
+'''
+
+# format fields of every tracepoint (as found in /sys/kernel/debug/tracing/events on x86_64)
+# [system, name, id, [(declaration, offset, size, signed)], raw struct format of the non common fields]
+TRACEPOINTS = [
+    ['sched', 'sched_switch', 316,
+     [('char prev_comm[16]', 8, 16, 1), ('pid_t prev_pid', 24, 4, 1), ('int prev_prio', 28, 4, 1),
+      ('long prev_state', 32, 8, 1), ('char next_comm[16]', 40, 16, 1), ('pid_t next_pid', 56, 4, 1),
+      ('int next_prio', 60, 4, 1)],
+     '16siiq16sii'],
+    ['sched', 'sched_stat_runtime', 312,
+     [('char comm[16]', 8, 16, 1), ('pid_t pid', 24, 4, 1), ('u64 runtime', 32, 8, 0),
+      ('u64 vruntime', 40, 8, 0)],
+     '16si4xQQ'],
+    ['sched', 'sched_stat_sleep', 314,
+     [('char comm[16]', 8, 16, 1), ('pid_t pid', 24, 4, 1), ('u64 delay', 32, 8, 0)],
+     '16si4xQ'],
+    ['sched', 'sched_stat_iowait', 313,
+     [('char comm[16]', 8, 16, 1), ('pid_t pid', 24, 4, 1), ('u64 delay', 32, 8, 0)],
+     '16si4xQ'],
+    ['sched', 'sched_wakeup', 318,
+     [('char comm[16]', 8, 16, 1), ('pid_t pid', 24, 4, 1), ('int prio', 28, 4, 1),
+      ('int success', 32, 4, 1), ('int target_cpu', 36, 4, 1)],
+     '16siiii'],
+    ['kvm', 'kvm_entry', 1193,
+     [('unsigned int vcpu_id', 8, 4, 0)],
+     'I'],
+    ['kvm', 'kvm_exit', 1192,
+     [('unsigned int exit_reason', 8, 4, 0), ('unsigned long guest_rip', 16, 8, 0), ('u32 isa', 24, 4, 0),
+      ('u64 info1', 32, 8, 0), ('u64 info2', 40, 8, 0)],
+     'I4xQI4xQQ'],
+]
+
+# IDENTIFIER | IP | TID | TIME | CPU | PERIOD | RAW
+SAMPLE_TYPE = (1 << 16) | (1 << 0) | (1 << 1) | (1 << 2) | (1 << 7) | (1 << 8) | (1 << 10)
+ATTR_SIZE = 112
+PERF_RECORD_COMM = 3
+PERF_RECORD_SAMPLE = 9
+PERF_RECORD_FINISHED_ROUND = 68
+
+def get_format_text(name, tp_id, fields):
+    text = 'name: %s\nID: %d\nformat:\n' % (name, tp_id) + COMMON_FIELDS
+    for decl, offset, size, signed in fields:
+        text += '\tfield:%s;\toffset:%d;\tsize:%d;\tsigned:%d;\n' % (decl, offset, size, signed)
+    return text + '\nprint fmt: ""\n'
+
+def get_tracing_data():
+    data = '\027\010\104tracing0.6\0' + struct.pack('<BBI', 0, 8, 4096)
+    for name in ['header_page', 'header_event']:
+        data += name + '\0' + struct.pack('<Q', 0)
+    # no ftrace formats
+    data += struct.pack('<I', 0)
+    systems = []
+    for tp in TRACEPOINTS:
+        if tp[0] not in systems:
+            systems.append(tp[0])
+    data += struct.pack('<I', len(systems))
+    for system in systems:
+        tps = [tp for tp in TRACEPOINTS if tp[0] == system]
+        data += system + '\0' + struct.pack('<I', len(tps))
+        for _, name, tp_id, fields, _ in tps:
+            text = get_format_text(name, tp_id, fields)
+            data += struct.pack('<Q', len(text)) + text
+    return data
+
+def pad8(data):
+    return data + '\0' * (-len(data) % 8)
+
+def comm_record(pid, tid, comm):
+    body = pad8(struct.pack('<II', pid, tid) + comm + '\0')
+    return struct.pack('<IHH', PERF_RECORD_COMM, 0, 8 + len(body)) + body
+
+def sample_record(tp_name, time, cpu, tid, *fields):
+    for _, name, tp_id, _, fmt in TRACEPOINTS:
+        if name == tp_name:
+            break
+    raw = struct.pack('<HBBi' + fmt, tp_id, 0, 0, tid, *fields)
+    # the raw data is padded so that the record size is a multiple of 8
+    raw += '\0' * (-(len(raw) + 4) % 8)
+    body = struct.pack('<QQIIQIIQI', tp_id, 0xffffffff81000000, tid, tid, time, cpu, 0, 1, len(raw)) + raw
+    return struct.pack('<IHH', PERF_RECORD_SAMPLE, 0, 8 + len(body)) + body
+
+def finished_round_record():
+    return struct.pack('<IHH', PERF_RECORD_FINISHED_ROUND, 0, 8)
+
+def build_perf_data(records):
+    '''Build the content of a perf.data file
+    :param records: list of encoded records (see comm_record, sample_record, finished_round_record)
+    :return: the file content
+    '''
+    attrs = ''
+    for _, _, tp_id, _, _ in TRACEPOINTS:
+        attr = struct.pack('<IIQQQ', 2, ATTR_SIZE, tp_id, 1, SAMPLE_TYPE)
+        # rest of the attr and the empty ids section
+        attrs += attr + '\0' * (ATTR_SIZE - len(attr)) + struct.pack('<QQ', 0, 0)
+    header_size = struct.calcsize('<8sQQQQQQQQ4Q')
+    attrs_offset = header_size
+    data = ''.join(records)
+    data_offset = attrs_offset + len(attrs)
+    tracing_data = get_tracing_data()
+    tracing_offset = data_offset + len(data) + 16
+    header = struct.pack('<8sQQQQQQQQ4Q', 'PERFILE2', header_size, ATTR_SIZE + 16,
+                         attrs_offset, len(attrs), data_offset, len(data), 0, 0,
+                         1 << 1, 0, 0, 0)
+    return header + attrs + data + struct.pack('<QQ', tracing_offset, len(tracing_data)) + tracing_data
+
+def get_sched_kvm_records(seed=1, rounds=6, samples_per_round=40):
+    '''Generate a random trace on 4 cpus with 2 vcpu threads of a qemu process
+    The samples of every round are written per cpu (out of time order across cpus)
+    and can be older than the last sample of the previous round (like perf does)
+    '''
+    rand = random.Random(seed)
+    tasks = [(900101, 'qemu-kvm'), (900102, 'qemu-kvm'), (900200, 'sshd'), (900300, 'kworker/1:2'), (0, 'swapper')]
+    vcpus = [900101, 900102]
+    records = [comm_record(900100, tid, comm) for tid, comm in tasks[:-1]]
+    time = 5000000000
+    for _ in range(rounds):
+        samples = []
+        for _ in range(samples_per_round):
+            time += rand.randint(500, 20000)
+            cpu = rand.randint(0, 3)
+            # some samples are older than the last sample of the previous round
+            sample_time = time - rand.choice([0, 0, 0, 30000])
+            kind = rand.choice(['switch', 'runtime', 'runtime', 'sleep', 'iowait', 'wakeup', 'kvm', 'kvm', 'kvm'])
+            tid, comm = rand.choice(tasks)
+            if kind == 'switch':
+                next_tid, next_comm = rand.choice(tasks)
+                record = sample_record('sched_switch', sample_time, cpu, tid, comm, tid, 120, 1,
+                                       next_comm, next_tid, 120)
+            elif kind == 'runtime':
+                record = sample_record('sched_stat_runtime', sample_time, cpu, tid, comm, tid,
+                                       rand.randint(1000, 2000000), rand.randint(0, 1 << 40))
+            elif kind in ['sleep', 'iowait']:
+                record = sample_record('sched_stat_' + kind, sample_time, cpu, tid, comm, tid,
+                                       rand.randint(0, 5000000))
+            elif kind == 'wakeup':
+                record = sample_record('sched_wakeup', sample_time, cpu, tid, comm, tid, 120, 1, cpu)
+            else:
+                vcpu = rand.choice(vcpus)
+                if rand.randint(0, 1):
+                    record = sample_record('kvm_entry', sample_time, cpu, vcpu, vcpus.index(vcpu))
+                else:
+                    record = sample_record('kvm_exit', sample_time, cpu, vcpu, rand.choice([1, 12, 30, 48]),
+                                           0xffffffff81234567, 0, 0, 0)
+            samples.append((cpu, sample_time, record))
+        # perf writes the buffer of every cpu in turn
+        samples.sort(key=lambda sample: sample[:2])
+        records.extend(record for _, _, record in samples)
+        records.append(finished_round_record())
+    # a task renamed in the middle of the trace
+    records.insert(len(records) // 2, comm_record(900200, 900200, 'sshd-renamed'))
+    return records
+
+def main():
+    with open(sys.argv[1], 'wb') as ff:
+        ff.write(build_perf_data(get_sched_kvm_records()))
+
+if __name__ == '__main__':
+    main()
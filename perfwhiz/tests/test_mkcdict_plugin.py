@@ -0,0 +1,99 @@
+# Copyright 2015 Cisco Systems, Inc.  All rights reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+import json
+import threading
+import time
+
+import pytest
+
+import mkcdict_plugin
+
+UUID1 = '4f5e6a7b-0000-4000-8000-000000000001'
+UUID2 = '4f5e6a7b-0000-4000-8000-000000000002'
+UUID3 = '4f5e6a7b-0000-4000-8000-000000000003'
+
+class StubServer(object):
+    def __init__(self, uuid, name, status='ACTIVE'):
+        self.id = uuid
+        self.name = name
+        self.status = status
+
+class StubNovaClient(object):
+    '''Stub of the novaclient servers API used by the plugin'''
+    def __init__(self, servers, delay=0):
+        self.servers = self
+        self.server_list = servers
+        self.delay = delay
+        self.search_opts = []
+        self.listed = threading.Event()
+
+    def list(self, detailed=True, search_opts=None):
+        self.search_opts.append(search_opts)
+        self.listed.set()
+        time.sleep(self.delay)
+        return self.server_list
+
+@pytest.fixture
+def cache_file(tmpdir, monkeypatch):
+    cache_file = str(tmpdir.join('nova.json'))
+    monkeypatch.setattr(mkcdict_plugin, 'NOVA_CACHE_FILE', cache_file)
+    monkeypatch.setattr(mkcdict_plugin, 'by_uuid', {})
+    monkeypatch.setattr(mkcdict_plugin, 'refresh_thread', None)
+    # the refresh is waited for by the tests, not at exit
+    monkeypatch.setattr(mkcdict_plugin.atexit, 'register', lambda func: None)
+    return cache_file
+
+def test_plugin_init_from_nova(cache_file):
+    client = StubNovaClient([StubServer(UUID1, 'ESC_Day0-3__62940__MT__MTPerftest_FULL_01ESC_Day0-31.1__0__CSR__0'),
+                             StubServer(UUID2, 'other-vm')])
+    assert mkcdict_plugin.plugin_init(nova_client=client)
+    assert mkcdict_plugin.plugin_convert_name('qemu', 100, 'instance-00000001', UUID1, 'vcpu0') == 'CSR.01'
+    assert mkcdict_plugin.plugin_convert_name('qemu', 101, 'instance-00000002', UUID2, 'vcpu0') == 'qemu'
+    with open(cache_file) as ff:
+        assert json.load(ff)['by_uuid'] == {UUID1: 'CSR.01'}
+
+def test_expired_cache_refresh(cache_file):
+    with open(cache_file, 'w') as ff:
+        json.dump({'time': time.time() - mkcdict_plugin.NOVA_CACHE_TTL - 10, 'by_uuid': {UUID1: 'CSR.01'}}, ff)
+    client = StubNovaClient([StubServer(UUID2, 'ESC_Day0-3__68540__MT__MTPerftest-FULL-01ESC_Day0-31.1__0__ASA__0')],
+                            delay=0.2)
+    assert mkcdict_plugin.plugin_init(nova_client=client)
+    # the cached names are available without waiting for Nova
+    assert mkcdict_plugin.by_uuid == {UUID1: 'CSR.01'}
+    assert client.listed.wait(5)
+    mkcdict_plugin.wait_nova_refresh()
+    assert not mkcdict_plugin.refresh_thread.is_alive()
+    assert 'changes-since' in client.search_opts[0]
+    with open(cache_file) as ff:
+        cache = json.load(ff)
+    assert cache['by_uuid'] == {UUID1: 'CSR.01', UUID2: 'ASA.01'}
+    assert time.time() - cache['time'] < mkcdict_plugin.NOVA_CACHE_TTL
+
+def test_refresh_removes_deleted_servers(cache_file):
+    with open(cache_file, 'w') as ff:
+        json.dump({'time': time.time() - mkcdict_plugin.NOVA_CACHE_TTL - 10,
+                   'by_uuid': {UUID1: 'CSR.01', UUID2: 'ASA.01', UUID3: 'CSR.02'}}, ff)
+    # UUID1 is deleted, UUID2 is renamed to a name that is not a service chain, UUID3 is unchanged
+    client = StubNovaClient([StubServer(UUID1, 'ESC_Day0-3__62940__MT__MTPerftest_FULL_01ESC_Day0-31.1__0__CSR__0',
+                                        status='DELETED'),
+                             StubServer(UUID2, 'other-vm')])
+    assert mkcdict_plugin.plugin_init(nova_client=client)
+    mkcdict_plugin.wait_nova_refresh()
+    assert not mkcdict_plugin.refresh_thread.is_alive()
+    assert mkcdict_plugin.by_uuid == {UUID3: 'CSR.02'}
+    with open(cache_file) as ff:
+        assert json.load(ff)['by_uuid'] == {UUID3: 'CSR.02'}
+    # the stale name is no longer applied to the tasks of that uuid
+    assert mkcdict_plugin.plugin_convert_name('qemu', 100, 'instance-00000003', UUID1, 'vcpu0') == 'qemu'
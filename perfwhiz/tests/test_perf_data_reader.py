@@ -0,0 +1,78 @@
+# Copyright 2015 Cisco Systems, Inc.  All rights reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+import os
+import sys
+
+from conftest import DATA_FOLDER
+import perf_data_builder
+import perf_data_reader
+from perf_formatter import open_cdict
+
+PERF_DATA_FILE = os.path.join(DATA_FOLDER, 'sched-kvm.perf.data')
+
+def convert(perf_data_file, cdict_file, bulk, chunk_rows=16):
+    '''Convert a perf data file with a fresh converter state
+    :return: the decoded cdict and the converter module
+    '''
+    sys.modules.pop('mkcdict_perf_script', None)
+    perf_data_reader.convert(perf_data_file, ['output=' + cdict_file, 'chunk_rows=%d' % (chunk_rows)], bulk=bulk)
+    import mkcdict_perf_script
+    return open_cdict(cdict_file), mkcdict_perf_script
+
+def test_bulk_same_as_callbacks(tmpdir):
+    bulk_dict, bulk_script = convert(PERF_DATA_FILE, str(tmpdir.join('bulk.cdict')), True)
+    dict_, script = convert(PERF_DATA_FILE, str(tmpdir.join('callbacks.cdict')), False)
+    assert bulk_script.event_counts == script.event_counts
+    assert bulk_script.event_drops == script.event_drops == {'sched__sched_wakeup': 22}
+    assert bulk_script.epoch == script.epoch
+    assert sorted(bulk_dict) == sorted(dict_)
+    for name in dict_:
+        assert list(bulk_dict[name]) == list(dict_[name]), name
+    with open(str(tmpdir.join('bulk.cdict')), 'rb') as ff:
+        bulk_content = ff.read()
+    with open(str(tmpdir.join('callbacks.cdict')), 'rb') as ff:
+        assert ff.read() == bulk_content
+
+def test_bulk_durations(tmpdir):
+    build = perf_data_builder
+    records = [build.comm_record(900100, 900101, 'qemu-kvm'),
+               # ignored: no switch yet on cpu 1
+               build.sample_record('sched_stat_runtime', 1000000, 1, 900200, 'sshd', 900200, 5000000, 0),
+               build.sample_record('sched_switch', 2000000, 1, 900200, 'sshd', 900200, 120, 1, 'swapper', 0, 120),
+               build.sample_record('kvm_exit', 2500000, 0, 900101, 12, 0, 0, 0, 0),
+               build.finished_round_record(),
+               # cpu 1 written before cpu 0 in this round
+               build.sample_record('sched_stat_runtime', 3000000, 1, 0, 'swapper', 0, 700000, 0),
+               build.sample_record('sched_stat_runtime', 3500000, 1, 0, 'swapper', 0, 300000, 0),
+               build.sample_record('sched_switch', 4000000, 1, 0, 'swapper', 0, 120, 1, 'sshd', 900200, 120),
+               build.sample_record('kvm_entry', 2600000, 0, 900101, 0),
+               build.finished_round_record(),
+               build.sample_record('kvm_exit', 4500000, 0, 900101, 30, 0, 0, 0, 0),
+               build.sample_record('sched_stat_runtime', 5000000, 1, 900200, 'sshd', 900200, 2000000, 0),
+               build.sample_record('sched_switch', 6000000, 1, 900200, 'sshd', 900200, 120, 1, 'swapper', 0, 120)]
+    perf_data_file = str(tmpdir.join('perf.data'))
+    with open(perf_data_file, 'wb') as ff:
+        ff.write(build.build_perf_data(records))
+    perf_dict, script = convert(perf_data_file, str(tmpdir.join('perf.cdict')), True)
+    # the first switch of cpu 1 has no duration, the first kvm exit sets the epoch (usecs 0)
+    # so the next kvm entry has no duration either
+    assert script.epoch == 2500
+    assert list(perf_dict['event']) == ['sched__sched_switch', 'kvm_exit', 'sched__sched_switch']
+    assert list(perf_dict['usecs']) == [1500, 2000, 3500]
+    assert list(perf_dict['duration']) == [1000, 1900, 2000]
+    assert list(perf_dict['pid']) == [0, 900101, 900200]
+    assert list(perf_dict['task_name']) == ['swapper', 'qemu-kvm', 'sshd']
+    assert list(perf_dict['next_pid']) == [900200, 0, 0]
+    assert list(perf_dict['next_comm']) == ['sshd', 30, 'swapper']
@@ -0,0 +1,258 @@
+# Copyright 2015 Cisco Systems, Inc.  All rights reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+import random
+
+import pytest
+
+import perf_formatter
+from perf_formatter import CdictWriter
+from perf_formatter import open_cdict
+from perf_formatter import open_cdict_summary
+from perf_formatter import read_cdict_file
+from perf_formatter import read_cdict_footer
+from perf_formatter import set_cdict_task_map
+from perf_formatter import write_cdict
+
+TASKS = [(900101, 'qemu-kvm'), (900102, 'qemu-kvm'), (900200, 'sshd'), (0, 'swapper')]
+
+def get_perf_dict(rows=500, seed=1):
+    '''Generate the columns of a capture of sched switches, runtimes and kvm exits'''
+    rand = random.Random(seed)
+    perf_dict = dict((name, []) for name, _ in perf_formatter.CDICT_COLUMNS)
+    usec = 0
+    for _ in range(rows):
+        usec += rand.randint(0, 50)
+        event = rand.choice(['sched__sched_switch', 'sched__sched_stat_runtime', 'kvm_exit'])
+        pid, task_name = rand.choice(TASKS)
+        if event == 'sched__sched_switch':
+            next_pid, next_comm = rand.choice(TASKS)
+        elif event == 'kvm_exit':
+            # the exit reason is stored in next_comm
+            next_pid, next_comm = 0, rand.choice([1, 12, 30, 48])
+        else:
+            next_pid, next_comm = 0, None
+        for name, value in [('event', event), ('cpu', rand.randint(0, 3)), ('usecs', usec), ('pid', pid),
+                            ('task_name', task_name), ('duration', rand.randint(1, 1000)),
+                            ('next_pid', next_pid), ('next_comm', next_comm)]:
+            perf_dict[name].append(value)
+    return perf_dict
+
+def assert_same_columns(perf_dict, expected, start=0, end=None):
+    assert sorted(perf_dict) == sorted(expected)
+    for name, values in expected.items():
+        assert list(perf_dict[name]) == values[start:end], name
+
+@pytest.mark.parametrize('codec', ['zlib', 'raw'])
+@pytest.mark.parametrize('chunk_rows', [0, 64])
+def test_round_trip(tmpdir, codec, chunk_rows):
+    cdict_file = str(tmpdir.join('perf.cdict'))
+    perf_dict = get_perf_dict()
+    write_cdict(cdict_file, perf_dict, codec, chunk_rows, metadata={'epoch': 1000})
+    assert_same_columns(open_cdict(cdict_file), perf_dict)
+    # the extension is optional
+    assert_same_columns(open_cdict(str(tmpdir.join('perf'))), perf_dict)
+    footer = read_cdict_footer(read_cdict_file(cdict_file))
+    assert footer['rows'] == 500
+    assert len(footer['chunks']) == (8 if chunk_rows else 1)
+    assert footer['metadata'] == {'epoch': 1000}
+
+def test_time_window(tmpdir):
+    cdict_file = str(tmpdir.join('perf.cdict'))
+    perf_dict = get_perf_dict()
+    write_cdict(cdict_file, perf_dict, chunk_rows=100)
+    usecs = perf_dict['usecs']
+    # a window inside the third chunk and the fourth chunk
+    from_usec = usecs[250]
+    to_usec = usecs[320]
+    window_dict = open_cdict(cdict_file, None, from_usec, to_usec)
+    # only the overlapping chunks are decoded
+    assert_same_columns(window_dict, perf_dict, 200, 400)
+    rows = [usec for usec in window_dict['usecs'] if from_usec <= usec <= to_usec]
+    assert rows == [usec for usec in usecs if from_usec <= usec <= to_usec]
+    # a window after the last event
+    assert_same_columns(open_cdict(cdict_file, None, usecs[-1] + 1), perf_dict, 0, 0)
+
+def test_truncated_file(tmpdir):
+    cdict_file = str(tmpdir.join('perf.cdict'))
+    perf_dict = get_perf_dict()
+    write_cdict(cdict_file, perf_dict, chunk_rows=100)
+    chunks = read_cdict_footer(read_cdict_file(cdict_file))['chunks']
+    # the conversion was interrupted while writing the third chunk
+    with open(cdict_file, 'r+b') as ff:
+        ff.truncate(chunks[2][0] + 40)
+    assert_same_columns(open_cdict(cdict_file), perf_dict, 0, 200)
+    footer = read_cdict_footer(read_cdict_file(cdict_file))
+    assert footer['rows'] == 200
+    # the time index of the complete chunks is recovered
+    assert footer['chunks'] == chunks[:2]
+
+def test_set_cdict_task_map(tmpdir):
+    cdict_file = str(tmpdir.join('perf.cdict'))
+    perf_dict = get_perf_dict()
+    write_cdict(cdict_file, perf_dict, chunk_rows=100)
+    assert set_cdict_task_map(cdict_file, {900101: 'vm1.vcpu0', 900200: 'sshd-renamed'})
+    mapped_dict = open_cdict(cdict_file)
+    task_names = {900101: 'vm1.vcpu0', 900102: 'qemu-kvm', 900200: 'sshd-renamed', 0: 'swapper'}
+    assert list(mapped_dict['task_name']) == [task_names[pid] for pid in perf_dict['pid']]
+    # the next task of the switches is also renamed
+    assert [name for pid, name in zip(mapped_dict['next_pid'], mapped_dict['next_comm']) if pid == 900200] == \
+        ['sshd-renamed'] * perf_dict['next_pid'].count(900200)
+    assert list(mapped_dict['usecs']) == perf_dict['usecs']
+    # a new mapping table replaces the previous one
+    assert set_cdict_task_map(cdict_file, {900102: 'vm1.vcpu1'})
+    task_names = {900101: 'qemu-kvm', 900102: 'vm1.vcpu1', 900200: 'sshd', 0: 'swapper'}
+    assert list(open_cdict(cdict_file)['task_name']) == [task_names[pid] for pid in perf_dict['pid']]
+    # not a v2 cdict file
+    v1_file = tmpdir.join('v1.cdict')
+    v1_file.write(perf_formatter.zlib.compress(perf_formatter.packb(perf_dict)), 'wb')
+    assert not set_cdict_task_map(str(v1_file), {})
+
+def get_aggregates(perf_dict, counts=None):
+    '''Get the number of events and the total duration per (event, pid, task name, cpu)'''
+    aggregates = {}
+    if counts is None:
+        counts = [1] * len(perf_dict['usecs'])
+    for event, pid, task_name, cpu, duration, count in zip(perf_dict['event'], perf_dict['pid'],
+                                                           perf_dict['task_name'], perf_dict['cpu'],
+                                                           perf_dict['duration'], counts):
+        aggregate = aggregates.setdefault((event, pid, task_name, cpu), [0, 0])
+        aggregate[0] += count
+        aggregate[1] += duration
+    return aggregates
+
+@pytest.mark.parametrize('use_numpy', [True, False])
+def test_summary(tmpdir, monkeypatch, use_numpy):
+    if not use_numpy:
+        monkeypatch.setattr(perf_formatter, 'np', None)
+    cdict_file = str(tmpdir.join('perf.cdict'))
+    perf_dict = get_perf_dict()
+    writer = CdictWriter(cdict_file, summary_usecs=1000)
+    for start in range(0, 500, 64):
+        writer.add_chunk(dict((name, values[start:start + 64]) for name, values in perf_dict.items()))
+    writer.close()
+    assert_same_columns(open_cdict(cdict_file), perf_dict)
+    summary_dict, usecs_range, interval = open_cdict_summary(cdict_file)
+    assert usecs_range == [perf_dict['usecs'][0], perf_dict['usecs'][-1]]
+    assert interval == 1000
+    assert sum(summary_dict['count']) == 500
+    assert get_aggregates(summary_dict, summary_dict['count']) == get_aggregates(perf_dict)
+    # the cells are in time order and have the usecs of their first event
+    assert summary_dict['usecs'] == sorted(summary_dict['usecs'])
+    assert set(summary_dict['usecs']) <= set(perf_dict['usecs'])
+    # the kvm exit reasons are kept
+    reasons = [reason for event, reason in zip(perf_dict['event'], perf_dict['next_comm']) if event == 'kvm_exit']
+    assert sorted(set(reason for event, reason in zip(summary_dict['event'], summary_dict['next_comm'])
+                      if event == 'kvm_exit')) == sorted(set(reasons))
+    # same cells for any chunk size
+    writer = CdictWriter(cdict_file, summary_usecs=1000)
+    writer.add_chunk(perf_dict)
+    writer.close()
+    assert open_cdict_summary(cdict_file)[0] == summary_dict
+
+def select_rows(perf_dict, from_usec, to_usec):
+    rows = [index for index, usec in enumerate(perf_dict['usecs']) if from_usec <= usec < to_usec]
+    return dict((name, [values[index] for index in rows]) for name, values in perf_dict.items())
+
+def test_summary_window(tmpdir):
+    cdict_file = str(tmpdir.join('perf.cdict'))
+    perf_dict = get_perf_dict()
+    writer = CdictWriter(cdict_file, summary_usecs=1000)
+    writer.add_chunk(perf_dict)
+    writer.close()
+    summary_dict = open_cdict_summary(cdict_file)[0]
+    # the cells of a window on cell boundaries have the same aggregates as the events of the window
+    window_dict = select_rows(summary_dict, 2000, 6000)
+    assert get_aggregates(window_dict, window_dict['count']) == get_aggregates(select_rows(perf_dict, 2000, 6000))
+    # but not the cells of a window that starts inside a cell
+    window_dict = select_rows(summary_dict, 2500, 6000)
+    assert get_aggregates(window_dict, window_dict['count']) != get_aggregates(select_rows(perf_dict, 2500, 6000))
+
+def test_no_summary(tmpdir):
+    cdict_file = str(tmpdir.join('perf.cdict'))
+    write_cdict(cdict_file, get_perf_dict())
+    assert open_cdict_summary(cdict_file) == (None, None, None)
+
+def write_segments(tmpdir, perf_dict, summary_usecs=0):
+    '''Write the first and second half of the events in 2 segments (the second one starts 10 msec later)
+    :return: the name of the manifest file and the names of the segment files
+    '''
+    segment_files = []
+    for index, (start, end) in enumerate([(0, 250), (250, 500)]):
+        segment_file = str(tmpdir.join('perf.%d.cdict' % (index)))
+        shift = index * 10000
+        writer = CdictWriter(segment_file, summary_usecs=summary_usecs)
+        writer.metadata = {'epoch': 5000000 + shift}
+        segment = dict((name, values[start:end]) for name, values in perf_dict.items())
+        segment['usecs'] = [usec - shift for usec in segment['usecs']]
+        writer.add_chunk(segment)
+        writer.close()
+        segment_files.append(segment_file)
+    manifest_file = str(tmpdir.join('perf.cdict'))
+    perf_formatter.write_cdict_manifest(manifest_file, segment_files)
+    return manifest_file, segment_files
+
+def test_segments(tmpdir):
+    perf_dict = get_perf_dict()
+    # the usecs of the second segment are relative to its own epoch
+    perf_dict['usecs'] = [usec + (10000 if index >= 250 else 0) for index, usec in enumerate(perf_dict['usecs'])]
+    manifest_file, segment_files = write_segments(tmpdir, perf_dict, summary_usecs=1000)
+    # the usecs of all the segments are relative to the first one
+    assert_same_columns(open_cdict(manifest_file), perf_dict)
+    # only the segments that overlap a window are decoded
+    assert_same_columns(open_cdict(manifest_file, None, 0, perf_dict['usecs'][100]), perf_dict, 0, 250)
+    assert_same_columns(open_cdict(manifest_file, None, perf_dict['usecs'][300]), perf_dict, 250, 500)
+    assert perf_formatter.get_cdict_last_usec(manifest_file) == perf_dict['usecs'][-1]
+    # the summaries of the segments are merged
+    summary_dict, usecs_range, interval = open_cdict_summary(manifest_file)
+    assert usecs_range == [perf_dict['usecs'][0], perf_dict['usecs'][-1]]
+    assert interval == 1000
+    assert get_aggregates(summary_dict, summary_dict['count']) == get_aggregates(perf_dict)
+    # a single file with all the events of the manifest
+    single_file = str(tmpdir.join('single.cdict'))
+    perf_formatter.transcode_cdict(manifest_file, single_file)
+    assert_same_columns(open_cdict(single_file), perf_dict)
+    # the mapping table is stored in all the segments
+    assert set_cdict_task_map(manifest_file, {900200: 'sshd-renamed'})
+    for segment_file in segment_files:
+        assert read_cdict_footer(read_cdict_file(segment_file))['task_map'] == {900200: 'sshd-renamed'}
+    assert 'sshd-renamed' in list(open_cdict(manifest_file)['task_name'])
+
+def test_segments_digest(tmpdir):
+    perf_dict = get_perf_dict()
+    manifest_file, segment_files = write_segments(tmpdir, perf_dict)
+    digest = perf_formatter.get_cdict_digest(manifest_file)
+    assert perf_formatter.get_cdict_digest(manifest_file) == digest
+    # the digest covers the content of the segments
+    perf_dict['duration'][400] += 1
+    write_segments(tmpdir, perf_dict)
+    assert perf_formatter.get_cdict_digest(manifest_file) != digest
+
+def test_transcode_summary(tmpdir):
+    cdict_file = str(tmpdir.join('perf.cdict'))
+    perf_dict = get_perf_dict()
+    writer = CdictWriter(cdict_file, summary_usecs=1000)
+    for start in range(0, 500, 100):
+        writer.add_chunk(dict((name, values[start:start + 100]) for name, values in perf_dict.items()))
+    writer.close()
+    summary_dict = open_cdict_summary(cdict_file)[0]
+    raw_file = str(tmpdir.join('raw.cdict'))
+    # all the chunks overlap the window
+    perf_formatter.transcode_cdict(cdict_file, raw_file, 'raw', None, 0, perf_dict['usecs'][-1])
+    assert_same_columns(open_cdict(raw_file), perf_dict)
+    assert open_cdict_summary(raw_file)[0] == summary_dict
+    # the summary of a part of the chunks is dropped
+    perf_formatter.transcode_cdict(cdict_file, raw_file, 'raw', None, perf_dict['usecs'][250], perf_dict['usecs'][320])
+    assert_same_columns(open_cdict(raw_file), perf_dict, 200, 400)
+    assert open_cdict_summary(raw_file) == (None, None, None)
@@ -0,0 +1,75 @@
+# Copyright 2015 Cisco Systems, Inc.  All rights reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+import os
+import sys
+
+import pytest
+
+from conftest import write_synthetic_cdict
+import perfmap
+import perfmap_cache
+
+def test_read_batch_file(tmpdir):
+    batch_file = tmpdir.join('queries.txt')
+    batch_file.write('# dashboards of the first VM\n'
+                     'charts   vm00.*\n'
+                     '\n'
+                     'heatmaps *.vcpu0\n'
+                     '  charts vm01.vcpu[01]  \n')
+    assert perfmap.read_batch_file(str(batch_file)) == [('charts', 'vm00.*'),
+                                                        ('heatmaps', '.*.vcpu0'),
+                                                        ('charts', 'vm01.vcpu[01]')]
+
+@pytest.mark.parametrize('line', ['charts', 'chart vm00.*', 'heatmaps'])
+def test_read_batch_file_invalid(tmpdir, line):
+    batch_file = tmpdir.join('queries.txt')
+    batch_file.write('charts vm00.*\n' + line + '\n')
+    with pytest.raises(ValueError):
+        perfmap.read_batch_file(str(batch_file))
+
+def run_perfmap(monkeypatch, capsys, args):
+    '''Run perfmap with fresh module globals
+    :return: the standard output
+    '''
+    for name, value in [('from_time', 0), ('cap_time', 0), ('batch_dfds', None)]:
+        monkeypatch.setattr(perfmap, name, value)
+    monkeypatch.setattr(sys, 'argv', ['perfmap'] + args)
+    perfmap.main()
+    return capsys.readouterr()[0]
+
+@pytest.mark.parametrize('jobs', ['1', '2'])
+def test_queries(tmpdir, monkeypatch, capsys, jobs):
+    monkeypatch.setattr(perfmap_cache, 'PERFMAP_CACHE_DIR', str(tmpdir.join('cache')))
+    cdict_file = write_synthetic_cdict(str(tmpdir.join('synthetic.cdict')))
+    batch_file = tmpdir.join('queries.txt')
+    batch_file.write('heatmaps vm00.vcpu0\n')
+    output_dir = tmpdir.mkdir('out')
+    args = ['-t', 'vm00.*', '-t', 'vm01.*', '--batch', str(batch_file), '-j', jobs,
+            '--headless', '--label', 'run', '--output-dir', str(output_dir), cdict_file]
+    out = run_perfmap(monkeypatch, capsys, args)
+    # a single load for all the queries
+    assert out.count('synthetic: 20000 events') == 1
+    assert 'Using cached' not in out
+    assert sorted(os.listdir(str(output_dir))) == ['run-charts_vm00.*.html', 'run-charts_vm01.*.html',
+                                                   'run-heatmaps_vm00.vcpu0.html']
+    # the charts of every query only have the selected tasks
+    for vm, other in [('vm00', 'vm01'), ('vm01', 'vm00')]:
+        html = output_dir.join('run-charts_%s.*.html' % (vm)).read()
+        assert vm + '.vcpu1' in html and other + '.vcpu1' not in html
+    # all the queries are in the cache
+    out = run_perfmap(monkeypatch, capsys, args)
+    assert 'synthetic: 20000 events' not in out
+    for task_re in ['vm00.*', 'vm01.*', 'vm00.vcpu0']:
+        assert 'Using cached chart data for ' + task_re in out
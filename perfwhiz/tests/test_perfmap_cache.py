@@ -0,0 +1,55 @@
+# Copyright 2015 Cisco Systems, Inc.  All rights reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+import os
+
+import perf_formatter
+from perf_formatter import get_cdict_digest
+from perf_formatter import write_cdict
+import perfmap_cache
+from perfmap_cache import get_cdict_digests
+
+def test_digests_reused(tmpdir, monkeypatch):
+    monkeypatch.setattr(perfmap_cache, 'PERFMAP_CACHE_DIR', str(tmpdir.join('cache')))
+    hashed = []
+
+    def digest(cdict_file):
+        hashed.append(cdict_file)
+        return get_cdict_digest(cdict_file)
+    monkeypatch.setattr(perfmap_cache, 'get_cdict_digest', digest)
+    cdict_file = str(tmpdir.join('perf.cdict'))
+    write_cdict(cdict_file, {'usecs': [1, 2, 3], 'duration': [10, 20, 30]})
+    first = get_cdict_digests([cdict_file])
+    # same file through another path: the content is not hashed again
+    assert get_cdict_digests([os.path.join(str(tmpdir), '.', 'perf.cdict')]) == first
+    assert len(hashed) == 1
+    # a new content with the same layout (only the durations change)
+    write_cdict(cdict_file, {'usecs': [1, 2, 3], 'duration': [10, 20, 31]})
+    os.utime(cdict_file, (0, 0))
+    second = get_cdict_digests([cdict_file])
+    assert len(hashed) == 2
+    assert second != first
+    assert second == [get_cdict_digest(cdict_file)]
+
+def test_identity_of_manifest(tmpdir):
+    segments = []
+    for index in range(2):
+        segments.append(str(tmpdir.join('seg%d.cdict' % (index))))
+        write_cdict(segments[-1], {'usecs': [index, index + 1]})
+    perf_formatter.write_cdict_manifest(str(tmpdir.join('capture')), segments)
+    identity = perf_formatter.get_cdict_identity(str(tmpdir.join('capture.cdict')))
+    assert [entry[0] for entry in identity] == [str(tmpdir.join(name))
+                                                for name in ['capture.cdict', 'seg0.cdict', 'seg1.cdict']]
+    # the footer of the segments is part of the identity
+    assert identity[0][5] is None and identity[1][5] and identity[2][5]
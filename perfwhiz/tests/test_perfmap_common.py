@@ -0,0 +1,49 @@
+# Copyright 2015 Cisco Systems, Inc.  All rights reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+from pandas import DataFrame
+
+from perf_formatter import get_cdict_last_usec
+from perf_formatter import open_cdict
+from perf_formatter import write_cdict
+from perfmap_common import DfDesc
+
+def write_gap_cdict(cdict_file):
+    '''Write 2 chunks of switches with no events between 1000 and 5000 usecs'''
+    usecs = [0, 500, 1000, 5000, 5500, 6000]
+    write_cdict(cdict_file, {'event': ['sched__sched_switch'] * 6,
+                             'cpu': [0] * 6,
+                             'usecs': usecs,
+                             'pid': [10] * 6,
+                             'task_name': ['vm.vcpu0'] * 6,
+                             'duration': [100] * 6,
+                             'next_pid': [0] * 6,
+                             'next_comm': ['swapper'] * 6}, chunk_rows=3)
+
+def test_window_multiplier(tmpdir):
+    cdict_file = str(tmpdir.join('gap.cdict'))
+    write_gap_cdict(cdict_file)
+    assert get_cdict_last_usec(cdict_file) == 6000
+    # only the first chunk overlaps the window
+    perf_dict = open_cdict(cdict_file, None, 0, 3000)
+    assert list(perf_dict['usecs']) == [0, 500, 1000]
+    dfd = DfDesc(cdict_file, DataFrame(perf_dict), last_usec=get_cdict_last_usec(cdict_file))
+    assert dfd.get_last_usec() == 6000
+    dfd.normalize(0, 3000)
+    # the capture covers the window, there are just no events after 1000 usecs
+    assert dfd.multiplier == 1.0
+    # a window that ends after the capture
+    dfd = DfDesc(cdict_file, DataFrame(open_cdict(cdict_file)), last_usec=get_cdict_last_usec(cdict_file))
+    dfd.normalize(0, 12000)
+    assert dfd.multiplier == 2.0
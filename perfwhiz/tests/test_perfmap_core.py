@@ -0,0 +1,92 @@
+# Copyright 2015 Cisco Systems, Inc.  All rights reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+from pandas import DataFrame
+
+from conftest import write_synthetic_cdict
+from perf_formatter import open_cdict
+from perf_formatter import open_cdict_summary
+from perfmap_common import DfDesc
+from perfmap_core import get_coremaps
+
+def get_dfd(rows, name='run'):
+    '''Get a normalized dataframe descriptor from a list of (event, cpu, usecs, task name, duration)'''
+    perf_dict = dict((column, []) for column in ['event', 'cpu', 'usecs', 'pid', 'task_name', 'duration',
+                                                 'next_pid', 'next_comm'])
+    for event, cpu, usecs, task_name, duration in rows:
+        for column, value in [('event', event), ('cpu', cpu), ('usecs', usecs), ('pid', len(task_name)),
+                              ('task_name', task_name), ('duration', duration), ('next_pid', 0),
+                              ('next_comm', 'swapper')]:
+            perf_dict[column].append(value)
+    dfd = DfDesc(name, DataFrame(perf_dict))
+    dfd.normalize(0, rows[-1][2])
+    return dfd
+
+def test_coremaps():
+    switch = 'sched__sched_switch'
+    dfd = get_dfd([('kvm_exit', 3, 0, 'vmA.vcpu0', 10),
+                   (switch, 0, 100, 'vmA.vcpu0', 100),
+                   (switch, 1, 200, 'vmB.vcpu0', 300),
+                   (switch, 0, 300, 'vmA.vcpu0', 100),
+                   (switch, 1, 400, 'swapper', 0),
+                   (switch, 2, 500, 'vmA.vcpu0', 50),
+                   (switch, 3, 600, 'sshd', 400),
+                   ('kvm_exit', 3, 1000, 'vmA.vcpu0', 10)])
+    coremaps, max_core = get_coremaps([dfd], 1000, 'vm|swapper')
+    assert max_core == 3
+    # the tasks in reverse order followed by all tasks, only the cpus with switches are listed
+    assert coremaps == [{'run': 'run',
+                         'extent': '[1, 2]',
+                         'coremap': [{'task': 'vmB.vcpu0', 'counts': [[1, 30.0, 1], ['all', 30.0, 1]]},
+                                     {'task': 'vmA.vcpu0', 'counts': [[0, 20.0, 2], [2, 5.0, 1], ['all', 25.0, 3]]},
+                                     {'task': 'swapper', 'counts': [[1, 0.0, 1], ['all', 0.0, 1]]},
+                                     {'task': 'all tasks', 'counts': [[0, 20.0, 2], [1, 30.0, 2], [2, 5.0, 1],
+                                                                      ['all', 55.0, 5]]}]}]
+    assert get_coremaps([dfd], 1000, 'nomatch') == (None, 0)
+
+def get_groupby_coremap(dfd, task_re):
+    '''Get the counts of a coremap with a group by (reference implementation)'''
+    df = dfd.df[(dfd.df['event'] == 'sched__sched_switch') & dfd.df['task_name'].str.match(task_re)]
+    span = dfd.get_time_span_usec()
+    counts = {}
+    for (task, cpu), group in df.groupby(['task_name', 'cpu'], observed=True):
+        count = group['count'].sum() if 'count' in group else len(group)
+        counts.setdefault(task, []).append([cpu, round(group['duration'].sum() * 100.0 / span, 2), count])
+    return counts
+
+def test_coremaps_groupby(tmpdir):
+    cdict_file = write_synthetic_cdict(str(tmpdir.join('synthetic.cdict')), summary=10)
+    dfd = DfDesc(cdict_file, DataFrame(open_cdict(cdict_file)))
+    dfd.normalize(0, dfd.get_last_usec())
+    summary_dict, usecs_range, _ = open_cdict_summary(cdict_file)
+    summary_dfd = DfDesc(cdict_file, DataFrame(summary_dict), usecs_range=usecs_range)
+    summary_dfd.normalize(0, summary_dfd.get_last_usec())
+    task_re = 'vm|task[0-2]'
+    coremap = get_coremaps([dfd], dfd.get_last_usec(), task_re)[0][0]['coremap']
+    expected = get_groupby_coremap(dfd, task_re)
+    assert sorted(expected) == sorted(row['task'] for row in coremap[:-1])
+    for row in coremap[:-1]:
+        cells = sorted(expected[row['task']])
+        assert row['counts'][:-1] == cells
+        assert row['counts'][-1][2] == sum(count for _, _, count in cells)
+    # the vcpus are pinned, the other tasks run on every cpu
+    assert [len(row['counts']) for row in coremap if 'vcpu' in row['task']] == [2] * 4
+    # same coremap from the summary
+    summary_coremap = get_coremaps([summary_dfd], summary_dfd.get_last_usec(), task_re)[0][0]['coremap']
+    assert [row['task'] for row in summary_coremap] == [row['task'] for row in coremap]
+    for row, summary_row in zip(coremap, summary_coremap):
+        assert [cell[0] for cell in summary_row['counts']] == [cell[0] for cell in row['counts']]
+        assert [cell[2] for cell in summary_row['counts']] == [cell[2] for cell in row['counts']]
+        for cell, summary_cell in zip(row['counts'], summary_row['counts']):
+            assert abs(cell[1] - summary_cell[1]) < 0.05
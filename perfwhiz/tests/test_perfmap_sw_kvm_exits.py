@@ -0,0 +1,144 @@
+# Copyright 2015 Cisco Systems, Inc.  All rights reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+import numpy as np
+from pandas import DataFrame
+import pytest
+
+from perfmap_common import DfDesc
+import perfmap_sw_kvm_exits
+from perfmap_sw_kvm_exits import get_column_buffer
+from perfmap_sw_kvm_exits import get_sw_kvm_events
+from perfmap_sw_kvm_exits import LOD_DURATION_BINS
+from perfmap_sw_kvm_exits import LOD_TIME_BINS
+from perfmap_sw_kvm_exits import MAX_SERIES_EVENTS
+
+def get_dfd(exits, switches=100, seed=1):
+    '''Get a dataframe descriptor with a number of kvm exits of vm.vcpu0 and switches of vm.vcpu1'''
+    rng = np.random.RandomState(seed)
+    rows = exits + switches
+    usecs = np.sort(rng.randint(0, 10000000, rows))
+    event = np.array(['kvm_exit'] * rows, dtype=object)
+    task_name = np.array(['vm.vcpu0'] * rows, dtype=object)
+    switch_rows = rng.choice(rows, switches, replace=False)
+    event[switch_rows] = 'sched__sched_switch'
+    task_name[switch_rows] = 'vm.vcpu1'
+    dfd = DfDesc('run', DataFrame({'event': event,
+                                   'cpu': rng.randint(0, 4, rows),
+                                   'usecs': usecs,
+                                   'pid': np.where(task_name == 'vm.vcpu0', 101, 102),
+                                   'task_name': task_name,
+                                   'duration': rng.lognormal(3, 2, rows).astype(np.int64),
+                                   'next_pid': np.zeros(rows, dtype=np.int64),
+                                   'next_comm': np.array([12] * rows, dtype=object)}))
+    dfd.normalize(0, int(usecs[-1]))
+    return dfd
+
+def test_small_series():
+    dfd = get_dfd(1000)
+    events = get_sw_kvm_events(dfd, 'vm')
+    assert [task['task'] for task in events['task_events']] == ['vm.vcpu0', 'vm.vcpu1']
+    exits = events['task_events'][0]['events']['kvm_exit']
+    assert exits['count'] == 1000 and 'lod' not in exits
+    df = dfd.df[dfd.df['event'] == 'kvm_exit']
+    assert exits['usecs'].tolist() == df['usecs'].tolist()
+    assert exits['duration'].tolist() == df['duration'].tolist()
+    assert exits['cpu'].tolist() == df['cpu'].tolist()
+    assert events['task_events'][1]['events']['sched__sched_switch']['count'] == 100
+    assert events['task_events'][1]['events']['kvm_exit']['count'] == 0
+
+def check_lod(series, usecs, durations, usecs_min, usecs_max, duration_max):
+    '''Check the levels of detail of a series against its raw events'''
+    assert [level['time_bins'] for level in series['lod']] == LOD_TIME_BINS
+    log_max = np.log10(duration_max)
+    for level in series['lod']:
+        time_bins = level['time_bins']
+        for name in ['time', 'duration', 'count']:
+            assert level[name].dtype.str == '<u4'
+        assert level['count'].sum() == len(usecs)
+        assert level['time'].max() < time_bins and level['duration'].max() < LOD_DURATION_BINS
+        # same totals per time bin and per duration bin as the raw events
+        time_bin = np.minimum((usecs - usecs_min) * time_bins // (usecs_max - usecs_min), time_bins - 1)
+        assert np.bincount(level['time'], weights=level['count'], minlength=time_bins).tolist() == \
+            np.bincount(time_bin, minlength=time_bins).tolist()
+        duration_bin = [min(int(np.log10(max(duration, 1)) * (LOD_DURATION_BINS / log_max)), LOD_DURATION_BINS - 1)
+                        for duration in durations]
+        assert np.bincount(level['duration'], weights=level['count'], minlength=LOD_DURATION_BINS).tolist() == \
+            np.bincount(duration_bin, minlength=LOD_DURATION_BINS).tolist()
+
+@pytest.mark.parametrize('max_raw_events', [None, 55000])
+def test_lod(monkeypatch, max_raw_events):
+    if max_raw_events:
+        monkeypatch.setattr(perfmap_sw_kvm_exits, 'MAX_RAW_EVENTS', max_raw_events)
+    exits = MAX_SERIES_EVENTS + 10000
+    dfd = get_dfd(exits)
+    events = get_sw_kvm_events(dfd, 'vm')
+    series = events['task_events'][0]['events']['kvm_exit']
+    assert series['count'] == exits
+    df = dfd.df[dfd.df['event'] == 'kvm_exit']
+    check_lod(series, df['usecs'].values, df['duration'].values, dfd.from_usec, dfd.to_usec,
+              events['usecs_duration_max'])
+    # the first raw events are kept
+    raw_events = max_raw_events or exits
+    assert series['usecs'].tolist() == df['usecs'].tolist()[:raw_events]
+    assert series['raw_usecs_max'] == (df['usecs'].iloc[raw_events - 1] if max_raw_events else dfd.to_usec)
+    # the small series of the other task is not aggregated
+    assert 'lod' not in events['task_events'][1]['events']['sched__sched_switch']
+
+def test_column_buffer():
+    swk_events = {'usecs_min': 10,
+                  'task_events': [{'task': 'vm.vcpu0',
+                                   'events': {'kvm_exit': {'count': 3,
+                                                           'usecs': np.array([1, 2, 3], dtype='<f8'),
+                                                           'cpu': np.array([5, 6, 7], dtype='<u4'),
+                                                           'lod': [{'time_bins': 250,
+                                                                    'count': np.array([9], dtype='<u4')}]}}}]}
+    info, buf = get_column_buffer(swk_events)
+    exits = info['task_events'][0]['events']['kvm_exit']
+    # the other values are unchanged
+    assert info['usecs_min'] == 10 and exits['count'] == 3 and exits['lod'][0]['time_bins'] == 250
+    columns = [(exits['usecs'], [1, 2, 3]), (exits['cpu'], [5, 6, 7]), (exits['lod'][0]['count'], [9])]
+    for desc, values in columns:
+        assert sorted(desc) == ['buffer_offset', 'length', 'type']
+        assert desc['buffer_offset'] % 8 == 0
+        assert desc['length'] == len(values)
+        # little endian typed arrays
+        column = np.frombuffer(buf, dtype='<' + desc['type'], count=desc['length'], offset=desc['buffer_offset'])
+        assert column.tolist() == values
+    # the columns do not overlap and the buffer is padded to 8 bytes
+    ranges = sorted((desc['buffer_offset'], desc['buffer_offset'] + desc['length'] * int(desc['type'][1]))
+                    for desc, _ in columns)
+    assert all(end <= next_start for (_, end), (next_start, _) in zip(ranges, ranges[1:]))
+    assert len(buf) % 8 == 0 and len(buf) == 24 + 16 + 8
+    with pytest.raises(KeyError):
+        # only the types that the heatmaps page can map
+        get_column_buffer({'usecs': np.array([1], dtype='>f8')})
+
+def test_column_buffer_of_events():
+    dfd = get_dfd(MAX_SERIES_EVENTS + 10000)
+    events = get_sw_kvm_events(dfd, 'vm')
+    info, buf = get_column_buffer(events)
+    for task, task_info in zip(events['task_events'], info['task_events']):
+        for event, series in task['events'].items():
+            series_info = task_info['events'][event]
+            for name in ['usecs', 'duration', 'cpu']:
+                desc = series_info[name]
+                assert desc['buffer_offset'] % 8 == 0
+                column = np.frombuffer(buf, dtype='<' + desc['type'], count=desc['length'],
+                                       offset=desc['buffer_offset'])
+                assert column.tolist() == series[name].tolist()
+            for level, level_info in zip(series.get('lod', []), series_info.get('lod', [])):
+                desc = level_info['count']
+                assert np.frombuffer(buf, dtype='<u4', count=desc['length'],
+                                     offset=desc['buffer_offset']).sum() == series['count']
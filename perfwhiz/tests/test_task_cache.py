@@ -0,0 +1,65 @@
+# Copyright 2015 Cisco Systems, Inc.  All rights reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+import pytest
+
+import perf_formatter
+
+QEMU_INFO = ['instance-00000001', '4f5e6a7b-0000-4000-8000-000000000001', 'vcpu0']
+
+@pytest.fixture
+def tasks(monkeypatch):
+    '''Fake /proc: start time and decode_pid information indexed by tid (tids not in the dict have exited)'''
+    tasks = {}
+    monkeypatch.setattr(perf_formatter, 'task_cache', {})
+    monkeypatch.setattr(perf_formatter, 'task_cache_updated', False)
+    monkeypatch.setattr(perf_formatter, 'snapshot_qemu_tasks', {})
+    monkeypatch.setattr(perf_formatter, 'snapshot_other_tids', set())
+    monkeypatch.setattr(perf_formatter, 'snapshot_time', None)
+    monkeypatch.setattr(perf_formatter, 'get_start_time', lambda tid: tasks[tid][0] if tid in tasks else None)
+    monkeypatch.setattr(perf_formatter, 'decode_pid', lambda tid: tuple(tasks[tid][1:]))
+    return tasks
+
+def test_only_qemu_threads_cached(tasks):
+    tasks[100] = [5000] + QEMU_INFO
+    tasks[200] = [5000, None, None, None]
+    assert perf_formatter.decode_task(100) == tuple(QEMU_INFO)
+    assert perf_formatter.decode_task(200) == (None, None, None)
+    assert perf_formatter.task_cache == {100: [5000] + QEMU_INFO}
+
+def test_exited_task(tasks):
+    perf_formatter.task_cache[100] = [5000] + QEMU_INFO
+    perf_formatter.task_cache[101] = [9000] + QEMU_INFO
+    # without snapshot, the entry of an exited tid may belong to a previous task
+    assert perf_formatter.decode_task(100) == (None, None, None)
+    perf_formatter.load_task_snapshot({'tasks': {}, 'others': [], 'time': 8000})
+    # started before the capture: not in the snapshot so the tid has been reused
+    assert perf_formatter.decode_task(100) == (None, None, None)
+    # started during the capture
+    assert perf_formatter.decode_task(101) == tuple(QEMU_INFO)
+
+def test_reused_tid(tasks):
+    perf_formatter.task_cache[100] = [5000] + QEMU_INFO
+    tasks[100] = [6000, None, None, None]
+    assert perf_formatter.decode_task(100) == (None, None, None)
+    assert 100 not in perf_formatter.task_cache
+
+def test_cache_bounded(tasks, monkeypatch):
+    monkeypatch.setattr(perf_formatter, 'TASK_CACHE_MAX_TASKS', 2)
+    for tid in range(5):
+        tasks[tid + 100] = [1000 - tid] + QEMU_INFO
+        perf_formatter.decode_task(tid + 100)
+    perf_formatter.save_task_cache()
+    perf_formatter.load_task_cache()
+    assert sorted(perf_formatter.task_cache) == [100, 101]